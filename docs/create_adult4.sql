@@ -14,5 +14,7 @@ CREATE TABLE DEV__MODELLING.CANCER__SURVIVAL.ADULT_4 (
     "SURVIVAL_PERCENT" FLOAT,
     "DATE_DIAGNOSIS_WINDOW" VARCHAR,
     "DATE_SNAPSHOT" VARCHAR,
+    "ROW_KEY" NUMBER,
+    "ROW_HASH" NUMBER,
     "_TIMESTAMP" TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
 )
\ No newline at end of file
@@ -0,0 +1,12 @@
+--Snowflake SQL to create the Benchmarking Rank table (loaded by the ETL from the Adult 4 data)
+CREATE TABLE DEV__MODELLING.CANCER__SURVIVAL.BENCHMARKING_RANK (
+    "JOIN_KEY" VARCHAR,
+    "CANCER_SITE" VARCHAR,
+    "SURVIVAL_PERCENT" FLOAT,
+    "RANK_CA" NUMBER,
+    "RANK_BASE" NUMBER,
+    "NCL_QUARTILE" VARCHAR,
+    "ROW_KEY" NUMBER,
+    "ROW_HASH" NUMBER,
+    "_TIMESTAMP" TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+)
@@ -0,0 +1,14 @@
+--Snowflake SQL to create the Benchmarking Standards table (loaded by the ETL from the Adult 4 data)
+CREATE TABLE DEV__MODELLING.CANCER__SURVIVAL.BENCHMARKING_STANDARDS (
+    "JOIN_KEY" VARCHAR,
+    "ENGLAND" FLOAT,
+    "LONDON" FLOAT,
+    "BEST" FLOAT,
+    "WORST" FLOAT,
+    "Q1" FLOAT,
+    "Q2" FLOAT,
+    "Q3" FLOAT,
+    "ROW_KEY" NUMBER,
+    "ROW_HASH" NUMBER,
+    "_TIMESTAMP" TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+)
@@ -16,5 +16,7 @@ CREATE OR REPLACE TABLE DEV__MODELLING.CANCER__SURVIVAL.INDEX(
     "PRECISION" FLOAT,
     "STANDARD_ERROR" FLOAT,
     "IS_DATA_SUBTITUTED" BOOLEAN,
+    "ROW_KEY" NUMBER,
+    "ROW_HASH" NUMBER,
     "_TIMESTAMP" TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
 )
\ No newline at end of file
@@ -0,0 +1,9 @@
+--Snowflake SQL to add the ROW_KEY and ROW_HASH columns to the Index and Adult 4
+--tables created before they were added to create_index.sql and create_adult4.sql
+--These columns are needed to load the tables with LOAD_MODE=merge or swap and by
+--the reporting views (which exclude them), but not by the default replace load
+ALTER TABLE DEV__MODELLING.CANCER__SURVIVAL.INDEX 
+    ADD COLUMN IF NOT EXISTS "ROW_KEY" NUMBER, "ROW_HASH" NUMBER;
+
+ALTER TABLE DEV__MODELLING.CANCER__SURVIVAL.ADULT_4 
+    ADD COLUMN IF NOT EXISTS "ROW_KEY" NUMBER, "ROW_HASH" NUMBER;
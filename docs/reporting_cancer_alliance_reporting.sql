@@ -20,7 +20,7 @@ AS
 
 --Script to pull in the data for core areas in the adult4 data
 SELECT 
-    * EXCLUDE _TIMESTAMP, 
+    * EXCLUDE (_TIMESTAMP, ROW_KEY, ROW_HASH), 
 	CONCAT(CANCER_SITE, GENDER, YEARS_SINCE_DIAGNOSIS, DATE_DIAGNOSIS_WINDOW) AS JOIN_KEY,
     CASE GENDER
         WHEN 'Persons' THEN 1
@@ -39,7 +39,7 @@ SELECT
     END AS SORT_AGE
     
 FROM (
-    SELECT * EXCLUDE _TIMESTAMP 
+    SELECT * EXCLUDE (_TIMESTAMP, ROW_KEY, ROW_HASH) 
     FROM DEV__MODELLING.CANCER__SURVIVAL.INDEX
     WHERE IS_AREA_CORE = TRUE
     
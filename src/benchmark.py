@@ -0,0 +1,426 @@
+#Benchmarks for the ETL using synthetic NHSD shaped workbooks
+#
+#Run with (from the root of the repository):
+#   python src/benchmark.py [--rows N [N ...]] [--stream-rows N] [--dtypes]
+#                       [--backend sqlite|duckdb]
+#
+#By default the read, transform, load and query stages are timed for each 
+#workbook against a local SQLite (or DuckDB) database (no NHSD or Snowflake
+#access is needed).
+#The synthetic workbooks are saved in output/benchmark/ (and reused if they
+#already exist) and the results are saved as JSON in output/ so runs from
+#different commits can be compared.
+
+import argparse
+import json
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime as dt
+from itertools import product
+from os import makedirs, remove
+from os.path import isfile, join
+
+from openpyxl import Workbook
+from sqlalchemy import create_engine, text
+
+import main as etl
+import utils.database_util as db
+import utils.excel_util as excel
+import utils.path_util as paths
+import utils.pipeline_util as pipeline
+from utils.telemetry_util import get_peak_rss
+
+benchmark_dir = join(paths.output_dir, "benchmark")
+
+#Values used to build the synthetic rows
+sites_genders = [
+    ("Breast", "Female"),
+    ("Cervix", "Female"),
+    ("Ovary", "Female"),
+    ("Larynx", "Male"),
+    ("Prostate", "Male"),
+    ("Lung", "Male"),
+    ("Lung", "Female"),
+    ("Lung", "Persons"),
+    ("Colorectal", "Male"),
+    ("Colorectal", "Female"),
+    ("Colorectal", "Persons")
+]
+standardisation_types = ["Age-standardised (5 age groups)", "Non-standardised"]
+years_since_diagnosis = [1, 5, 10]
+
+#Get the geography (type, code, name) for the nth synthetic area
+#The first areas are the target geographies, the rest are Cancer Alliances
+def get_geography(n):
+    if n == 0:
+        return ("Country", "E92000001", "England")
+    if n == 1:
+        return ("Region", "E40000003", "London")
+    if n == 2:
+        return ("Cancer Alliance", "E56000027", "North Central London")
+
+    return ("Cancer Alliance", f"E57{n:06d}", f"Cancer Alliance {n}")
+
+def make_adult_workbook(data_file, n_rows):
+
+    """
+    Function to write a synthetic adult cancer survival workbook with a
+    Table 4 sheet of n_rows rows and a Notes and definitions sheet.
+
+    inputs:
+    - data_file: Path to save the workbook to
+    - n_rows: Number of data rows in Table 4
+    """
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Table 4")
+
+    #Lines before the tabular data begins
+    for i in range(9):
+        ws.append([f"Synthetic adult cancer survival data ({i})"])
+
+    ws.append(["Geography type", "Geography code", "Geography name",
+               "Cancer site", "Gender", "Standardisation type",
+               "Years since diagnosis", "Patients", "Net survival (%)",
+               "Overall survival (%)"])
+
+    combinations = list(product(sites_genders, standardisation_types,
+                                years_since_diagnosis))
+    for i in range(n_rows):
+        (site, gender), std, years = combinations[i % len(combinations)]
+        geography = get_geography(i // len(combinations))
+        ws.append([*geography, site, gender, std, years,
+                   100 + i % 900, 40 + i % 50 + 0.1, 30 + i % 50 + 0.2])
+
+    ws = wb.create_sheet("Notes and definitions")
+    for i in range(10):
+        ws.append([f"Synthetic notes ({i})"])
+    ws.append(["Methodology"])
+    ws.append(["Survival estimates are based on a snapshot taken in March 2024 ."])
+
+    wb.save(data_file)
+
+def make_index_workbook(data_file, n_rows):
+
+    """
+    Function to write a synthetic Index of cancer survival workbook with a
+    Table 5 sheet of n_rows rows.
+
+    inputs:
+    - data_file: Path to save the workbook to
+    - n_rows: Number of data rows in Table 5
+    """
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Table 5")
+
+    #Lines before the tabular data begins
+    for i in range(10):
+        ws.append([f"Synthetic index of cancer survival data ({i})"])
+
+    ws.append(["Geography type", "Geography code", "Geography name",
+               "Cancer site", "Gender", "Age at diagnosis",
+               "Standardisation type", "Diagnosis year",
+               "Years since diagnosis", "Patient numbers", "Survival (%)",
+               "Lower CI", "Upper CI", "Precision", "Standard error",
+               "Substituted by Other Geography"])
+
+    index_sites_genders = sites_genders + [("Index", "Persons"),
+                                           ("Other", "Persons")]
+    combinations = list(product(index_sites_genders, ["All ages", "15-44"],
+                                range(2005, 2021), years_since_diagnosis))
+    for i in range(n_rows):
+        (site, gender), age, year, years = combinations[i % len(combinations)]
+        geography = get_geography(i // len(combinations))
+        survival = 40 + i % 50 + 0.1
+        ws.append([*geography, site, gender, age, "Age-standardised", year,
+                   years, 100 + i % 900, survival, survival - 2.5,
+                   survival + 2.5, "High", 1.3,
+                   "E56000001" if i % 20 == 0 else None])
+
+    wb.save(data_file)
+
+#Get the synthetic workbooks for the given number of rows (creating them if
+#they don't already exist)
+def get_workbooks(n_rows):
+    makedirs(benchmark_dir, exist_ok=True)
+
+    index_file = join(benchmark_dir, f"Index_synthetic_{n_rows}.xlsx")
+    adult_file = join(benchmark_dir, f"adult_synthetic_{n_rows}_2017_2021.xlsx")
+
+    if not isfile(index_file):
+        print(f"Creating {index_file}")
+        make_index_workbook(index_file, n_rows)
+    if not isfile(adult_file):
+        print(f"Creating {adult_file}")
+        make_adult_workbook(adult_file, n_rows)
+
+    return index_file, adult_file
+
+#Run a function, returning the result, wall time and peak memory allocated
+#If trace is False, memory allocations are not traced (tracing slows down
+#the workbook parsing a lot) and the peak is None
+def measure(func, *args, trace=True):
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace else None
+    finally:
+        if trace:
+            tracemalloc.stop()
+
+    return result, seconds, peak
+
+#Get the current git commit (so results can be compared between commits)
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_dtypes(n_rows):
+
+    """
+    Function to compare the time and memory used by the transforms with and
+    without compact dtypes (categoricals and downcast integers).
+
+    inputs:
+    - n_rows: Number of rows in each synthetic workbook
+
+    output:
+    Returns a list of results (one per transform and setting)
+    """
+
+    index_file, adult_file = get_workbooks(n_rows)
+    transforms = [
+        ("index", etl.transform_index_data, index_file),
+        ("adult4", etl.transform_adult_data_sheet4, adult_file)
+    ]
+    target_geographies = ["E56000027", "E40000003", "E92000001"]
+
+    results = []
+    for compact in [False, True]:
+        etl.compact_dtypes = compact
+
+        for name, transform, data_file in transforms:
+            #Parse the workbook first so only the transform is measured
+            transform(data_file, target_geographies)
+
+            df, seconds, peak = measure(transform, data_file,
+                                        target_geographies)
+            results.append({
+                "transform": name,
+                "compact_dtypes": compact,
+                "rows_in": n_rows,
+                "rows_out": len(df),
+                "seconds": round(seconds, 3),
+                "peak_bytes": peak,
+                "output_bytes": int(df.memory_usage(deep=True).sum())
+            })
+            print(results[-1])
+
+        excel.close_workbooks()
+
+    return results
+
+#Aggregate query timed after each load (survival by area and site, as used
+#by the reporting views)
+query_sql = """
+SELECT "AREA_CODE", "CANCER_SITE", AVG("SURVIVAL_PERCENT"), COUNT(*)
+FROM {destination}
+GROUP BY "AREA_CODE", "CANCER_SITE"
+"""
+
+def run_stages(n_rows, stream_rows=None, mode="replace", backend="sqlite"):
+
+    """
+    Function to time the read, transform, load and query stages for each 
+    synthetic workbook, loading into a local database.
+
+    inputs:
+    - n_rows: Number of rows in each synthetic workbook
+    - stream_rows: If given, the read, transform and load stages are run 
+    together in chunks of this many rows (as with STREAM_ROWS) and reported
+    as one "stream" stage
+    - mode: Load mode passed to upload_df
+    - backend: Local database to load into, "sqlite" (through SQLAlchemy) or
+    "duckdb" (see database_util.connect_local)
+
+    output:
+    Returns a list of results (one per workbook and stage). Peak RSS is the
+    high water mark of the process so far, so rss_growth_bytes (how much the
+    stage raised it) is the better measure of the memory used by a stage
+    """
+
+    index_file, adult_file = get_workbooks(n_rows)
+    tables = [
+        ("index", etl.index_pipeline, etl.index_key_cols, index_file),
+        ("adult4", etl.adult4_pipeline, etl.adult4_key_cols, adult_file)
+    ]
+    target_geographies = ["E56000027", "E40000003", "E92000001"]
+
+    #Local stand-in for Snowflake (recreated for each run)
+    if backend == "duckdb":
+        ctx = db.connect_local(join(benchmark_dir, "benchmark.duckdb"), 
+                               "BENCHMARK")
+    else:
+        db_file = join(benchmark_dir, "benchmark.db")
+        if isfile(db_file):
+            remove(db_file)
+        ctx = create_engine(f"sqlite:///{db_file}")
+
+    results = []
+    for name, spec, key_cols, data_file in tables:
+        context = {"data_file": data_file, 
+                   "target_geographies": target_geographies}
+
+        #Create the destination table with the columns of the output
+        #(DuckDB tables are created by the first upload)
+        if backend == "duckdb":
+            destination = f"BENCHMARK.MAIN.{name.upper()}_BENCHMARK"
+            ctx.execute(f"DROP TABLE IF EXISTS {destination}")
+        else:
+            destination = f"{name.upper()}_BENCHMARK"
+            df_empty = pipeline.apply_pipeline(
+                spec, pipeline.plan_pipeline(spec),
+                excel.read_sheet(data_file, spec["sheet_name"],
+                                 skiprows=spec["skiprows"], nrows=0,
+                                 use_cache=False),
+                context, compact_dtypes=etl.compact_dtypes)
+            db.add_row_hashes(df_empty, key_cols).to_sql(destination, ctx,
+                                                         index=False)
+            excel.close_workbooks()
+
+        def read():
+            plan = pipeline.plan_pipeline(spec)
+            df = excel.read_sheet(
+                data_file, spec["sheet_name"], skiprows=spec["skiprows"],
+                categories=spec["categories"] if etl.compact_dtypes else None,
+                usecols=plan["usecols"], row_filter=spec["row_filter"](context),
+                use_cache=False)
+            return plan, df
+
+        def transform(plan, df):
+            return pipeline.apply_pipeline(spec, plan, df, context,
+                                           compact_dtypes=etl.compact_dtypes)
+
+        def load(df):
+            if not db.upload_df(ctx, df, destination, key_cols=key_cols,
+                                mode=mode):
+                raise Exception(f"Failed to load {destination}")
+
+        #Read, transform and upload in chunks, returning the rows uploaded
+        def stream():
+            chunks = pipeline.iter_pipeline(spec, data_file, context,
+                                            chunk_rows=stream_rows,
+                                            compact_dtypes=etl.compact_dtypes)
+            nrows = 0
+            def count_rows(chunks):
+                nonlocal nrows
+                for chunk in chunks:
+                    nrows += len(chunk)
+                    yield chunk
+
+            load(count_rows(chunks))
+            return nrows
+
+        #Run the aggregate query, returning the rows returned
+        def query():
+            sql = query_sql.format(destination=destination)
+            if backend == "duckdb":
+                return len(ctx.execute(sql).fetchall())
+
+            with ctx.connect() as con:
+                return len(con.execute(text(sql)).fetchall())
+
+        def add_result(stage, rows_out, seconds, rss_before):
+            rss = get_peak_rss()
+            results.append({
+                "workbook": name,
+                "stage": stage,
+                "rows_in": n_rows,
+                "rows_out": rows_out,
+                "seconds": round(seconds, 3),
+                "rows_per_second": round(rows_out / seconds) if seconds else None,
+                "peak_rss_bytes": rss,
+                "rss_growth_bytes": None if rss is None else rss - rss_before
+            })
+            print(results[-1])
+
+        if stream_rows:
+            rss = get_peak_rss()
+            nrows, seconds, _ = measure(stream, trace=False)
+            add_result("stream", nrows, seconds, rss)
+        else:
+            rss = get_peak_rss()
+            (plan, df), seconds, _ = measure(read, trace=False)
+            add_result("read", len(df), seconds, rss)
+
+            rss = get_peak_rss()
+            df, seconds, _ = measure(transform, plan, df, trace=False)
+            add_result("transform", len(df), seconds, rss)
+
+            rss = get_peak_rss()
+            _, seconds, _ = measure(load, df, trace=False)
+            add_result("load", len(df), seconds, rss)
+
+        rss = get_peak_rss()
+        nrows, seconds, _ = measure(query, trace=False)
+        add_result("query", nrows, seconds, rss)
+
+        excel.close_workbooks()
+
+    if backend == "duckdb":
+        ctx.close()
+    else:
+        ctx.dispose()
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[2000000],
+                        help="Rows in each synthetic workbook (one run per "
+                             "value)")
+    parser.add_argument("--stream-rows", type=int, default=None,
+                        help="Run the stages in chunks of this many rows")
+    parser.add_argument("--mode", default="replace",
+                        choices=["replace", "append", "merge", "swap"],
+                        help="Load mode for the load stage")
+    parser.add_argument("--backend", default="sqlite",
+                        choices=["sqlite", "duckdb"],
+                        help="Local database to load into")
+    parser.add_argument("--dtypes", action="store_true",
+                        help="Compare the transforms with and without compact "
+                             "dtypes instead")
+    args = parser.parse_args()
+
+    results = {
+        "commit": get_commit(),
+        "date": f"{dt.today():%Y-%m-%d %H:%M:%S}",
+        "stream_rows": args.stream_rows,
+        "mode": args.mode,
+        "backend": args.backend,
+        "results": []
+    }
+
+    for n_rows in args.rows:
+        if args.dtypes:
+            results["results"] += compare_dtypes(n_rows)
+        else:
+            results["results"] += run_stages(n_rows, args.stream_rows, 
+                                             args.mode, args.backend)
+
+    name = "benchmark_dtypes" if args.dtypes else "benchmark"
+    makedirs(paths.output_dir, exist_ok=True)
+    results_file = join(paths.output_dir,
+                        f"{name}_{dt.today():%Y%m%d_%H%M%S}.json")
+    with open(results_file, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {results_file}")
@@ -1,159 +1,759 @@
-import numpy as np
-import pandas as pd
-
+import argparse
+import json
 from calendar import month_name
 from datetime import datetime as dt
-from sqlalchemy import create_engine, MetaData, Table, text, insert
+from functools import lru_cache
 
-from dotenv import load_dotenv
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, 
+                                as_completed)
+from glob import glob
 from os import getenv
-from os import listdir
-from os.path import isfile, join
+from os import makedirs, replace
+from os.path import basename, dirname, isdir, isfile, join, splitext
+from queue import Empty, Queue
+import re
+import sys
+
+import utils.cache_util as cache
+from utils.import_util import lazy_import, load_lazy_modules
+import utils.path_util as paths
+import utils.scrape_util as scrape
+import utils.telemetry_util as telemetry
+
+#Heavy packages (and the modules that import them) are only imported when 
+#first used, so commands that don't need them (e.g. check) start quickly
+#(They are loaded on the main thread before any thread pool is started, see
+#import_util.load_lazy_modules)
+asyncio = lazy_import("asyncio")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+dotenv = lazy_import("dotenv")
+snowflake_connector = lazy_import("snowflake.connector")
+
+async_scrape = lazy_import("utils.async_scrape_util")
+db = lazy_import("utils.database_util")
+excel = lazy_import("utils.excel_util")
+pipeline = lazy_import("utils.pipeline_util")
+validation = lazy_import("utils.validation_util")
+
+#Target files in the publication
+#For each target publication (part of a page url), the target ids are the
+#parts of the file names to download
+publication = "cancer-survival-in-england"
+target_publications = {
+    "index":{"target_ids":["Index"]},
+    "cancers-diagnosed":{"target_ids":["adult"]}
+}
+
+#Find (exactly 1) file in the links of a page for each target id
+#Files are found by the start of their id (e.g. "Index" finds 
+#"Index_of_cancer_survival") using an index of the page's file ids
+#Returns a list of the file ids found
+def find_target_file_ids(publication, links, target_publication):
+    file_ids = []
+    file_index = scrape.build_prefix_index(links.keys())
+
+    for target_id in target_publication["target_ids"]:
+        found_file_ids = scrape.find_prefix(file_index, target_id)
+
+        if len(found_file_ids) == 1:
+            file_ids.append(found_file_ids[0])
+        elif len(found_file_ids) == 0:
+            print(f"Warning: No files were found for the {publication} publication.")
+        else:
+            print(f"Warning: Multiple files were found for the {publication} publication. These files won't be processed.")
+
+    return file_ids
+
+#Get the last part of a page's url (e.g. "/pub/index-2024" => "index-2024")
+def get_page_slug(page):
+    return page.rstrip("/").split("/")[-1]
+
+#Index the pages of a publication by target publication. A page belongs to
+#the first target publication its slug starts with.
+#Returns a dict of target publication: list of pages (in publication order)
+#(Kept for each list of pages so the pages are only indexed once per run)
+@lru_cache(maxsize=8)
+def index_target_pages(pages, targets):
+    slug_index = scrape.build_prefix_index(get_page_slug(page) 
+                                           for page in pages)
+    slug_positions = {}
+    for position, page in enumerate(pages):
+        slug_positions.setdefault(get_page_slug(page), []).append(position)
+
+    page_targets = {}
+    for target in targets:
+        for slug in scrape.find_prefix(slug_index, target):
+            for position in slug_positions[slug]:
+                page_targets.setdefault(position, target)
+
+    target_pages = {target: [] for target in targets}
+    for position in sorted(page_targets):
+        target_pages[page_targets[position]].append(pages[position])
+
+    return target_pages
+
+#Get the latest page for each target publication
+#Returns a list of (target publication, page) tuples
+def get_latest_target_pages(pages, target_publications):
+    target_pages = index_target_pages(tuple(pages), 
+                                      tuple(target_publications))
+
+    return [(target, target_pages[target][0]) 
+            for target in target_publications 
+            if target_pages[target]]
+
+#Download the target files from each of the target pages
+#target_pages is a list of (target publication, page) tuples. If page_dirs is
+#True, each page's files are saved in their own sub directory of data_dir.
+#If to_memory is True, the files are kept in memory (see get_data_in_memory)
+#Returns a list of the local paths of the target files (in page order)
+def download_target_files(target_pages, target_publications,
+                          data_dir=paths.data_dir, page_dirs=False, 
+                          to_memory=False, persist=True):
+
+    #Get all links in each page (fetched concurrently)
+    page_links = scrape.get_file_links_from_pages(
+        [page for _, page in target_pages])
+
+    downloads = []
 
-from snowflake.connector import connect
+    #For each page, get the target links
+    for (publication, page), links in zip(target_pages, page_links):
 
-import utils.database_util as db
-import utils.scrape_util as scrape
+        #For each target id, find (exactly 1) target file
+        file_ids = find_target_file_ids(publication, links, 
+                                        target_publications[publication])
+
+        #Files from different pages can share a name so each page can be 
+        #given its own directory (named after the page)
+        dest_dir = data_dir
+        if page_dirs:
+            dest_dir = join(data_dir, get_page_slug(page))
+        makedirs(dest_dir, exist_ok=True)
+
+        #Queue all found files to be saved to the data directory
+        for file_id in file_ids:
+            file_name = file_id + ".xlsx"
+            downloads.append((links, file_id, join(dest_dir, file_name)))
+
+    #Download the files (concurrently, streamed straight to disk)
+    results = scrape.download_files(downloads, to_memory=to_memory, 
+                                    persist=persist)
+
+    data_files = []
+    for (_, file_id, dest_file), result in zip(downloads, results):
+        #Report files that are unchanged (failures are reported by scrape_util)
+        if result is None:
+            print(f"{file_id}.xlsx is unchanged since the last download.")
+            data_files.append(dest_file)
+
+        #(Large files kept in memory may be saved to a temporary path)
+        elif result:
+            data_files.append(result)
+
+    return data_files
 
 #Scrape and download the latest data files from the NHSD site
+#If pages is given (from get_nhsd_pages), the publication is not requested again
+#Returns a list of the local paths of the data files
 def scrape_latest_data(
-        publication="cancer-survival-in-england",
-        target_publications = {
-            "index":{"target_ids":["Index"]},
-            "cancers-diagnosed":{"target_ids":["adult"]}
-        }
+        publication=publication,
+        target_publications=target_publications,
+        pages=None,
+        to_memory=False,
+        persist=True
         ):
     
     #Get all pages from the publication
-    pages = scrape.get_nhsd_pages(publication)
+    if pages is None:
+        pages = scrape.get_nhsd_pages(publication)
 
     #Get target_pages
-    target_pages = []
-
-    #For each target publication, get the page containing 
-    for target in target_publications.keys():
-        for page in pages:
-            if target in page:
-                target_pages.append((target, page))
-                break
-
+    target_pages = get_latest_target_pages(pages, target_publications)
 
-    #For each page, get the target links
-    for publication, page in target_pages:
-        #Get all links in the page
-        links = scrape.get_file_links_from_page(page)
-
-        #Get the target information
-        target_publication = target_publications[publication]
+    return download_target_files(target_pages, target_publications,
+                                 to_memory=to_memory, persist=persist)
 
-        file_ids = []
+#The manifest records what was loaded by the last successful run: the latest
+#page of the publication, the target pages, the url, hash, ETag and 
+#Last-Modified of each data file and the date of the snapshot. If the 
+#publication still has the same pages and the files are unchanged, there is 
+#nothing new to load.
+manifest_file = join(paths.data_dir, "manifest.json")
 
-        #For each target id, find (exactly 1) target file
-        for target_id in target_publication["target_ids"]:
-            found_file_ids = []
-            for link in links.keys():
-                if target_id in link:
-                    found_file_ids.append(link)
-
-            if len(found_file_ids) == 1:
-                file_ids.append(found_file_ids[0])
-            elif len(found_file_ids) == 0:
-                print(f"Warning: No files were found for the {publication} publication.")
-            else:
-                print(f"Warning: Multiple files were found for the {publication} publication. These files won't be processed.")
+#Load the manifest (an empty dict if there isn't one)
+def load_manifest(manifest_file=manifest_file):
+    try:
+        with open(manifest_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+#Write the manifest
+def save_manifest(manifest, manifest_file=manifest_file):
+    makedirs(dirname(manifest_file), exist_ok=True)
+    with open(manifest_file + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    replace(manifest_file + ".tmp", manifest_file)
+
+def build_manifest(pages, data_files, 
+                   target_publications=target_publications):
+
+    """
+    Function to build the manifest of a successful run.
+
+    inputs:
+    - pages: List of the pages of the publication (from get_nhsd_pages)
+    - data_files: List of paths of the data files that were loaded
+    - target_publications: Dict of the target publications
+
+    output:
+    Returns the manifest dict
+    """
+
+    #Get the url of each data file from the links of its page (kept in the
+    #scrape cache when the files were downloaded, so the pages are only 
+    #requested again if they aren't cached)
+    target_pages = get_latest_target_pages(pages, target_publications)
+    page_links = []
+    for _, page in target_pages:
+        links = scrape.get_cached_file_links(page)
+        if links is None:
+            links = scrape.get_file_links_from_page(page)
+        page_links.append(links)
+
+    file_urls = {}
+    for (target, _), links in zip(target_pages, page_links):
+        for file_id in find_target_file_ids(target, links, 
+                                            target_publications[target]):
+            file_urls[file_id] = links[file_id]["url"]
+
+    scrape_cache = scrape.load_scrape_cache()
+    files = {}
+    date_snapshot = None
+    for data_file in data_files:
+        file_id = splitext(basename(data_file))[0]
+        url = file_urls.get(file_id)
+        entry = scrape_cache.get(url, {})
+        files[file_id] = {"url": url,
+                          "data_file": data_file,
+                          "sha256": cache.file_hash(data_file),
+                          "etag": entry.get("etag"),
+                          "last_modified": entry.get("last_modified")}
+
+        if file_id.startswith("adult"):
+            try:
+                date_snapshot = get_snapshot_date_from_adult(data_file)
+            except snapshot_errors as e:
+                print("    -> ", 
+                      "Warning: Unable to extract the snapshot date for the",
+                      f"manifest from {basename(data_file)} ({e}).")
+
+    return {
+        "latest_page": pages[0],
+        "target_pages": [list(target_page) for target_page in target_pages],
+        "files": files,
+        "date_snapshot": date_snapshot,
+        "loaded": f"{dt.today():%Y-%m-%d %H:%M:%S}"
+    }
 
-        #Save all found files to the data directory
-        for file_id in file_ids:
-            content = scrape.download_file_from_id(links, file_id)
+#Check if the publication is unchanged since the manifest was written
+#(the same latest page and target pages, and the same data files)
+#If in_memory is True (see get_data_in_memory) the data files have no local
+#copy, so each file is unchanged if the version last downloaded (its ETag, 
+#Last-Modified and hash in the scrape cache) is the version that was loaded
+def is_publication_unchanged(manifest, pages, 
+                             target_publications=target_publications,
+                             in_memory=False):
+    if not manifest or not pages:
+        return False
+
+    target_pages = get_latest_target_pages(pages, target_publications)
+    if (manifest.get("latest_page") != pages[0] or
+        manifest.get("target_pages") != [list(page) for page in target_pages]):
+        return False
+
+    scrape_cache = scrape.load_scrape_cache()
+    for file in manifest.get("files", {}).values():
+        if in_memory:
+            entry = scrape_cache.get(file.get("url"), {})
+            if not entry or any(entry.get(key) != file.get(key) 
+                                for key in ["sha256", "etag", "last_modified"]):
+                return False
+        elif (not isfile(file["data_file"]) or 
+              cache.file_hash(file["data_file"]) != file["sha256"]):
+            return False
+
+    return True
+
+#Get the pages of the publication and check if it is unchanged since the
+#last successful run. Returns a tuple of the pages and the result of the check
+def check_publication():
+    pages = scrape.get_nhsd_pages(publication)
+    return pages, is_publication_unchanged(load_manifest(), pages, 
+                                           in_memory=get_data_in_memory())
+
+#Check if new data files have been published since the last download
+#(without downloading them). A file is new if its url has not been downloaded
+#before or the local copy is missing (files kept in memory have no local copy,
+#see get_data_in_memory).
+#Returns a list of the new file ids
+def check_for_new_data(
+        publication=publication,
+        target_publications=target_publications,
+        data_dir=paths.data_dir
+        ):
 
-            file_name = file_id + ".xlsx"
+    pages = scrape.get_nhsd_pages(publication)
+    in_memory = get_data_in_memory()
+
+    #Nothing has changed since the last successful run
+    if is_publication_unchanged(load_manifest(), pages, target_publications,
+                                in_memory=in_memory):
+        return []
+
+    target_pages = get_latest_target_pages(pages, target_publications)
+    page_links = scrape.get_file_links_from_pages(
+        [page for _, page in target_pages])
+
+    scrape_cache = scrape.load_scrape_cache()
+    new_file_ids = []
+    for (target, _), links in zip(target_pages, page_links):
+        for file_id in find_target_file_ids(target, links, 
+                                            target_publications[target]):
+            local_file = join(data_dir, file_id + ".xlsx")
+            if (links[file_id]["url"] not in scrape_cache
+                or not (in_memory or isfile(local_file))):
+                new_file_ids.append(file_id)
+
+    return new_file_ids
+
+#Scrape and download the data files from every (current and past) page of the
+#publication. Files are saved to a sub directory of data_dir for each page.
+def scrape_all_data(
+        publication=publication,
+        target_publications=target_publications,
+        data_dir=join(paths.data_dir, "backfill")
+        ):
+    
+    #Get all pages from the publication (latest first)
+    pages = scrape.get_nhsd_pages(publication)
 
-            scrape.save_file(content, file_name)
+    #Get every page for each target publication (in page order)
+    page_targets = {
+        page: target 
+        for target, target_pages in index_target_pages(
+            tuple(pages), tuple(target_publications)).items()
+        for page in target_pages
+    }
+    target_pages = [(page_targets[page], page) for page in pages 
+                    if page in page_targets]
+
+    data_files = download_target_files(target_pages, target_publications,
+                                       data_dir=data_dir, page_dirs=True)
+
+    #Record the page order so the files can be ordered without scraping
+    save_manifest([get_page_slug(page) for _, page in target_pages],
+                  join(data_dir, backfill_pages_file))
+
+    return data_files
+
+#Name of the file (in the backfill directory) listing the page directories in
+#publication order (newest first)
+backfill_pages_file = "pages.json"
+
+#Get the year a page was published from the latest year in its name
+#(e.g. cancers-diagnosed-2017-to-2021-followed-up-to-2022 is from 2022)
+#Returns 0 if the name has no year
+def get_page_year(page_dir):
+    years = re.findall(r"(?<!\d)(?:19|20)\d{2}(?!\d)", page_dir)
+    return max(map(int, years), default=0)
+
+#Get the downloaded backfill files in publication order (newest first) 
+#without scraping. The page order saved by scrape_all_data is used, and any
+#pages not in it are ordered by the year in their name (newest first)
+def get_backfill_files(data_dir=join(paths.data_dir, "backfill")):
+    page_order = load_manifest(join(data_dir, backfill_pages_file))
+    if not isinstance(page_order, list):
+        page_order = []
+
+    page_dirs = sorted(
+        (page_dir for page_dir in glob("*", root_dir=data_dir) 
+         if isdir(join(data_dir, page_dir))),
+        key=lambda page_dir: (
+            (0, page_order.index(page_dir), 0) if page_dir in page_order 
+            else (1, -get_page_year(page_dir), page_dir)))
+
+    return [data_file for page_dir in page_dirs
+            for data_file in sorted(glob(join(data_dir, page_dir, "*.xlsx")))]
 
 #Function to parse the date of the sanpshot from the data file
 #This works by checking the first line of the "Methdology" column in the 
 #"Notes and definitions" sheet and looking for the Month and Year the represents
 #the snapshot of when the data was captured. If the function is unable to do
-#this, it throws an error on the assumption it will be caught.
+#this, it throws an error on the assumption it will be caught (one of the 
+#snapshot_errors below).
 def get_snapshot_date_from_adult(data_file):
 
     to_skip = 10 #How many lines in the excel before the tabular data begins
-    df = pd.read_excel(data_file, sheet_name="Notes and definitions", 
-                       skiprows=to_skip)
+    df = excel.read_sheet(data_file, "Notes and definitions", 
+                          skiprows=to_skip, nrows=1)
     
     target_line = df.iloc[0,0]
     month_year = target_line.split(" ")[-3:-1]
 
-    #Check if valid month
-    if month_name[0] not in month_name:
-        raise Exception()
+    #Check if valid month (month_name[0] is an empty string)
+    if len(month_year) != 2 or month_year[0] not in month_name[1:]:
+        raise ValueError(f"No snapshot month found in: {target_line}")
     
     #Check if valid year
     if int(month_year[1]) < 2000 or int(month_year[1]) > 2100:
-        raise Exception() 
+        raise ValueError(f"No snapshot year found in: {target_line}")
 
     return " ".join(month_year)
 
+#Errors raised by get_snapshot_date_from_adult when the snapshot date can't be
+#found (a missing sheet is a KeyError and a blank line an AttributeError)
+snapshot_errors = (ValueError, IndexError, KeyError, AttributeError)
+
+#If True, text columns are read as categoricals and integer columns are
+#downcast to reduce memory use (and string operations run once per category)
+compact_dtypes = True
+
+#Columns read as categoricals for each sheet (if compact_dtypes is True)
+index_categories = [
+    "Geography type",
+    "Geography code",
+    "Geography name",
+    "Cancer site",
+    "Gender",
+    "Age at diagnosis",
+    "Standardisation type"
+]
+
+adult4_categories = [
+    "Geography type",
+    "Geography code",
+    "Geography name",
+    "Cancer site",
+    "Gender",
+    "Standardisation type"
+]
+
+#Apply a string operation (func) to a column. For categorical columns the
+#operation is applied once per category instead of once per row.
+def map_categories(s, func):
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return func(s)
+
+    categories = s.cat.categories
+    mapped = func(pd.Series(categories, index=categories))
+
+    return s.map(mapped).astype("category")
+
 #Create a Persons gender copy of gender exclusive data
-def generalise_gender(df, cancer_site, base_gender):
+#site_genders maps each cancer site to the gender its data is recorded under
+#(e.g. {"Prostate": "Male"}) so every site is handled in one selection and one
+#concat. If where is given, only the rows where it is True are generalised.
+#If keep_base is False, the rows are relabelled as Persons instead of copied.
+def generalise_gender(df, site_genders, where=None, keep_base=True):
+    #Select the rows recorded under the base gender of their site
+    gendered = df["Gender"] == df["Cancer site"].map(site_genders)
+    if where is not None:
+        gendered &= where
+
+    #Persons must be a category before it can be set in a categorical column
+    gender = df["Gender"]
+    if (isinstance(gender.dtype, pd.CategoricalDtype) 
+        and "Persons" not in gender.cat.categories):
+        df["Gender"] = gender.cat.add_categories("Persons")
+
+    if not keep_base:
+        df["Gender"] = df["Gender"].mask(gendered, "Persons")
+        return df
+
     #Populate extra Persons rows
-    df_gendered = df[(df["Cancer site"] == cancer_site) 
-                                 & (df["Gender"] == base_gender)].copy()
-    df_gendered["Gender"] = "Persons"
+    df_gendered = df[gendered].copy()
+    df_gendered.loc[:, "Gender"] = "Persons"
     df = pd.concat([df, df_gendered])
 
     return df
 
-#Function for processing the index data
-def process_index_data(ctx, data_file, target_geographies):
-
-    #Extract data###############################################################
-
-    to_skip = 10    #How many lines in the excel before the tabular data begins
-    df_index = pd.read_excel(data_file, sheet_name="Table 5", skiprows=to_skip)
-
-    #Transform data#############################################################
-
-    #NOTE: Some data does not make sense and could be filtered out
-    # (i.e 10 years since diagnosis in 2020)
-
-    #Filter to remove sub ICBs
-    df_index = df_index[(
-        (df_index["Geography type"] == "Cancer Alliance") | 
-        (df_index["Geography code"].isin(target_geographies))
-    )]
+#Build the full name of a destination table from the environment variables
+def get_destination(destination_env):
+    database = getenv("DATABASE") 
+    schema = getenv("SCHEMA")
+    destination_table = getenv(destination_env)
+
+    return f"{database}.{schema}.{destination_table}"
+
+#How to load the tables, "replace" (truncate and reload), "merge" (only 
+#insert new rows and update changed rows) or "swap" (load into a shadow table
+#and swap it in, so readers never see an empty table)
+def get_load_mode():
+    return getenv("LOAD_MODE", "replace")
+
+#How to write the data to Snowflake, "write_pandas" or "copy" (bulk load 
+#Parquet files with PUT and COPY INTO, using less memory for large uploads)
+def get_loader():
+    return getenv("LOADER", "write_pandas")
+
+#Number of rows to read, transform and upload at a time (set STREAM_ROWS to
+#stream each sheet in chunks so memory use doesn't grow with the workbook)
+#Returns None (read each sheet in one go) if not set
+def get_stream_rows():
+    stream_rows = getenv("STREAM_ROWS")
+    return int(stream_rows) if stream_rows else None
+
+#Columns that identify a unique row in each destination table
+index_key_cols = [
+    "AREA_CODE",
+    "CANCER_SITE",
+    "GENDER",
+    "AGE_AT_DIAGNOSIS",
+    "STANDARDISATION_TYPE",
+    "YEAR_OF_DIAGNOSIS",
+    "YEARS_SINCE_DIAGNOSIS"
+]
+
+adult4_key_cols = [
+    "AREA_CODE",
+    "CANCER_SITE",
+    "GENDER",
+    "STANDARDISATION_TYPE",
+    "STANDARDISATION_TYPE_SUBCATEGORY",
+    "YEARS_SINCE_DIAGNOSIS",
+    "DATE_DIAGNOSIS_WINDOW",
+    "SURVIVAL_METRIC"
+]
+
+key_cols = {
+    "DESTINATION_INDEX": index_key_cols,
+    "DESTINATION_ADULT4": adult4_key_cols
+}
+
+#Columns that scope the rows of each destination table replaced by a merge
+#(see database_util.merge_df). An adult file only holds its own diagnosis
+#window, so rows of other windows are kept, while the index file holds every
+#row. The benchmarking tables aren't scoped (rows are never deleted)
+merge_scope_cols = {
+    "DESTINATION_INDEX": [],
+    "DESTINATION_ADULT4": ["DATE_DIAGNOSIS_WINDOW"]
+}
+
+#Steps shared by the transform pipelines########################################
+
+#Get a lookup table for a workbook. It is built the first time it is needed
+#and kept in the context, so every step (and every chunk when streaming) 
+#shares it instead of rebuilding it
+def get_lookup(context, name, build):
+    lookups = context.setdefault("lookups", {})
+    if name not in lookups:
+        lookups[name] = build(context)
+
+    return lookups[name]
+
+#Lookup of the core area codes
+def build_core_areas(context):
+    return frozenset(context["target_geographies"])
+
+#Filter to mark the core areas (NCL, London, England)
+def mark_core_areas(df, context):
+    core_areas = get_lookup(context, "core_areas", build_core_areas)
+    df["area_core"] = df["Geography code"].isin(core_areas)
+    return df
 
-    #Filter to select geographies
-    df_index["area_core"] = df_index["Geography code"].isin(target_geographies)
+#Filter to remove sub ICBs (keeping the core areas and Cancer Alliances)
+#This is pushed down to read time so the other rows are never stored
+def get_geography_filter(context):
+    return {"Geography type": ["Cancer Alliance"],
+            "Geography code": get_lookup(context, "core_areas", 
+                                         build_core_areas)}
 
-    #Derive data_substituion
-    df_index["data_substituted"] = np.where(
-        df_index["Substituted by Other Geography"].isnull(), False, True)
+#Stamp data with timestamp
+def stamp_upload_date(df, context):
+    df["date_upload"] = dt.today()
+    return df
 
-    #Stamp data with timestamp
-    df_index["date_upload"] = dt.today()
+#Geography sets (batch mode)####################################################
+#Set GEOGRAPHY_SETS to produce the tables for several alliances from a single
+#parse of each workbook. It is a JSON object (or the path of a JSON file) of 
+#set name: list of core area codes, with the set's Cancer Alliance first (the
+#area ranked in the benchmarking rank), e.g.
+#   {"NCL": ["E56000027", "E40000003", "E92000001"],
+#    "NEL": ["E56000028", "E40000003", "E92000001"]}
+#The workbooks are read for the core areas of every set, then each set's rows
+#(the Cancer Alliances and its core areas, with its own IS_AREA_CORE flags) 
+#are split out in one pass. GEOGRAPHY_SET_OUTPUT sets where they are loaded:
+# - "tables" (default): A table for each set, named after the destination 
+#   with the set name as a suffix (e.g. ADULT_4_NCL)
+# - "partitioned": The destination table, with the set name in GEOGRAPHY_SET
+
+#Get the geography sets (None if not in batch mode)
+def get_geography_sets():
+    geography_sets = getenv("GEOGRAPHY_SETS")
+    if not geography_sets:
+        return None
+
+    if isfile(geography_sets):
+        with open(geography_sets) as file:
+            return json.load(file)
+
+    return json.loads(geography_sets)
+
+def get_geography_set_output():
+    return getenv("GEOGRAPHY_SET_OUTPUT", "tables")
+
+#Get the key columns of an output table (the geography set is part of the key
+#in batch mode)
+def get_output_key_cols(table_key_cols):
+    if get_geography_sets():
+        return table_key_cols + ["GEOGRAPHY_SET"]
+    return table_key_cols
+
+#Get the data quality checks for a table: its checks plus the key columns
+#(which must be unique) and the core areas (which must all be in the data)
+def get_checks(checks, table_key_cols, context):
+    return {**checks, 
+            "key_cols": get_output_key_cols(table_key_cols),
+            "coverage": {"AREA_CODE": context["target_geographies"]}}
+
+#Split the rows into the geography sets, marking the core areas of each set
+#The membership of every set is worked out at once (a sets x rows matrix) and
+#the rows of each set are taken in one go, so the output is the rows of the 
+#first set, then the second set etc.
+def split_geography_sets(df, context):
+    geography_sets = context["geography_sets"]
+
+    is_core = np.array([df["Geography code"].isin(codes).to_numpy() 
+                        for codes in geography_sets.values()], dtype=bool)
+    is_ca = (df["Geography type"] == "Cancer Alliance").to_numpy()
+    set_positions, row_positions = np.nonzero(is_core | is_ca)
+
+    df = df.iloc[row_positions].copy()
+    df["area_core"] = is_core[set_positions, row_positions]
+    df["geography_set"] = pd.Categorical.from_codes(set_positions, 
+                                                    list(geography_sets))
+    return df
 
-    #Populate extra Persons rows for the breast data
-    df_dupe = df_index[(df_index["Cancer site"] == "Breast") 
-                       & (df_index["Gender"] == "Female")
-                       & (df_index["Age at diagnosis"] == "All ages")].copy()
-    df_dupe["Gender"] = "Persons"
-    df_index = pd.concat([df_index, df_dupe])
+#Get the batch version of a pipeline spec, where the core areas are marked as
+#the rows are split into the geography sets (after the other steps, so they
+#only run once for each row)
+def get_batch_pipeline(spec):
+    steps = [step for step in spec["steps"] 
+             if step["func"] is not mark_core_areas]
+    steps.append({"func": split_geography_sets, 
+                  "uses": ["Geography code", "Geography type"],
+                  "adds": ["area_core", "geography_set"]})
+
+    return {**spec, 
+            "steps": steps, 
+            "keep": spec["keep"] + ["geography_set"],
+            "rename": {**spec["rename"], "geography_set": "GEOGRAPHY_SET"}}
+
+#Get the pipeline spec and context to transform a data file
+#In batch mode the geography sets replace target_geographies
+def get_pipeline_context(spec, data_file, target_geographies):
+    context = {"data_file": data_file, 
+               "target_geographies": target_geographies}
+
+    geography_sets = get_geography_sets()
+    if geography_sets:
+        context["geography_sets"] = geography_sets
+        context["target_geographies"] = list(dict.fromkeys(
+            code for codes in geography_sets.values() for code in codes))
+        spec = get_batch_pipeline(spec)
+
+    return spec, context
+
+#Upload a table to the destination (or, in batch mode, the destinations of
+#each geography set)
+#df is a dataframe or a list (or generator) of dataframes (see db.upload_df)
+#Returns Boolean value if the uploads were successful
+def upload_output(ctx, df, destination_env, table_key_cols):
+    destination = get_destination(destination_env)
+    scope_cols = merge_scope_cols.get(destination_env)
+    upload_args = {"mode": get_load_mode(), "loader": get_loader()}
+
+    geography_sets = get_geography_sets()
+    if not geography_sets:
+        return db.upload_df(ctx, df, destination, key_cols=table_key_cols, 
+                            scope_cols=scope_cols, **upload_args)
+
+    output = get_geography_set_output()
+    if output == "partitioned":
+        #Each set only replaces its own rows
+        if scope_cols is not None:
+            scope_cols = scope_cols + ["GEOGRAPHY_SET"]
+        return db.upload_df(ctx, df, destination, 
+                            key_cols=get_output_key_cols(table_key_cols),
+                            scope_cols=scope_cols, **upload_args)
+
+    if output != "tables":
+        raise ValueError(f"Unknown GEOGRAPHY_SET_OUTPUT: {output}")
+
+    #Each set goes to its own table so streamed chunks are collected first
+    if not isinstance(df, pd.DataFrame):
+        print("    -> ", 
+              "Warning: Streamed data is collected before it is split into",
+              "the geography set tables (use GEOGRAPHY_SET_OUTPUT=partitioned",
+              "to stream it).")
+        df = pd.concat(df, ignore_index=True)
+
+    success = True
+    for name in geography_sets:
+        df_set = df[df["GEOGRAPHY_SET"] == name].drop(columns="GEOGRAPHY_SET")
+        success &= db.upload_df(ctx, df_set, f"{destination}_{name.upper()}",
+                                key_cols=table_key_cols, scope_cols=scope_cols,
+                                **upload_args)
+
+    return success
+
+#Steps for the index data#######################################################
+
+#Derive data_substituion
+def mark_substituted_data(df, context):
+    df["data_substituted"] = np.where(
+        df["Substituted by Other Geography"].isnull(), False, True)
+    return df
 
-    #Remove the now generalised breast data
-    df_index = df_index[~((df_index["Cancer site"] == "Breast") 
-                       & (df_index["Gender"] == "Female")
-                       & (df_index["Age at diagnosis"] == "All ages"))]
+#Relabel the (all ages) breast data as Persons
+def relabel_breast_index(df, context):
+    return generalise_gender(
+        df, {"Breast": "Female"}, 
+        where=(df["Age at diagnosis"] == "All ages"), keep_base=False)
 
-    #Rename the index site to overall for clarity
-    df_index["Cancer site"] = (
-        df_index["Cancer site"].str.replace('Index', 'Overall'))
-    
-    #Remove "Other" site from the data
-    df_index = df_index[~(df_index["Cancer site"] == "Other")]
+#Rename the index site to overall for clarity
+def rename_index_site(df, context):
+    df["Cancer site"] = map_categories(
+        df["Cancer site"], lambda s: s.str.replace('Index', 'Overall'))
+    return df
 
-    #Remove Unused Columns
-    columns_to_keep = [
+#Remove "Other" site from the data
+def remove_other_site(df, context):
+    return df[~(df["Cancer site"] == "Other")]
+
+#NOTE: Some data does not make sense and could be filtered out
+# (i.e 10 years since diagnosis in 2020)
+index_pipeline = {
+    "sheet_name": "Table 5",
+    "skiprows": 10, #How many lines in the excel before the tabular data begins
+    "categories": index_categories,
+    "row_filter": get_geography_filter,
+    "steps": [
+        {"func": mark_core_areas, 
+         "uses": ["Geography code"], "adds": ["area_core"]},
+        {"func": mark_substituted_data, 
+         "uses": ["Substituted by Other Geography"], 
+         "adds": ["data_substituted"]},
+        {"func": stamp_upload_date, "adds": ["date_upload"]},
+        {"func": relabel_breast_index, 
+         "uses": ["Cancer site", "Gender", "Age at diagnosis"]},
+        {"func": rename_index_site, "uses": ["Cancer site"]},
+        {"func": remove_other_site, "uses": ["Cancer site"]}
+    ],
+    "keep": [
         "Geography name",
         "Geography code",
         "area_core",
@@ -170,27 +770,14 @@ def process_index_data(ctx, data_file, target_geographies):
         "Precision",
         "Standard error",
         "data_substituted",
-        "date_upload"]
-    
-    df_index = df_index[columns_to_keep]
-
-    #Rename columns
-    column_map = {
+        "date_upload"
+    ],
+    "column_map": {
         "Geography name": "Area name",
         "Geography code": "Area code",
         "Survival (%)": "survival_per"
-    }
-
-    df_index = df_index.rename(columns=column_map)
-
-    #Format column names
-    df_index.columns = df_index.columns.str.replace('\n', ' ', regex=False)
-    df_index.columns = df_index.columns.str.strip().str.replace(' ', '_')
-    df_index.columns = df_index.columns.str.lower()
-
-    #Load data##################################################################
-
-    rename_index = {
+    },
+    "rename": {
         "area_code": "AREA_CODE",
         "area_name": "AREA_NAME",
         "area_core": "IS_AREA_CORE",
@@ -208,95 +795,135 @@ def process_index_data(ctx, data_file, target_geographies):
         "standard_error": "STANDARD_ERROR",
         "data_substituted": "IS_DATA_SUBTITUTED"
     }
+}
+
+#Data quality checks run on the index data before it is uploaded (see
+#validation_util.py). The keys and geography coverage are added by get_checks
+index_checks = {
+    "columns": list(index_pipeline["rename"].values()),
+    "bounds": [("LOWER_CI", "SURVIVAL_PERCENT", "UPPER_CI")],
+    "ranges": {
+        "SURVIVAL_PERCENT": (0, 100),
+        "LOWER_CI": (0, 100),
+        "UPPER_CI": (0, 100),
+        "PATIENT_NUMBERS": (0, None),
+        "YEARS_SINCE_DIAGNOSIS": (0, None)
+    }
+}
 
-    df_index = df_index[rename_index.keys()].rename(columns=rename_index)
-
-    database = getenv("DATABASE") 
-    schema = getenv("SCHEMA")
-    destination_table = getenv("DESTINATION_INDEX")
-    destination = f"{database}.{schema}.{destination_table}"
-
-    db.upload_df(ctx, df_index, destination, replace=True)
+#Function for transforming the index data
+def transform_index_data(data_file, target_geographies):
 
-#Function for processing the adult cancer survival (Table 4) data
-def process_adult_data_sheet4(ctx, data_file, target_geographies=[]):
-    
-    #Extract data###############################################################
+    spec, context = get_pipeline_context(index_pipeline, data_file, 
+                                         target_geographies)
 
-    to_skip = 9 #How many lines in the excel before the tabular data begins
-    df_adult4 = pd.read_excel(data_file, sheet_name="Table 4", skiprows=to_skip)
+    df = pipeline.run_pipeline(spec, data_file, context,
+                               compact_dtypes=compact_dtypes)
 
-    #Transform data#############################################################
+    return validation.validate_frame(
+        df, get_checks(index_checks, index_key_cols, context), 
+        basename(data_file))
 
-    #NOTE: This process will leave non-age standardised and overall survival
-    # data in for non-NCL areas. This needs to be filtered out in the frontend
+#Function for processing the index data
+def process_index_data(ctx, data_file, target_geographies):
 
-    #Filter to mark the core areas (NCL, London, England)
-    df_adult4["area_core"] = (
-        df_adult4["Geography code"].isin(target_geographies))
-    
-    #Filter out data that is not core or a Cancer Alliance
-    df_adult4 = df_adult4[(
-            (df_adult4["area_core"] == True) | 
-            (df_adult4["Geography type"] == "Cancer Alliance")
-    )]
-
-    #Move the subcategory of the standardisation to its own column
-    std = df_adult4["Standardisation type"]
-    #    Get all values in the column that are standardised
-    df_adult4["standardisation_type_subcategory"] = (
-        std.where(std != "Non-standardised"))
-    
-    #    Remove everything except what is between the brackets
-    #    e.g. "Age-standardised (5 age groups)" => "5 age groups"
-    std_sc = df_adult4["standardisation_type_subcategory"]
-    std_sc = std_sc.str.split("(").str[1]
-    std_sc = std_sc.str.split(")").str[0]
-    df_adult4["standardisation_type_subcategory"] = std_sc
+    with telemetry.stage("process", data_file=data_file, 
+                         destination_env="DESTINATION_INDEX"):
+        stream_rows = get_stream_rows()
+        if stream_rows:
+            spec, context = get_pipeline_context(index_pipeline, data_file, 
+                                                 target_geographies)
+            df_index = pipeline.iter_pipeline(spec, data_file, context, 
+                                              chunk_rows=stream_rows,
+                                              compact_dtypes=compact_dtypes)
+            df_index = validation.validate_chunks(
+                df_index, get_checks(index_checks, index_key_cols, context),
+                basename(data_file))
+        else:
+            df_index = transform_index_data(data_file, target_geographies)
+
+        return upload_output(ctx, df_index, "DESTINATION_INDEX", 
+                             index_key_cols)
+
+#Steps for the adult cancer survival (Table 4) data#############################
+
+#Move the subcategory of the standardisation to its own column
+def split_standardisation_type(df, context):
+    def get_std_subcategory(std):
+        #Get all values in the column that are standardised
+        std_sc = std.where(std != "Non-standardised")
+
+        #Remove everything except what is between the brackets
+        #e.g. "Age-standardised (5 age groups)" => "5 age groups"
+        std_sc = std_sc.str.split("(").str[1]
+        std_sc = std_sc.str.split(")").str[0]
+        return std_sc
+
+    std = df["Standardisation type"]
+    df["standardisation_type_subcategory"] = map_categories(
+        std, get_std_subcategory)
 
     #Remove the subcategory from the original standardisation type column
-    std = std.str.split("(").str[0]
-    std = std.str.strip()
-    df_adult4["Standardisation type"] = std
-
-    #Stamp data with timestamp
-    df_adult4["date_upload"] = dt.today()
+    df["Standardisation type"] = map_categories(
+        std, lambda s: s.str.split("(").str[0].str.strip())
+    return df
 
-    #Stamp data with the window of diagnosis (in the filename)
-    diagnosis_window_years = data_file.split(".")[-2].split("_")[-2:]
-    df_adult4["date_diagnosis_window"] = "-".join(diagnosis_window_years)
+#Stamp data with the window of diagnosis (in the filename)
+def stamp_diagnosis_window(df, context):
+    diagnosis_window_years = (
+        context["data_file"].split(".")[-2].split("_")[-2:])
+    df["date_diagnosis_window"] = "-".join(diagnosis_window_years)
+    return df
 
-    #Stamp data with the date of the snapshot (if possible)
+#Stamp data with the date of the snapshot (if possible)
+def stamp_snapshot_date(df, context):
     try:
-        date_snapshot = get_snapshot_date_from_adult(data_file)
+        date_snapshot = get_snapshot_date_from_adult(context["data_file"])
     except:
         print("    -> ", 
               "Warning: Unable to extract the snapshot date from the data.")
         date_snapshot = None
         
-    df_adult4["date_snapshot"] = date_snapshot
-
-    #Populate extra Persons rows for breast
-    #(This data is only missing for the national figures in the adult data)
-    df_breast_persons = df_adult4[(
-        (df_adult4["Cancer site"] == "Breast") &
-        (df_adult4["Gender"] == "Female") &
-        (df_adult4["Geography code"] == "E92000001")
-    )].copy()
-    df_breast_persons["Gender"] = "Persons"
-    df_adult4 = pd.concat([df_adult4, df_breast_persons])
-
-    male_sites = ["Larynx", "Prostate"]
-    female_sites = ["Cervix", "Ovary"]
-
-    for male_site in male_sites:
-        df_adult4 = generalise_gender(df_adult4, male_site, "Male")
+    df["date_snapshot"] = date_snapshot
+    return df
 
-    for female_site in female_sites:
-        df_adult4 = generalise_gender(df_adult4, female_site, "Female")
+#Populate extra Persons rows for gender exclusive sites and breast
+#(Breast data is only missing for the national figures in the adult data)
+def generalise_adult_gender(df, context):
+    site_genders = {
+        "Breast": "Female",
+        "Larynx": "Male",
+        "Prostate": "Male",
+        "Cervix": "Female",
+        "Ovary": "Female"
+    }
 
-    #List of id columns (not related to the metric value) to keep
-    id_cols = [
+    return generalise_gender(
+        df, site_genders,
+        where=((df["Cancer site"] != "Breast") |
+               (df["Geography code"] == "E92000001")))
+
+#NOTE: This process will leave non-age standardised and overall survival
+# data in for non-NCL areas. This needs to be filtered out in the frontend
+adult4_pipeline = {
+    "sheet_name": "Table 4",
+    "skiprows": 9, #How many lines in the excel before the tabular data begins
+    "categories": adult4_categories,
+    "row_filter": get_geography_filter,
+    "steps": [
+        {"func": mark_core_areas, 
+         "uses": ["Geography code"], "adds": ["area_core"]},
+        {"func": split_standardisation_type, 
+         "uses": ["Standardisation type"], 
+         "adds": ["standardisation_type_subcategory"]},
+        {"func": stamp_upload_date, "adds": ["date_upload"]},
+        {"func": stamp_diagnosis_window, "adds": ["date_diagnosis_window"]},
+        {"func": stamp_snapshot_date, "adds": ["date_snapshot"]},
+        {"func": generalise_adult_gender, 
+         "uses": ["Cancer site", "Gender", "Geography code"]}
+    ],
+    #Id columns (not related to the metric value) and the unpivoted metric
+    "keep": [
         "Geography type",
         "Geography name",
         "Geography code",
@@ -309,47 +936,28 @@ def process_adult_data_sheet4(ctx, data_file, target_geographies=[]):
         "area_core",
         "date_upload",
         "date_diagnosis_window",
-        "date_snapshot"]
-    
-    # List of metric value columns
-    value_cols = [
-        "Net survival (%)",
-        "Overall survival (%)"
-    ]
-    
-    #Remove unused columns
-    df_adult4 = df_adult4[id_cols + value_cols]
-
-    #Unpivot the data around the survival metrics
-    df_adult4 = pd.melt(df_adult4, 
-                        id_vars=id_cols,
-                        var_name="survival_metric",
-                        value_name="survival_per")
-    
-    #Format metric names to remove the (%) suffix and capitalise the words
-    df_adult4["survival_metric"] = (
-        df_adult4["survival_metric"].str.removesuffix(" (%)"))
-    
-    df_adult4["survival_metric"] = df_adult4["survival_metric"].str.title()
-
-    #Rename columns
-    column_map = {
+        "date_snapshot",
+        "survival_metric",
+        "survival_per"
+    ],
+    #Unpivot the data around the survival metrics, formatting the metric 
+    #names to remove the (%) suffix and capitalise the words
+    "unpivot": {
+        "value_cols": [
+            "Net survival (%)",
+            "Overall survival (%)"
+        ],
+        "value_names": lambda col: col.removesuffix(" (%)").title(),
+        "var_name": "survival_metric",
+        "value_name": "survival_per"
+    },
+    "column_map": {
         "Geography type": "Area type",
         "Geography name": "Area name",
         "Geography code": "Area code",
         "Patients": "patient_numbers"
-    }
-
-    df_adult4 = df_adult4.rename(columns=column_map)
-
-    #Format column names
-    df_adult4.columns = df_adult4.columns.str.replace('\n', ' ', regex=False)
-    df_adult4.columns = df_adult4.columns.str.strip().str.replace(' ', '_')
-    df_adult4.columns = df_adult4.columns.str.lower()
-
-    #Load data##################################################################
-
-    rename_adult4 = {
+    },
+    "rename": {
         "area_type": "AREA_TYPE",
         "area_code": "AREA_CODE",
         "area_name": "AREA_NAME",
@@ -365,39 +973,327 @@ def process_adult_data_sheet4(ctx, data_file, target_geographies=[]):
         "date_diagnosis_window": "DATE_DIAGNOSIS_WINDOW",
         "date_snapshot": "DATE_SNAPSHOT"
     }
+}
+
+#Data quality checks run on the adult data before it is uploaded
+adult4_checks = {
+    "columns": list(adult4_pipeline["rename"].values()),
+    "ranges": {
+        "SURVIVAL_PERCENT": (0, 100),
+        "PATIENT_NUMBERS": (0, None),
+        "YEARS_SINCE_DIAGNOSIS": (0, None)
+    }
+}
 
-    df_adult4 = df_adult4[rename_adult4.keys()].rename(columns=rename_adult4)
+#Function for transforming the adult cancer survival (Table 4) data
+def transform_adult_data_sheet4(data_file, target_geographies=[]):
 
-    database = getenv("DATABASE") 
-    schema = getenv("SCHEMA")
-    destination_table = getenv("DESTINATION_ADULT4")
-    destination = f"{database}.{schema}.{destination_table}"
-    
-    db.upload_df(ctx, df_adult4, destination, replace=True)
+    spec, context = get_pipeline_context(adult4_pipeline, data_file, 
+                                         target_geographies)
 
-def main(scrape=True):
+    df = pipeline.run_pipeline(spec, data_file, context,
+                               compact_dtypes=compact_dtypes)
 
-    ### Load environment variables 
-    load_dotenv(override=True)
+    return validation.validate_frame(
+        df, get_checks(adult4_checks, adult4_key_cols, context), 
+        basename(data_file))
 
-    if scrape:
-        #Pull the latest data
-        print("Downloading the latest data:")
-        scrape_latest_data()
-        print("-> Download complete\n")
+#Function for processing the adult cancer survival (Table 4) data
+def process_adult_data_sheet4(ctx, data_file, target_geographies=[]):
 
-    #Get data files
-    data_dir = "./data/"
-    data_files = [data_dir + f for f in listdir(data_dir) 
-                  if isfile(join(data_dir, f)) 
-                  and f.endswith(".xlsx")]
-    
-    #Set list of target geographies
-    # NCL (CA) - E56000027, London - E40000003, England - E92000001
-    target_geographies = ["E56000027", "E40000003", "E92000001"]
+    with telemetry.stage("process", data_file=data_file, 
+                         destination_env="DESTINATION_ADULT4"):
+        stream_rows = get_stream_rows()
+        if stream_rows:
+            spec, context = get_pipeline_context(adult4_pipeline, data_file, 
+                                                 target_geographies)
+            df_adult4 = pipeline.iter_pipeline(spec, data_file, context, 
+                                               chunk_rows=stream_rows,
+                                               compact_dtypes=compact_dtypes)
+            df_adult4 = validation.validate_chunks(
+                df_adult4, get_checks(adult4_checks, adult4_key_cols, context),
+                basename(data_file))
+            #Keep the (small) benchmarking subset as the chunks go past
+            benchmarking_rows = []
+            df_adult4 = collect_benchmarking_rows(df_adult4, benchmarking_rows)
+        else:
+            df_adult4 = transform_adult_data_sheet4(data_file, 
+                                                    target_geographies)
+
+        success = upload_output(ctx, df_adult4, "DESTINATION_ADULT4", 
+                                adult4_key_cols)
+
+        #Only update the benchmarking tables if the adult data was loaded
+        if success:
+            success = upload_benchmarking(
+                ctx, benchmarking_rows if stream_rows else df_adult4)
+
+        return success
+
+#Benchmarking aggregates#########################################################
+#The benchmarking standards and the NCL rank used by the dashboards are worked
+#out here as the adult data is loaded (instead of with window functions in the
+#reporting views) and loaded into two small summary tables.
+#Set DESTINATION_BENCHMARKING_STANDARDS and/or DESTINATION_BENCHMARKING_RANK 
+#to load them (see docs/create_benchmarking_*.sql)
+
+#Area codes of the benchmarking standards and the ranked area
+england_code = "E92000001"
+london_code = "E40000003"
+ncl_code = "E56000027"
+
+benchmarking_cols = [
+    "AREA_CODE",
+    "AREA_TYPE",
+    "CANCER_SITE",
+    "GENDER",
+    "YEARS_SINCE_DIAGNOSIS",
+    "DATE_DIAGNOSIS_WINDOW",
+    "SURVIVAL_PERCENT"
+]
+
+benchmarking_key_cols = ["JOIN_KEY"]
+
+#Get the rows used for benchmarking (age-standardised net survival) with the
+#JOIN_KEY used by the dashboards (and the geography set in batch mode)
+def get_benchmarking_rows(df_adult4):
+    cols = benchmarking_cols + [col for col in ["GEOGRAPHY_SET"] 
+                                if col in df_adult4.columns]
+    df = df_adult4.loc[
+        (df_adult4["STANDARDISATION_TYPE"] == "Age-standardised")
+        & (df_adult4["SURVIVAL_METRIC"] == "Net Survival"), 
+        cols].copy()
+
+    #Built as CONCAT does in the views: YEARS_SINCE_DIAGNOSIS is a NUMBER
+    #(so 5 rather than "5.0") and the key is null if any part is null
+    years = df["YEARS_SINCE_DIAGNOSIS"].astype("Int64").astype("string")
+    df["JOIN_KEY"] = (df["CANCER_SITE"].astype("string") 
+                      + df["GENDER"].astype("string") + years
+                      + df["DATE_DIAGNOSIS_WINDOW"].astype("string"))
+
+    return df
 
-    #Establish Snowflake connection
-    ctx = connect(
+#Pass through a list (or generator) of adult dataframes, keeping the rows used
+#for benchmarking in rows (so streamed uploads can be benchmarked afterwards)
+def collect_benchmarking_rows(chunks, rows):
+    for chunk in chunks:
+        rows.append(get_benchmarking_rows(chunk))
+        yield chunk
+
+#Get the nth smallest value in each group, where n = ceil(p * group size)
+#(the same as PERCENTILE_DISC(p) in Snowflake)
+def get_percentile_disc(df_sorted, positions, sizes, p):
+    selected = df_sorted[positions == np.ceil(p * sizes)]
+    return selected.set_index("JOIN_KEY")["SURVIVAL_PERCENT"]
+
+def get_benchmarking_standards(df_rows):
+
+    """
+    Function to get the benchmarking standards for each JOIN_KEY (as in the
+    BENCHMARKING_STANDARDS view).
+
+    inputs:
+    - df_rows: Dataframe of the benchmarking rows (see get_benchmarking_rows)
+
+    output:
+    Returns a dataframe of the England and London survival and the best, 
+    worst and quartiles of the Cancer Alliances for each JOIN_KEY
+    """
+
+    def get_area_survival(area_code):
+        df_area = df_rows[df_rows["AREA_CODE"] == area_code]
+        return df_area.groupby("JOIN_KEY")["SURVIVAL_PERCENT"].sum(min_count=1)
+
+    df_ca = df_rows[df_rows["AREA_TYPE"] == "Cancer Alliance"]
+    survival = df_ca.groupby("JOIN_KEY")["SURVIVAL_PERCENT"]
+
+    #Sort once for all the quartiles
+    df_sorted = (df_ca.dropna(subset=["SURVIVAL_PERCENT"])
+                 .sort_values(["JOIN_KEY", "SURVIVAL_PERCENT"]))
+    groups = df_sorted.groupby("JOIN_KEY")["SURVIVAL_PERCENT"]
+    positions = groups.cumcount() + 1
+    sizes = groups.transform("size")
+
+    df_standards = pd.concat({
+        "ENGLAND": get_area_survival(england_code),
+        "LONDON": get_area_survival(london_code),
+        "BEST": survival.max(),
+        "WORST": survival.min(),
+        "Q1": get_percentile_disc(df_sorted, positions, sizes, 0.25),
+        "Q2": get_percentile_disc(df_sorted, positions, sizes, 0.5),
+        "Q3": get_percentile_disc(df_sorted, positions, sizes, 0.75)
+    }, axis=1)
+
+    df_standards.index.name = "JOIN_KEY"
+    return df_standards.reset_index()
+
+def get_benchmarking_rank(df_rows, area_code=ncl_code):
+
+    """
+    Function to get the rank of an area among the Cancer Alliances for each
+    JOIN_KEY (as in the BENCHMARKING_RANK view).
+
+    inputs:
+    - df_rows: Dataframe of the benchmarking rows (see get_benchmarking_rows)
+    - area_code: Code of the area to rank (NCL by default)
+
+    output:
+    Returns a dataframe of the area's survival, rank (1 is the highest 
+    survival), the number of Cancer Alliances ranked and the quartile for 
+    each JOIN_KEY
+    """
+
+    #Rows with a null JOIN_KEY can't be joined to so aren't ranked
+    df_ca = df_rows[(df_rows["AREA_TYPE"] == "Cancer Alliance")
+                    & df_rows["SURVIVAL_PERCENT"].notna()
+                    & df_rows["JOIN_KEY"].notna()].copy()
+    df_ca["RANK_CA"] = (df_ca.groupby("JOIN_KEY")["SURVIVAL_PERCENT"]
+                        .rank(method="min", ascending=False).astype("int64"))
+
+    df_base = (df_ca.groupby("JOIN_KEY", as_index=False)
+               .agg(CANCER_SITE=("CANCER_SITE", "first"),
+                    RANK_BASE=("JOIN_KEY", "size")))
+
+    df_area = df_ca.loc[df_ca["AREA_CODE"] == area_code, 
+                        ["JOIN_KEY", "SURVIVAL_PERCENT", "RANK_CA"]]
+    df_rank = df_base.merge(df_area, on="JOIN_KEY", how="left")
+    df_rank["RANK_CA"] = df_rank["RANK_CA"].astype("Int64")
+    df_rank["CANCER_SITE"] = df_rank["CANCER_SITE"].astype(str)
+
+    #As a float array (NaN where the area isn't ranked) so the comparisons
+    #are plain Boolean arrays
+    ratio = (df_rank["RANK_CA"].to_numpy(dtype="float64", na_value=np.nan)
+             / df_rank["RANK_BASE"].to_numpy())
+    df_rank["NCL_QUARTILE"] = np.select(
+        [df_rank["RANK_CA"].isna().to_numpy(), 
+         (df_rank["RANK_BASE"] < 4).to_numpy(), 
+         ratio < 0.25, ratio < 0.5, ratio < 0.75],
+        [None, "-", "1st", "2nd", "3rd"], default="4th")
+
+    return df_rank[["JOIN_KEY", "CANCER_SITE", "SURVIVAL_PERCENT", "RANK_CA",
+                    "RANK_BASE", "NCL_QUARTILE"]]
+
+#Work out the benchmarking aggregates of each geography set (ranking the 
+#first area of each set) with the set name in GEOGRAPHY_SET
+def get_geography_set_aggregates(df_rows, func, geography_sets):
+    dfs = []
+    for name, codes in geography_sets.items():
+        df_set = func(df_rows[df_rows["GEOGRAPHY_SET"] == name], codes[0])
+        df_set["GEOGRAPHY_SET"] = name
+        dfs.append(df_set)
+
+    return pd.concat(dfs, ignore_index=True)
+
+#Work out and upload the benchmarking tables from the adult data (a dataframe
+#or a list of the benchmarking rows from collect_benchmarking_rows)
+#Returns Boolean value if the uploads were successful (True if neither table
+#is set up)
+def upload_benchmarking(ctx, df_adult4):
+    #Functions of the benchmarking rows and the area to rank
+    aggregates = {
+        "DESTINATION_BENCHMARKING_STANDARDS": 
+            lambda df_rows, area_code: get_benchmarking_standards(df_rows),
+        "DESTINATION_BENCHMARKING_RANK": get_benchmarking_rank
+    }
+    aggregates = {destination_env: func 
+                  for destination_env, func in aggregates.items()
+                  if getenv(destination_env)}
+    if not aggregates:
+        return True
+
+    with telemetry.stage("benchmarking") as span:
+        if isinstance(df_adult4, pd.DataFrame):
+            df_rows = get_benchmarking_rows(df_adult4)
+        else:
+            df_rows = pd.concat(df_adult4, ignore_index=True)
+        span["rows_in"] = len(df_rows)
+
+        geography_sets = get_geography_sets()
+
+        success = True
+        for destination_env, func in aggregates.items():
+            if geography_sets:
+                df = get_geography_set_aggregates(df_rows, func, 
+                                                  geography_sets)
+            else:
+                df = func(df_rows, ncl_code)
+
+            success &= upload_output(ctx, df, destination_env, 
+                                     benchmarking_key_cols)
+
+    return success
+
+#Transform a single data file (used by the backfill process pool)
+#content is the content of the workbook if it is held in memory (as the
+#worker processes don't share memory with the main process)
+#Returns the destination environment variable and the transformed data
+def transform_data_file(data_file, target_geographies, content=None):
+    file_name = data_file.replace("\\", "/").split("/")[-1]
+    if content is not None:
+        cache.add_memory_file(data_file, content)
+
+    try:
+        if file_name.startswith("Index"):
+            return ("DESTINATION_INDEX", 
+                    transform_index_data(data_file, target_geographies))
+
+        if file_name.startswith("adult"):
+            return ("DESTINATION_ADULT4", 
+                    transform_adult_data_sheet4(data_file, target_geographies))
+    finally:
+        #Each worker handles many files so release the workbook once done
+        excel.close_workbooks()
+        if content is not None:
+            cache.remove_memory_file(data_file)
+
+    return (None, None)
+
+#Process every historical data file and load each table in one go
+#data_files should be ordered newest first, as when a row appears in more than
+#one publication the row from the newest publication is kept
+def backfill(ctx, data_files, target_geographies, max_workers=None):
+
+    #Transform the files in parallel (one workbook per worker process)
+    results = {destination_env: [] for destination_env in key_cols}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        transformed = executor.map(transform_data_file, data_files, 
+                                   [target_geographies] * len(data_files))
+        
+        for data_file, (destination_env, df) in zip(data_files, transformed):
+            if destination_env:
+                print(f"-> {data_file}")
+                results[destination_env].append(df)
+
+    #Combine the publications and load each table once
+    for destination_env, dfs in results.items():
+        if not dfs:
+            continue
+
+        df = pd.concat(dfs, ignore_index=True)
+        df = df.drop_duplicates(
+            subset=get_output_key_cols(key_cols[destination_env]), 
+            keep="first")
+
+        upload_transformed(ctx, destination_env, df)
+
+#Number of files transformed (and uploaded) at the same time by main()
+#Set MAX_WORKERS=1 to process the files one at a time
+def get_max_workers():
+    return int(getenv("MAX_WORKERS", 2))
+
+#Path of a local DuckDB database to load instead of Snowflake (set 
+#LOCAL_DATABASE, e.g. ./output/cancer_survival.duckdb). None if not set
+def get_local_database():
+    return getenv("LOCAL_DATABASE")
+
+#Open a new Snowflake connection (or local database connection)
+def get_connection():
+    local_database = get_local_database()
+    if local_database:
+        return db.connect_local(local_database, getenv("DATABASE"), 
+                                getenv("SCHEMA"))
+
+    return snowflake_connector.connect(
         account=getenv("ACCOUNT"),
         user=getenv("USER"),
         authenticator=getenv("AUTHENTICATOR"),
@@ -407,16 +1303,573 @@ def main(scrape=True):
         schema=getenv("SCHEMA")
     )
 
-    #Split the files between Index and adult
-    print("Processing survival data:")
+#Run func(ctx, *args) with a database connection from a pool (a Queue of
+#open connections, so a connection is only used by one upload at a time). If
+#no connection is free, a new one is opened with connect_db and added to opened
+def with_pooled_connection(connections, opened, connect_db, func, *args):
+    try:
+        ctx = connections.get_nowait()
+    except Empty:
+        ctx = connect_db()
+        opened.append(ctx)
+
+    try:
+        return func(ctx, *args)
+    finally:
+        connections.put(ctx)
+
+#Close the connections opened by with_pooled_connection
+def close_connections(opened):
+    for ctx in opened:
+        if hasattr(ctx, "close"):
+            ctx.close()
+
+#Upload a transformed file (from transform_data_file) to its destination
+#Returns Boolean value if the upload was successful
+def upload_transformed(ctx, destination_env, df):
+    success = upload_output(ctx, df, destination_env, 
+                            key_cols[destination_env])
+
+    #The benchmarking tables are worked out from the adult data
+    if success and destination_env == "DESTINATION_ADULT4":
+        success = upload_benchmarking(ctx, df)
+
+    return success
+
+#Group the transformed files (from transform_data_file) by destination, in
+#order. Each group is uploaded on one thread, as uploads to the same table at
+#the same time conflict (e.g. the adult files of several diagnosis windows)
+def group_by_destination(transformed):
+    groups = {}
+    for destination_env, df in transformed:
+        groups.setdefault(destination_env, []).append((destination_env, df))
+    return list(groups.values())
+
+#Upload a group of transformed files one after another on one connection
+#Returns a list of Boolean values if each file was uploaded successfully
+def upload_transformed_group(ctx, group):
+    return [upload_transformed(ctx, destination_env, df) 
+            for destination_env, df in group]
+
+#Read, transform and upload a data file (Index or adult) on one connection
+#Returns Boolean value if the upload was successful (None if the file is not
+#a data file)
+def process_data_file(ctx, data_file, target_geographies):
+    file_name = basename(data_file)
+
+    if file_name.startswith("Index"):
+        print(f"-> {file_name}")
+        return process_index_data(ctx, data_file, target_geographies)
+
+    if file_name.startswith("adult"):
+        print(f"-> {file_name}")
+        return process_adult_data_sheet4(ctx, data_file, target_geographies)
+
+    return None
+
+def process_files(connect_db, data_files, target_geographies, max_workers=2):
+
+    """
+    Function to process the data files in parallel. The files are transformed
+    (and validated) on a process pool, then uploaded together on a thread
+    pool. No file is uploaded until every file has passed validation, so a
+    malformed workbook doesn't leave the tables partly updated. Files with 
+    the same destination table are uploaded one after another.
+
+    inputs:
+    - connect_db: Function that opens a database connection. Connections are
+    kept in a pool of at most max_workers and reused between uploads
+    - data_files: List of paths of the data files
+    - target_geographies: List of the core area codes
+    - max_workers: Number of files transformed and uploaded at the same time
+
+    output:
+    Returns a list of Boolean values if each file was uploaded successfully
+    (by destination, in the order the transforms finished). Raises a 
+    ValidationError (and uploads nothing) if any file fails validation
+    """
+
+    #The uploads use the lazily imported modules from other threads
+    load_lazy_modules()
+
+    transformed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as transformers:
+        transforms = {
+            transformers.submit(transform_data_file, data_file, 
+                                target_geographies,
+                                cache.get_memory_file(data_file)): data_file
+            for data_file in data_files
+        }
+
+        for transform in as_completed(transforms):
+            destination_env, df = transform.result()
+            if destination_env:
+                print(f"-> {basename(transforms[transform])}")
+                transformed.append((destination_env, df))
+
+    connections = Queue()
+    opened = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as uploaders:
+            uploads = [uploaders.submit(
+                           with_pooled_connection, connections, opened, 
+                           connect_db, upload_transformed_group, group)
+                       for group in group_by_destination(transformed)]
+
+            results = [result for upload in uploads 
+                       for result in upload.result()]
+    finally:
+        close_connections(opened)
+
+    return results
+
+#Schemas of the loaded tables in the reporting SQL (docs/reporting_*.sql), 
+#which are DATABASE.SCHEMA when the views are created locally
+reporting_source_schemas = [
+    "DEV__MODELLING.CANCER__SURVIVAL", 
+    "MODELLING.CANCER__SURVIVAL"
+]
+
+#Create (or replace) the reporting views in the local database from the 
+#reporting SQL in docs_dir, so they can be queried without Snowflake
+#Returns the number of statements run
+def create_local_views(ctx, docs_dir=paths.docs_dir):
+    local_schema = f"{getenv('DATABASE')}.{getenv('SCHEMA')}"
+
+    sql = []
+    for path in sorted(glob(join(docs_dir, "reporting_*.sql"))):
+        with open(path) as file:
+            sql.append(file.read())
+
+    if not sql:
+        print(f"Warning: No reporting views (reporting_*.sql) were found in "
+              f"{docs_dir}, so no views were created.")
+        return 0
+
+    with telemetry.stage("create_local_views"):
+        return db.run_local_sql(
+            ctx, ";\n".join(sql), getenv("DATABASE"), 
+            schemas={schema: local_schema 
+                     for schema in reporting_source_schemas})
+
+#Use the async pipeline (see scrape_and_process) to download and process the
+#latest data (set ASYNC_PIPELINE=1)
+def use_async_pipeline():
+    return getenv("ASYNC_PIPELINE", "0") == "1"
+
+def scrape_and_process(pages, connect_db, target_geographies, max_workers=2,
+                       data_dir=paths.data_dir):
+
+    """
+    Function to download the latest data files and transform each one as
+    soon as it is downloaded. Reading the target pages, downloading the files
+    and transforming them run at the same time (with asyncio): the files found
+    on each page are queued for download and each finished download is handed
+    straight to a transform while the other downloads are still in flight.
+    The transformed files are uploaded once every file has been transformed
+    and passed validation (streamed files are uploaded as they are read, see
+    process_data_file).
+
+    inputs:
+    - pages: List of the pages of the publication (from get_nhsd_pages). If
+    None, the pages are requested first
+    - connect_db: Function that opens a database connection (connections are
+    pooled as in process_files)
+    - target_geographies: List of the core area codes
+    - max_workers: Number of files processed at the same time (downloads are
+    limited to scrape_util.max_workers at a time)
+    - data_dir: Directory the data files are saved to
+
+    output:
+    Returns a tuple of the list of data files and a list of Boolean values if
+    each file was uploaded successfully (in the order they finished). Raises a
+    ValidationError (and uploads nothing that isn't streamed) if any file 
+    fails validation
+    """
+
+    #The uploads use the lazily imported modules from other threads
+    load_lazy_modules()
+    makedirs(data_dir, exist_ok=True)
+
+    return asyncio.run(scrape_and_process_async(
+        pages, connect_db, target_geographies, max_workers, data_dir))
+
+async def scrape_and_process_async(pages, connect_db, target_geographies, 
+                                   max_workers, data_dir):
+    loop = asyncio.get_running_loop()
+    max_downloads = scrape.max_workers
+    stream_rows = get_stream_rows()
+
+    #Files found on the pages wait here for a downloader. The queue is 
+    #bounded so finding files waits if the downloads fall behind
+    downloads = asyncio.Queue(maxsize=max_downloads)
+    #Streamed files are processed one at a time (as in main)
+    processing = asyncio.Semaphore(1 if stream_rows else max_workers)
+
+    connections = Queue()
+    opened = []
+    data_files = []
+    processed = []
+    transformed = []
+
+    #Get the links of each target page and queue the target files
+    async def find_files(session, pages):
+        try:
+            if pages is None:
+                pages = await async_scrape.get_nhsd_pages(session, publication)
+
+            async def find_page_files(target, page):
+                links = await async_scrape.get_file_links_from_page(session, 
+                                                                    page)
+                for file_id in find_target_file_ids(
+                        target, links, target_publications[target]):
+                    await downloads.put(
+                        (links, file_id, join(data_dir, file_id + ".xlsx")))
+
+            await asyncio.gather(*(
+                find_page_files(target, page) for target, page 
+                in get_latest_target_pages(pages, target_publications)))
+        finally:
+            #Tell each downloader there are no more files
+            for _ in range(max_downloads):
+                await downloads.put(None)
+
+    #Transform a data file on the process pool (it is uploaded once every
+    #file is transformed). Streamed files are transformed and uploaded chunk 
+    #by chunk on the thread pool, returning if the upload was successful
+    async def process(data_file, transformers, uploaders):
+        async with processing:
+            if stream_rows:
+                return await loop.run_in_executor(
+                    uploaders, with_pooled_connection, connections, opened,
+                    connect_db, process_data_file, data_file, 
+                    target_geographies)
+
+            destination_env, df = await loop.run_in_executor(
+                transformers, transform_data_file, data_file, 
+                target_geographies, cache.get_memory_file(data_file))
+            if destination_env:
+                print(f"-> {basename(data_file)}")
+                transformed.append((destination_env, df))
+
+            return None
+
+    #Download the queued files, handing each to processing once downloaded
+    async def download(session, transformers, uploaders):
+        while (item := await downloads.get()) is not None:
+            _, file_id, dest_file = item
+            result = await async_scrape.download_file_from_id(
+                session, *item, to_memory=get_data_in_memory(), 
+                persist=get_persist_data())
+
+            #Report files that are unchanged (failures are already reported)
+            if result is None:
+                print(f"{file_id}.xlsx is unchanged since the last download.")
+                result = dest_file
+
+            if result:
+                data_files.append(result)
+                processed.append(asyncio.create_task(
+                    process(result, transformers, uploaders)))
+
+    try:
+        with (ProcessPoolExecutor(max_workers=max_workers) as transformers,
+              ThreadPoolExecutor(max_workers=max_workers) as uploaders):
+            async with async_scrape.create_session(max_downloads) as session:
+                await asyncio.gather(
+                    find_files(session, pages),
+                    *(download(session, transformers, uploaders) 
+                      for _ in range(max_downloads)))
+
+            results = [result for result in await asyncio.gather(*processed)
+                       if result is not None]
+
+            #Every file has passed validation so upload them together (files
+            #with the same destination one after another)
+            uploads = await asyncio.gather(*(
+                loop.run_in_executor(
+                    uploaders, with_pooled_connection, connections, opened,
+                    connect_db, upload_transformed_group, group)
+                for group in group_by_destination(transformed)))
+            results += [result for group in uploads for result in group]
+    finally:
+        close_connections(opened)
+        excel.close_workbooks()
+
+    return data_files, results
+
+#Keep the downloaded data files in memory and process them from there instead
+#of reading them back from the data directory (set DATA_IN_MEMORY=1). They are
+#only also saved to the data directory if PERSIST_DATA=1
+def get_data_in_memory():
+    return getenv("DATA_IN_MEMORY", "0") == "1"
+
+def get_persist_data():
+    return getenv("PERSIST_DATA", "0") == "1"
+
+#Release the data files held in memory once they have been processed
+def release_memory_files(data_files):
     for data_file in data_files:
-        if data_file.split("/")[-1].startswith("Index"):
-            print(f"-> {data_file.split("/")[-1]}")
-            process_index_data(ctx, data_file, target_geographies)
+        cache.remove_memory_file(data_file)
+
+#Set list of target geographies
+# NCL (CA) - E56000027, London - E40000003, England - E92000001
+target_geographies = ["E56000027", "E40000003", "E92000001"]
+
+#Get the data files (workbooks) in the data directory
+def get_data_files(data_dir=paths.data_dir):
+    return [path for path in sorted(glob(join(data_dir, "*.xlsx"))) 
+            if isfile(path)]
+
+#Transform the data files and save them as Parquet files in output_dir (in a
+#sub directory for each destination) so they can be loaded later
+#Returns a list of the paths of the Parquet files
+def process_to_parquet(data_files, target_geographies, 
+                       output_dir=join(paths.output_dir, "processed"), 
+                       max_workers=None):
+    parquet_files = []
+
+    #Transform the files in parallel (one workbook per worker process)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        transformed = executor.map(transform_data_file, data_files, 
+                                   [target_geographies] * len(data_files))
+        
+        for data_file, (destination_env, df) in zip(data_files, transformed):
+            if not destination_env:
+                continue
+
+            print(f"-> {basename(data_file)}")
+            dest_dir = join(output_dir, destination_env)
+            makedirs(dest_dir, exist_ok=True)
+            parquet_file = join(dest_dir, 
+                                splitext(basename(data_file))[0] + ".parquet")
+            df.to_parquet(parquet_file, index=False)
+            parquet_files.append(parquet_file)
+
+    return parquet_files
+
+#Upload the Parquet files saved by process_to_parquet
+#Returns Boolean value if every file was uploaded successfully
+def load_processed(ctx, output_dir=join(paths.output_dir, "processed")):
+    success = True
+
+    for destination_env in key_cols:
+        for path in sorted(glob(join(output_dir, destination_env, "*.parquet"))):
+            print(f"-> {basename(path)}")
+            df = pd.read_parquet(path)
+            success &= upload_transformed(ctx, destination_env, df)
+
+    return success
 
-        if data_file.split("/")[-1].startswith("adult"):
-            print(f"-> {data_file.split("/")[-1]}")
-            process_adult_data_sheet4(ctx, data_file, target_geographies)
+#If force is False, the run is skipped when the publication is unchanged since
+#the last successful run (see is_publication_unchanged)
+def main(scrape=True, backfill_all=False, force=False):
 
+    ### Load environment variables 
+    dotenv.load_dotenv(override=True)
+
+    pages = None
+    if scrape and not backfill_all:
+        #Check if anything has changed (one request for the publication page)
+        with telemetry.stage("check"):
+            pages, unchanged = check_publication()
+
+        if unchanged and not force:
+            print("The publication is unchanged since the last run.",
+                  "Nothing to process.")
+            return
+
+        #Download the files and process each as soon as it is downloaded
+        if use_async_pipeline():
+            print("Downloading and processing the latest data:")
+            with telemetry.stage("scrape_and_process"):
+                data_files, results = scrape_and_process(
+                    pages, get_connection, target_geographies, 
+                    max_workers=get_max_workers())
+
+            if results and all(results):
+                save_manifest(build_manifest(pages, data_files))
+            release_memory_files(data_files)
+            return
+
+        #Pull the latest data
+        print("Downloading the latest data:")
+        with telemetry.stage("scrape"):
+            downloaded = scrape_latest_data(pages=pages, 
+                                            to_memory=get_data_in_memory(),
+                                            persist=get_persist_data())
+        print("-> Download complete\n")
+
+    #Get data files (files kept in memory are not all in the data directory)
+    if scrape and get_data_in_memory() and not backfill_all:
+        data_files = downloaded
+    else:
+        data_files = get_data_files()
+
+    #Process every past publication instead of the latest data
+    if backfill_all:
+        #Establish Snowflake connection
+        ctx = get_connection()
+
+        backfill_dir = join(paths.data_dir, "backfill")
+        if scrape:
+            print("Downloading all publications:")
+            with telemetry.stage("scrape"):
+                backfill_files = scrape_all_data(data_dir=backfill_dir)
+            print("-> Download complete\n")
+        else:
+            #Use the newest publications first (as when scraping)
+            backfill_files = get_backfill_files(backfill_dir)
+
+        print("Processing all survival data:")
+        with telemetry.stage("backfill", files=len(backfill_files)):
+            backfill(ctx, backfill_files, target_geographies)
+        return
+
+    #Transform the files in parallel, uploading them once all are validated
+    #(Streamed files are uploaded chunk by chunk so are processed in turn)
+    print("Processing survival data:")
+    max_workers = get_max_workers()
+    if max_workers > 1 and not get_stream_rows():
+        results = process_files(get_connection, data_files, 
+                                target_geographies, max_workers=max_workers)
+    else:
+        #Establish Snowflake connection
+        ctx = get_connection()
+
+        results = []
+        if get_stream_rows():
+            #Process the Index and adult files in turn (streamed files are
+            #validated as they are uploaded and a failed check rolls back
+            #the load of that table)
+            for data_file in data_files:
+                result = process_data_file(ctx, data_file, target_geographies)
+                if result is not None:
+                    results.append(result)
+        else:
+            #Transform (and validate) every file before uploading any
+            transformed = []
+            for data_file in data_files:
+                destination_env, df = transform_data_file(data_file, 
+                                                          target_geographies)
+                if destination_env:
+                    print(f"-> {basename(data_file)}")
+                    transformed.append((destination_env, df))
+
+            for destination_env, df in transformed:
+                results.append(upload_transformed(ctx, destination_env, df))
+
+        #Release the open workbooks
+        excel.close_workbooks()
+
+    #Record what was loaded so unchanged publications are skipped next time
+    if pages and results and all(results):
+        save_manifest(build_manifest(pages, data_files))
+    release_memory_files(data_files)
+
+
+#Exit code of the check command when no new data has been published (a run
+#that fails exits with 1, and 2 is used by argparse for invalid arguments)
+no_new_data_exit_code = 3
+
+#Command line interface (can be run from any directory, the data and output 
+#directories are in the root of the repository):
+#   python main.py [run [--force]]          Download, process and load the latest data
+#   python main.py check                    Check if new data has been published
+#   python main.py scrape [--all]           Download the latest (or every) data file
+#   python main.py process                  Transform the data files to output/processed
+#   python main.py load                     Upload the files in output/processed
+#   python main.py backfill [--no-scrape]   Process every past publication
+#Heavy packages are only imported by the commands that use them
+def cli(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Cancer survival data ETL (NHSD to Snowflake)")
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser(
+        "run", help="Download, process and load the latest data (the default)")
+    run_parser.add_argument("--force", action="store_true",
+                            help="Process the data even if the publication "
+                                 "is unchanged since the last run")
+    commands.add_parser("check", 
+                        help="Check if new data has been published (exits "
+                             "with 0 if there is new data, "
+                             f"{no_new_data_exit_code} if there is none and "
+                             "1 if the check failed)")
+    scrape_parser = commands.add_parser("scrape", 
+                                        help="Download the latest data files")
+    scrape_parser.add_argument("--all", action="store_true",
+                               help="Download every past publication to "
+                                    "data/backfill")
+    commands.add_parser("process", 
+                        help="Transform the data files in data and save them "
+                             "to output/processed")
+    commands.add_parser("load", 
+                        help="Upload the processed files in output/processed")
+    backfill_parser = commands.add_parser(
+        "backfill", help="Process and load every past publication")
+    backfill_parser.add_argument("--no-scrape", action="store_true",
+                                 help="Use the files already in data/backfill "
+                                 "(in the page order saved when they were "
+                                 "downloaded)")
+
+    args = parser.parse_args(argv)
+    command = args.command or "run"
+
+    dotenv.load_dotenv(override=True)
+
+    if command == "check":
+        new_file_ids = check_for_new_data()
+        if not new_file_ids:
+            print("No new data has been published.")
+            return no_new_data_exit_code
+
+        print("New data has been published:")
+        for file_id in new_file_ids:
+            print(f"-> {file_id}")
+        return 0
 
-main(scrape=True)
\ No newline at end of file
+    try:
+        return run_command(command, args)
+    except validation.ValidationError as e:
+        #A malformed workbook stops the run before its data is uploaded
+        print("The data failed validation so it was not uploaded:")
+        print(e)
+        return 1
+
+#Run a command of the command line interface (other than check)
+def run_command(command, args):
+    if command == "scrape":
+        if getattr(args, "all", False):
+            scrape_all_data()
+        else:
+            scrape_latest_data()
+    elif command == "process":
+        process_to_parquet(get_data_files(), target_geographies)
+    elif command == "load":
+        ctx = get_connection()
+        try:
+            success = load_processed(ctx)
+        finally:
+            close_connections([ctx])
+    elif command == "backfill":
+        main(scrape=not getattr(args, "no_scrape", False), backfill_all=True)
+    else:
+        main(scrape=True, force=getattr(args, "force", False))
+
+    #Keep the reporting views of a local database up to date
+    if command in ["run", "load", "backfill"] and get_local_database():
+        ctx = get_connection()
+        try:
+            create_local_views(ctx)
+        finally:
+            close_connections([ctx])
+
+    if command == "load":
+        return 0 if success else 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
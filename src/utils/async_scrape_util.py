@@ -0,0 +1,149 @@
+#Functions for scraping the NHSD site with asyncio (see scrape_util.py for the
+#terminology). These mirror the functions in scrape_util.py but use aiohttp so
+#pages and files can be requested while other work is still running (see
+#scrape_and_process in main.py). They share the scrape cache with
+#scrape_util.py so conditional requests work with either. File access (the
+#cache, hashing and writing downloads) runs on threads so it doesn't block the
+#event loop.
+
+#Import packages
+import asyncio
+import hashlib
+import os
+
+import aiohttp
+from yarl import URL
+
+import utils.scrape_util as scrape
+import utils.telemetry_util as telemetry
+
+#Retries with backoff for transient server errors (as in scrape_util.py)
+retries = 5
+backoff_factor = 1
+retry_statuses = {429, 500, 502, 503, 504}
+
+#Create a session with at most max_connections open at the same time
+def create_session(max_connections=scrape.max_workers):
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    return aiohttp.ClientSession(connector=connector)
+
+#Make a GET request, retrying transient errors with backoff
+#The url is used as given (the file links contain escapes such as %2C which
+#would otherwise be unescaped)
+#Returns the response (which must be released by the caller)
+async def get(session, url, headers=None):
+    for attempt in range(retries + 1):
+        try:
+            res = await session.get(URL(url, encoded=True), headers=headers)
+        except aiohttp.ClientConnectionError:
+            if attempt == retries:
+                raise
+        else:
+            if res.status not in retry_statuses or attempt == retries:
+                return res
+            res.release()
+
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+#Get the html of a page, using the cached copy if the server reports it has
+#not been modified since the last request
+async def get_page_html(session, url):
+    with telemetry.stage("scrape_page", url=url) as span:
+        headers = await asyncio.to_thread(scrape.get_page_headers, url)
+        res = await get(session, url, headers=headers)
+        async with res:
+            span["status_code"] = res.status
+
+            if res.status == 304:
+                return await asyncio.to_thread(scrape.read_page_html, url)
+
+            res.raise_for_status()
+            content = await res.read()
+            text = content.decode(res.get_encoding())
+        span["bytes"] = len(content)
+        await asyncio.to_thread(scrape.save_page_html, url, res, content, text)
+
+        return text
+
+#Get the n most recent pages from the specified nhsd page
+async def get_nhsd_pages(session, nhsd_publication, n=False,
+                         url="https://digital.nhs.uk",
+                         section="/data-and-information/publications/statistical/"):
+    url_full = url + section + nhsd_publication + "/"
+    html = await get_page_html(session, url_full)
+
+    return await asyncio.to_thread(scrape.parse_nhsd_pages, html, n)
+
+#For a given page, return a list of all files capturing the file id and period
+#(Parsing runs on a thread so other requests carry on in the meantime)
+async def get_file_links_from_page(session, page, url="https://digital.nhs.uk"):
+    full_url = url + page
+    html = await get_page_html(session, full_url)
+
+    return await asyncio.to_thread(scrape.parse_file_links, full_url, html)
+
+#Download a data file for a given file_id and file_links, streamed straight to
+#dest_file (or kept in memory if to_memory is True). Returns the path of the
+#file, None if dest_file already holds the latest copy of the file or 0 if the
+#download failed (see scrape_util.download_file_from_id)
+async def download_file_from_id(session, file_links, file_id, dest_file,
+                                to_memory=False, persist=True):
+    with telemetry.stage("download_file", file_id=file_id,
+                         dest_file=dest_file, to_memory=to_memory) as span:
+        result = await _download_file_from_id(session, file_links, file_id,
+                                              dest_file, span, to_memory,
+                                              persist)
+        span["result"] = ("unchanged" if result is None
+                          else "failed" if result == 0 else "downloaded")
+        return result
+
+#Hash and write a block of a streamed download
+def write_block(file, sha, block):
+    sha.update(block)
+    file.write(block)
+
+async def _download_file_from_id(session, file_links, file_id, dest_file,
+                                 span, to_memory=False, persist=True):
+    #Hashes the local copy of the file
+    download = await asyncio.to_thread(scrape.prepare_download, file_links,
+                                       file_id, dest_file)
+    if download is None:
+        return 0
+    target_url, local_hash, headers = download
+
+    res = await get(session, target_url, headers=headers)
+    async with res:
+        span["status_code"] = res.status
+
+        #The file has not changed since it was last downloaded
+        if res.status == 304:
+            return None
+
+        if res.status != 200:
+            scrape.print_download_failure(target_url, res.status)
+            return 0
+
+        if to_memory and not scrape.is_large_download(res.headers):
+            content = await res.read()
+            span["bytes"] = len(content)
+            return await asyncio.to_thread(
+                scrape.keep_in_memory, target_url, res, dest_file, content,
+                local_hash, persist)
+
+        #Large files that are not saved to the data directory are streamed
+        #to a temporary file
+        if to_memory and not persist:
+            dest_file = scrape.get_spill_file(dest_file)
+
+        #Stream the file to a temporary file in blocks, hashing as it goes
+        sha = hashlib.sha256()
+        file = await asyncio.to_thread(open, dest_file + ".part", "wb")
+        try:
+            async for block in res.content.iter_chunked(scrape.chunk_size):
+                await asyncio.to_thread(write_block, file, sha, block)
+        finally:
+            await asyncio.to_thread(file.close)
+    span["bytes"] = os.path.getsize(dest_file + ".part")
+
+    return await asyncio.to_thread(scrape.finish_download, target_url, res,
+                                   dest_file, sha.hexdigest(), local_hash)
@@ -0,0 +1,188 @@
+#Functions for the local cache of parsed workbook sheets
+#
+#Parsed sheets are stored as Parquet files in the cache directory, keyed by the
+#SHA-256 of the source workbook plus the sheet name and the options it was read
+#with (rows skipped, columns, filters etc.). This means an unchanged workbook
+#is never re-parsed between runs.
+#
+#The cache can be cleared with the following (run from the src directory so
+#the utils package can be imported, the cache is in data/.cache in the root of
+#the repository):
+#   python -m utils.cache_util clear [data_file ...]
+
+#Import packages
+import hashlib
+import json
+import os
+import sys
+from glob import glob
+
+from utils.import_util import lazy_import
+import utils.path_util as paths
+
+#Only needed to read cached sheets (scrape_util uses this module for hashing)
+pd = lazy_import("pandas")
+
+cache_dir = os.path.join(paths.data_dir, ".cache")
+max_cache_bytes = 500 * 1024 * 1024 #Size limit before old entries are evicted
+
+#Hashes of files already read in this run, keyed by (path, size, mtime)
+_file_hashes = {}
+
+#Workbooks downloaded into memory instead of being read from disk (see
+#scrape_util.download_file_from_id), keyed by the path they are known by
+_memory_files = {}
+
+#Hold the content of a workbook in memory under its path, so it is read from
+#memory (see excel_util.open_workbook) and hashed without reading the disk
+def add_memory_file(data_file, content, content_hash=None):
+    key = os.path.abspath(data_file)
+    _memory_files[key] = content
+    _file_hashes[("memory", key)] = (content_hash or 
+                                     hashlib.sha256(content).hexdigest())
+
+#Get the content of a workbook held in memory (None if it isn't)
+def get_memory_file(data_file):
+    return _memory_files.get(os.path.abspath(data_file))
+
+#Release the content of a workbook held in memory (its hash is kept)
+def remove_memory_file(data_file):
+    _memory_files.pop(os.path.abspath(data_file), None)
+
+#Get the SHA-256 of a file, reading it in blocks
+def file_hash(data_file):
+    memory_key = ("memory", os.path.abspath(data_file))
+    if memory_key in _file_hashes:
+        return _file_hashes[memory_key]
+
+    stat = os.stat(data_file)
+    key = (os.path.abspath(data_file), stat.st_size, stat.st_mtime_ns)
+
+    if key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(data_file, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha.update(block)
+        _file_hashes[key] = sha.hexdigest()
+
+    return _file_hashes[key]
+
+#Get the cache file path for a given sheet of a workbook
+#The file name is prefixed with the workbook hash so all entries for a
+#workbook can be found when invalidating it
+def get_cache_path(data_file, sheet_name, options):
+    sheet_key = sheet_name + "|" + json.dumps(options, sort_keys=True)
+    sheet_key = sheet_key.encode("utf-8")
+    sheet_hash = hashlib.sha256(sheet_key).hexdigest()[:16]
+
+    return os.path.join(cache_dir, f"{file_hash(data_file)}_{sheet_hash}.parquet")
+
+def load_frame(data_file, sheet_name, options):
+
+    """
+    Function to load a parsed sheet from the cache.
+
+    inputs:
+    - data_file: Path to the source Excel workbook
+    - sheet_name: Name of the sheet
+    - options: Dict of the options the sheet was read with
+    (see excel_util.read_sheet)
+
+    output:
+    Returns the cached dataframe, or None if the sheet is not cached
+    """
+
+    path = get_cache_path(data_file, sheet_name, options)
+
+    if not os.path.isfile(path):
+        return None
+
+    #Mark the entry as recently used so it is evicted last
+    os.utime(path)
+
+    return pd.read_parquet(path)
+
+def save_frame(df, data_file, sheet_name, options):
+
+    """
+    Function to save a parsed sheet to the cache, evicting the least recently
+    used entries if the cache grows past max_cache_bytes.
+
+    inputs:
+    - df: Dataframe of the parsed sheet
+    - data_file: Path to the source Excel workbook
+    - sheet_name: Name of the sheet
+    - options: Dict of the options the sheet was read with
+    (see excel_util.read_sheet)
+
+    output:
+    Returns Boolean value if the sheet was cached
+    """
+
+    path = get_cache_path(data_file, sheet_name, options)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    #Write to a temporary file first so a failed write never leaves a
+    #partial entry in the cache (named by process as the cache can be shared)
+    path_tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(path_tmp, index=False)
+        os.replace(path_tmp, path)
+    #Sheets with mixed type columns can't be stored in Parquet
+    except Exception as e:
+        print("    -> ", f"Warning: Unable to cache {sheet_name} ({e}).")
+        if os.path.isfile(path_tmp):
+            os.remove(path_tmp)
+        return False
+
+    evict()
+
+    return True
+
+#Remove the least recently used entries until the cache is within max_bytes
+def evict(max_bytes=None):
+    if max_bytes is None:
+        max_bytes = max_cache_bytes
+
+    #Entries can be removed by other processes sharing the cache while this
+    #runs, so missing files are skipped
+    entries = []
+    for path in glob(os.path.join(cache_dir, "*.parquet")):
+        try:
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except FileNotFoundError:
+            pass
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+#Remove the cache entries for the given workbooks (or every entry if None)
+def invalidate(data_files=None):
+    if data_files is None:
+        paths = glob(os.path.join(cache_dir, "*.parquet"))
+    else:
+        paths = []
+        for data_file in data_files:
+            pattern = f"{file_hash(data_file)}_*.parquet"
+            paths += glob(os.path.join(cache_dir, pattern))
+
+    for path in paths:
+        os.remove(path)
+
+    return len(paths)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "clear":
+        print("Usage (from the src directory): "
+              "python -m utils.cache_util clear [data_file ...]")
+        sys.exit(1)
+
+    removed = invalidate(sys.argv[2:] or None)
+    print(f"Removed {removed} cached sheets from {cache_dir}")
@@ -1,61 +1,904 @@
 #Functions for interacting with the database
 
 #Import packages
+import os
+import re
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
 import pandas as pd
-from sqlalchemy import create_engine, MetaData, Table, text, insert
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import create_engine, MetaData, Table, text, insert, inspect
+from sqlalchemy.engine import Engine
 
 from snowflake.connector.pandas_tools import write_pandas
 
-def upload_df(ctx, df, destination, replace=True):
+import utils.telemetry_util as telemetry
+import utils.validation_util as validation
+
+#DuckDB is only needed for the local database (see connect_local)
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+copy_chunk_rows = 500000  #Rows per Parquet file when loading with COPY
+
+#Check if the connection is a SQLAlchemy engine (i.e. a local database used
+#for development and testing) rather than a Snowflake connection
+def is_sqlalchemy(ctx):
+    return isinstance(ctx, Engine)
+
+#Check if the connection is a local DuckDB database (see connect_local)
+def is_duckdb(ctx):
+    return duckdb is not None and isinstance(ctx, duckdb.DuckDBPyConnection)
+
+#Get the name of the database behind a connection (recorded in the spans)
+def get_backend(ctx):
+    if is_duckdb(ctx):
+        return "duckdb"
+    if is_sqlalchemy(ctx):
+        return "sqlalchemy"
+    return "snowflake"
+
+#Split a destination into its table name and schema (if any)
+def split_destination(destination):
+    destination_segs = destination.split(".")
+    schema = ".".join(destination_segs[:-1]) or None
+
+    return destination_segs[-1], schema
+
+#Quote a list of column names for use in SQL
+def quote_columns(columns, prefix=""):
+    return ", ".join(f'{prefix}"{col}"' for col in columns)
+
+def add_row_hashes(df, key_cols):
+
+    """
+    Function to add the ROW_KEY and ROW_HASH columns used for incremental
+    loads. ROW_KEY is a hash of the natural key columns and ROW_HASH is a hash
+    of every other column, so a changed row has the same ROW_KEY but a
+    different ROW_HASH.
+
+    inputs:
+    - df: Dataframe object
+    - key_cols: List of columns that identify a unique row
+
+    output:
+    Returns a copy of the dataframe with the ROW_KEY and ROW_HASH columns
+    """
+
+    df = df.copy()
+    value_cols = [col for col in df.columns
+                  if col not in key_cols + ["ROW_KEY", "ROW_HASH"]]
+
+    #Stored as signed 64 bit integers so they fit in any database
+    df["ROW_KEY"] = pd.util.hash_pandas_object(
+        df[key_cols], index=False).values.view("int64")
+    df["ROW_HASH"] = pd.util.hash_pandas_object(
+        df[value_cols], index=False).values.view("int64")
+
+    return df
+
+def write_parquet_chunks(df, dest_dir, prefix="chunk", chunk_rows=None,
+                         compression="snappy"):
 
     """
-    Function to upload a dataframe to Snowflake.
+    Function to write a dataframe to compressed Parquet files of up to
+    chunk_rows rows each. Columns keep their types (no conversion to Python
+    objects) and missing values are written as nulls.
 
     inputs:
-    - ctx: Snowflake connection object 
-    (https://docs.snowflake.com/en/developer-guide/python-connector/python-connector-connect)
+    - df: Dataframe object
+    - dest_dir: Directory to write the files to
+    - prefix: Start of each file name
+    - chunk_rows: Maximum rows per file (copy_chunk_rows if None)
+    - compression: Parquet compression codec
+
+    output:
+    Returns a list of the paths of the files written
+    """
+
+    if chunk_rows is None:
+        chunk_rows = copy_chunk_rows
+
+    os.makedirs(dest_dir, exist_ok=True)
+
+    paths = []
+    for start in range(0, max(len(df), 1), chunk_rows):
+        table = pa.Table.from_pandas(df.iloc[start:start + chunk_rows],
+                                     preserve_index=False)
+        path = os.path.join(dest_dir, f"{prefix}_{len(paths):05d}.parquet")
+        #Snowflake can't load nanosecond timestamps from Parquet
+        pq.write_table(table, path, compression=compression,
+                       coerce_timestamps="us", allow_truncated_timestamps=True)
+        paths.append(path)
+
+    return paths
+
+def copy_df(ctx, df, destination, chunk_rows=None, compression="snappy",
+            target_dir=None):
+
+    """
+    Function to bulk load a dataframe by writing it to Parquet files, uploading
+    them to the table stage (PUT) and loading them with COPY INTO.
+
+    inputs:
+    - ctx: Snowflake connection object (or None to only write the files)
     - df: Dataframe object
     - destination: Full table name of the destination
     (e.g. DATABASE_NAME.SCHEMA_NAME.TABLE_NAME)
-    - replace: If True, the destination is TRUNCATED before uploading new data
-    (If the upload fails, the truncation is rollbacked)
+    - chunk_rows: Maximum rows per file (copy_chunk_rows if None)
+    - compression: Parquet compression codec
+    - target_dir: Directory to keep the Parquet files in. If None, the files
+    are written to a temporary directory and removed after loading
 
     output:
-    Returns Boolean value if the upload was successful
+    Returns the number of rows loaded (or written if ctx is None)
     """
 
-    df = df.copy()
-    df.reset_index(drop=True, inplace=True)
+    table_name, schema = split_destination(destination)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dest_dir = target_dir or temp_dir
+        paths = write_parquet_chunks(df, dest_dir, prefix=table_name,
+                                     chunk_rows=chunk_rows,
+                                     compression=compression)
+
+        #Local file target (for testing and benchmarking offline)
+        if ctx is None:
+            return len(df)
+
+        stage = f"@{schema}.%{table_name}"
+        cur = ctx.cursor()
+        try:
+            #Clear any files left in the stage by a failed load
+            cur.execute(f"REMOVE {stage}")
+
+            for path in paths:
+                path_uri = os.path.abspath(path).replace("\\", "/")
+                cur.execute(f"PUT 'file://{path_uri}' {stage} "
+                            "AUTO_COMPRESS=FALSE OVERWRITE=TRUE")
+
+            cur.execute(
+                f"COPY INTO {destination} FROM {stage} "
+                "FILE_FORMAT=(TYPE=PARQUET) "
+                "MATCH_BY_COLUMN_NAME=CASE_SENSITIVE "
+                "ON_ERROR=ABORT_STATEMENT PURGE=TRUE")
+
+            #The 4th column of the COPY result is the rows loaded per file
+            #(a single column message is returned if no files were loaded)
+            nrows = sum(row[3] for row in cur.fetchall() if len(row) > 3)
+        finally:
+            cur.close()
+
+    return nrows
+
+#Write a dataframe to an existing Snowflake table with the given loader
+#("write_pandas" or "copy"), returning the number of rows written
+def write_df(ctx, df, destination, loader="write_pandas", chunk_rows=None):
+    if loader == "copy":
+        return copy_df(ctx, df, destination, chunk_rows=chunk_rows)
+
+    df = df.reset_index(drop=True)
     #Needed to prevent "null" strings in the destination
     df = df.where(pd.notnull(df), None)
 
-    cur = ctx.cursor()
     destination_segs = destination.split(".")
-    success = False
+    success, nchunks, nrows, _ = write_pandas(
+        conn=ctx,
+        df=df,
+        table_name=destination_segs[2],
+        schema=destination_segs[1],
+        database=destination_segs[0],
+        chunk_size=chunk_rows,
+        overwrite=False
+    )
+
+    if not success:
+        raise Exception("Failed to write DataFrame to Snowflake.")
+
+    return nrows
+
+#Local DuckDB database###########################################################
+#A local database can be used in place of Snowflake for development, testing
+#and small deployments. Every upload_df mode is supported, the dataframes are
+#appended in bulk (DuckDB reads them in place) and the reporting views in docs
+#can be created locally with run_local_sql.
+
+#Local databases opened by connect_local (one per file, shared by every
+#connection to it)
+_local_databases = {}
+_local_lock = threading.Lock()
+
+#Columns added to the local tables, as in the tables in docs (the row hashes
+#are only filled in by the merge and swap modes)
+docs_columns = [
+    ("ROW_KEY", "BIGINT"),
+    ("ROW_HASH", "BIGINT"),
+    ("_TIMESTAMP", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+]
+
+def connect_local(path, database, schema=None):
+
+    """
+    Function to connect to a local DuckDB database.
+
+    inputs:
+    - path: Path of the database file (created if it doesn't exist)
+    - database: Name to attach the database as, so the full table names used
+    for Snowflake (DATABASE_NAME.SCHEMA_NAME.TABLE_NAME) work unchanged
+    - schema: Name of a schema to create in the database if it doesn't exist.
+    It is created when the database is first attached, as uploads running in
+    parallel that both create it in their transactions would conflict
+
+    output:
+    Returns a DuckDB connection. Each call returns a new connection to the
+    same database, so each thread can have its own
+    """
+
+    if duckdb is None:
+        raise ImportError("duckdb must be installed to use a local database.")
+
+    key = (os.path.abspath(path), database)
+    with _local_lock:
+        if key not in _local_databases:
+            path_dir = os.path.dirname(path)
+            if path_dir:
+                os.makedirs(path_dir, exist_ok=True)
+
+            con = duckdb.connect()
+            con.execute(f"ATTACH '{path}' AS {database}")
+            _local_databases[key] = con
+
+        if schema:
+            _local_databases[key].execute(
+                f"CREATE SCHEMA IF NOT EXISTS {database}.{schema}")
+
+        return _local_databases[key].cursor()
+
+#Create a table in a local database with the columns of a registered
+#dataframe (source) if it doesn't already exist. Categorical columns are 
+#created as VARCHAR (not ENUM) and, if add_docs_columns is True, the
+#docs_columns not in the source are added (so the reporting views in docs can
+#be created). Columns missing from an existing table are added to it
+def create_duckdb_table(ctx, destination, source, add_docs_columns=True):
+    _, schema = split_destination(destination)
+    ctx.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+
+    columns = []
+    for col, col_type, *_ in ctx.execute(f"DESCRIBE {source}").fetchall():
+        if col_type.startswith("ENUM"):
+            col_type = "VARCHAR"
+        columns.append((col, col_type))
+    if add_docs_columns:
+        source_columns = [col for col, _ in columns]
+        columns += [(col, col_type) for col, col_type in docs_columns
+                    if col not in source_columns]
+
+    column_defs = [f'"{col}" {col_type}' for col, col_type in columns]
+    ctx.execute(f"CREATE TABLE IF NOT EXISTS {destination} "
+                f"({', '.join(column_defs)})")
+
+    table_columns = get_table_columns(ctx, destination)
+    for (col, _), column_def in zip(columns, column_defs):
+        if col not in table_columns:
+            ctx.execute(f"ALTER TABLE {destination} ADD COLUMN {column_def}")
+
+#Get the columns of a table
+def get_table_columns(ctx, table):
+    return [col[0] for col in 
+            ctx.execute(f"SELECT * FROM {table} LIMIT 0").description]
+
+#Start of a full table name (DATABASE_NAME.SCHEMA_NAME.)
+table_name_pattern = r"\b([A-Za-z_]\w*)\.([A-Za-z_]\w*)\.(?=[A-Za-z_\"])"
+
+def run_local_sql(ctx, sql, database, schemas=None):
+
+    """
+    Function to run SQL written for Snowflake (e.g. the reporting views in 
+    docs) on a local DuckDB database. Snowflake only clauses (COMMENT) are 
+    removed and the full table names are mapped to the local database.
+    Statements that fail (e.g. a view that uses a view created later in the
+    SQL) are retried once the others have run.
+
+    inputs:
+    - ctx: DuckDB connection (from connect_local)
+    - sql: SQL statements separated by semicolons
+    - database: Name of the local database (as given to connect_local)
+    - schemas: Dict of Snowflake schema (DATABASE_NAME.SCHEMA_NAME) => local
+    schema. Any other schema is created in the local database with the
+    database and schema names joined by "__"
+
+    output:
+    Returns the number of statements run (any that still fail are printed)
+    """
+
+    schemas = {schema.upper(): local_schema 
+               for schema, local_schema in (schemas or {}).items()}
+
+    def get_local_schema(match):
+        schema = f"{match.group(1)}.{match.group(2)}".upper()
+        if schema not in schemas:
+            schemas[schema] = (f"{database}.{match.group(1)}__"
+                               f"{match.group(2)}").upper()
+        return schemas[schema] + "."
+
+    statements = []
+    for statement in sql.split(";"):
+        statement = re.sub(r"""COMMENT\s*=\s*("[^"]*"|'[^']*')""", "", 
+                           statement, flags=re.I)
+        statement = re.sub(table_name_pattern, get_local_schema, statement)
+        if statement.strip():
+            statements.append(statement)
+
+    for schema in set(schemas.values()):
+        ctx.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+
+    nrun = 0
+    while statements:
+        failed = []
+        for statement in statements:
+            try:
+                ctx.execute(statement)
+            except duckdb.Error as e:
+                failed.append((statement, e))
+        nrun += len(statements) - len(failed)
+
+        #Stop once no more statements can be run
+        if len(failed) == len(statements):
+            for statement, e in failed:
+                print("Warning: Unable to run the statement", 
+                      f"{' '.join(statement.split())[:80]}...", e)
+            break
+        statements = [statement for statement, _ in failed]
+
+    return nrun
+
+
+#Sinks###########################################################################
+#A sink runs the statements of the load modes (merge_df, swap_df and append_df)
+#on one database backend, so each mode is written once for every backend.
+#Sinks with transactional_writes can roll back the chunks written in a
+#transaction, the others are loaded through a staging or shadow table.
+
+#Get a unique name for a staging or shadow table of a destination, so loads
+#running at the same time never share one
+def get_work_table(destination, suffix):
+    return f"{destination}_{suffix}_{uuid.uuid4().hex[:8].upper()}"
+
+class DuckDBSink:
+
+    """
+    Sink for a local DuckDB database (see connect_local). The tables are
+    created from the first chunk written to them.
+    """
+
+    transactional_writes = True
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    @contextmanager
+    def transaction(self):
+        self.ctx.begin()
+        try:
+            yield
+            self.ctx.commit()
+        except BaseException:
+            self.ctx.rollback()
+            raise
+
+    def execute(self, sql):
+        self.ctx.execute(sql)
+
+    def fetchone(self, sql):
+        return self.ctx.execute(sql).fetchone()
+
+    #Run an INSERT, UPDATE or DELETE, returning the number of rows changed
+    def execute_count(self, sql):
+        return self.fetchone(sql)[0]
+
+    #A failed statement aborts the transaction, so the table is looked up
+    #instead of trying to use it
+    def has_table(self, table):
+        table_name, schema = split_destination(table)
+        database, schema = schema.split(".")
+        return self.fetchone(
+            "SELECT COUNT(*) FROM duckdb_tables() "
+            f"WHERE database_name = '{database}' "
+            f"AND schema_name = '{schema}' "
+            f"AND table_name = '{table_name}'")[0] > 0
+
+    def create_table_like(self, table, destination, temporary=False):
+        pass
+
+    def truncate(self, table):
+        if self.has_table(table):
+            self.execute(f"DELETE FROM {table}")
+
+    def write_chunk(self, df, table):
+        self.ctx.register("upload_chunk", df)
+        try:
+            create_duckdb_table(self.ctx, table, "upload_chunk")
+            self.execute(f"INSERT INTO {table} BY NAME "
+                         "SELECT * FROM upload_chunk")
+        finally:
+            self.ctx.unregister("upload_chunk")
+        return len(df)
+
+    #Merged with an UPDATE of the changed rows followed by an INSERT of new rows
+    def merge(self, stage, destination, columns):
+        create_duckdb_table(self.ctx, destination, stage)
+        update_cols = [col for col in columns if col != "ROW_KEY"]
+
+        self.execute(f'DELETE FROM {destination} WHERE "ROW_KEY" IS NULL')
+        set_cols = ", ".join(f'"{col}" = s."{col}"' for col in update_cols)
+        nupdated = self.fetchone(
+            f"UPDATE {destination} AS t SET {set_cols} FROM {stage} AS s "
+            f'WHERE t."ROW_KEY" = s."ROW_KEY" '
+            f'AND (t."ROW_HASH" IS NULL OR t."ROW_HASH" <> s."ROW_HASH")')[0]
+
+        ninserted = self.fetchone(
+            f"INSERT INTO {destination} ({quote_columns(columns)}) "
+            f"SELECT {quote_columns(columns, prefix='s.')} FROM {stage} s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {destination} t "
+            f'WHERE t."ROW_KEY" = s."ROW_KEY")')[0]
+
+        return ninserted, nupdated
+
+    #Readers keep seeing the previous rows until the transaction commits, so
+    #the rows of the shadow table are copied in place of the destination's
+    def swap(self, shadow, destination):
+        create_duckdb_table(self.ctx, destination, shadow)
+        self.execute(f"DELETE FROM {destination}")
+        self.execute(f"INSERT INTO {destination} BY NAME SELECT * FROM {shadow}")
+
+    def drop(self, table):
+        self.execute(f"DROP TABLE IF EXISTS {table}")
+
+class SQLAlchemySink:
+
+    """
+    Sink for a local database through a SQLAlchemy engine. Statements run in
+    the open transaction (see transaction) or else in their own.
+    """
+
+    transactional_writes = True
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.con = None
+
+    @contextmanager
+    def transaction(self):
+        with self.engine.begin() as con:
+            self.con = con
+            try:
+                yield
+            finally:
+                self.con = None
+
+    @contextmanager
+    def connect(self):
+        if self.con is not None:
+            yield self.con
+        else:
+            with self.engine.begin() as con:
+                yield con
+
+    def execute(self, sql):
+        with self.connect() as con:
+            return con.execute(text(sql))
+
+    def fetchone(self, sql):
+        with self.connect() as con:
+            return con.execute(text(sql)).fetchone()
+
+    def execute_count(self, sql):
+        return self.execute(sql).rowcount
+
+    def has_table(self, table):
+        table_name, schema = split_destination(table)
+        with self.connect() as con:
+            return inspect(con).has_table(table_name, schema=schema)
+
+    #Created with the columns (and types) of the destination if it exists,
+    #otherwise from the first chunk written
+    def create_table_like(self, table, destination, temporary=False):
+        if self.has_table(destination):
+            self.execute(f"CREATE TABLE {table} AS "
+                         f"SELECT * FROM {destination} WHERE 1 = 0")
+
+    def truncate(self, table):
+        if self.has_table(table):
+            self.execute(f"DELETE FROM {table}")
+
+    def write_chunk(self, df, table):
+        table_name, schema = split_destination(table)
+        with self.connect() as con:
+            df.to_sql(table_name, con, schema=schema, index=False,
+                      if_exists="append")
+        return len(df)
+
+    #Not every database supports MERGE, so this is done as an UPDATE of the
+    #changed rows followed by an INSERT of new rows
+    def merge(self, stage, destination, columns):
+        update_cols = [col for col in columns if col != "ROW_KEY"]
+
+        self.execute(f'DELETE FROM {destination} WHERE "ROW_KEY" IS NULL')
+        match = f'{stage}."ROW_KEY" = {destination}."ROW_KEY"'
+        set_cols = ", ".join(
+            f'"{col}" = (SELECT {stage}."{col}" FROM {stage} WHERE {match})'
+            for col in update_cols)
+        nupdated = self.execute(
+            f"UPDATE {destination} SET {set_cols} "
+            f"WHERE EXISTS (SELECT 1 FROM {stage} WHERE {match} "
+            f'AND ({destination}."ROW_HASH" IS NULL '
+            f'OR {destination}."ROW_HASH" <> {stage}."ROW_HASH"))').rowcount
+
+        ninserted = self.execute(
+            f"INSERT INTO {destination} ({quote_columns(columns)}) "
+            f"SELECT {quote_columns(columns)} FROM {stage} "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {destination} WHERE {match})"
+        ).rowcount
+
+        return ninserted, nupdated
+
+    #There is no SWAP command, so the tables are renamed instead
+    def swap(self, shadow, destination):
+        destination_table, _ = split_destination(destination)
+        old_table, _ = split_destination(get_work_table(destination, "OLD"))
+
+        exists = self.has_table(destination)
+        if exists:
+            self.execute(f"ALTER TABLE {destination} RENAME TO {old_table}")
+        self.execute(f"ALTER TABLE {shadow} RENAME TO {destination_table}")
+        if exists:
+            _, schema = split_destination(destination)
+            self.drop(f"{schema}.{old_table}" if schema else old_table)
+
+    def drop(self, table):
+        self.execute(f"DROP TABLE IF EXISTS {table}")
+
+class SnowflakeSink:
+
+    """
+    Sink for a Snowflake connection. The chunks are written with the given
+    loader (see write_df). Writing a chunk creates a stage (and DDL commits
+    the open transaction), so writes can't be rolled back.
+    """
+
+    transactional_writes = False
+
+    def __init__(self, ctx, loader="write_pandas", chunk_rows=None):
+        self.ctx = ctx
+        self.loader = loader
+        self.chunk_rows = chunk_rows
+
+    @contextmanager
+    def transaction(self):
+        self.execute("BEGIN")
+        try:
+            yield
+            self.execute("COMMIT")
+        except BaseException:
+            self.execute("ROLLBACK")
+            raise
+
+    def execute(self, sql):
+        cur = self.ctx.cursor()
+        try:
+            cur.execute(sql)
+        finally:
+            cur.close()
+
+    def fetchone(self, sql):
+        cur = self.ctx.cursor()
+        try:
+            cur.execute(sql)
+            return cur.fetchone()
+        finally:
+            cur.close()
+
+    def execute_count(self, sql):
+        return self.fetchone(sql)[0]
+
+    #Temporary tables only last for the session and permanent ones keep the
+    #grants of the destination (so they can be swapped in)
+    def create_table_like(self, table, destination, temporary=False):
+        if temporary:
+            self.execute(f"CREATE OR REPLACE TEMPORARY TABLE {table} "
+                         f"LIKE {destination}")
+        else:
+            self.execute(f"CREATE OR REPLACE TABLE {table} "
+                         f"LIKE {destination} COPY GRANTS")
+
+    def truncate(self, table):
+        self.execute(f"TRUNCATE TABLE {table}")
+
+    def write_chunk(self, df, table):
+        return write_df(self.ctx, df, table, loader=self.loader,
+                        chunk_rows=self.chunk_rows)
+
+    def merge(self, stage, destination, columns):
+        update_cols = [col for col in columns if col != "ROW_KEY"]
+
+        self.execute(f'DELETE FROM {destination} WHERE "ROW_KEY" IS NULL')
+        set_cols = ", ".join(f'"{col}" = s."{col}"' for col in update_cols)
+        return self.fetchone(
+            f"MERGE INTO {destination} t USING {stage} s "
+            f'ON t."ROW_KEY" = s."ROW_KEY" '
+            f'WHEN MATCHED AND (t."ROW_HASH" IS NULL OR t."ROW_HASH" <> s."ROW_HASH") '
+            f"THEN UPDATE SET {set_cols} "
+            f"WHEN NOT MATCHED THEN INSERT ({quote_columns(columns)}) "
+            f"VALUES ({quote_columns(columns, prefix='s.')})")[:2]
+
+    def swap(self, shadow, destination):
+        self.execute(f"ALTER TABLE {destination} SWAP WITH {shadow}")
+
+    def drop(self, table):
+        self.execute(f"DROP TABLE IF EXISTS {table}")
+
+#Get the sink for a connection (see upload_df for the loader and chunk_rows)
+def get_sink(ctx, loader="write_pandas", chunk_rows=None):
+    if is_duckdb(ctx):
+        return DuckDBSink(ctx)
+    if is_sqlalchemy(ctx):
+        return SQLAlchemySink(ctx)
+    return SnowflakeSink(ctx, loader=loader, chunk_rows=chunk_rows)
+
+#Load modes######################################################################
+
+#Write the chunks to a staging or shadow table (created like the destination),
+#returning the number of rows written and the columns of the chunks (None if
+#there were no chunks)
+def stage_chunks(sink, chunks, table, destination, temporary=False):
+    sink.create_table_like(table, destination, temporary=temporary)
+
+    nrows = 0
+    columns = None
+    for df in chunks:
+        nrows += sink.write_chunk(df, table)
+        columns = columns or list(df.columns)
+
+    return nrows, columns
+
+def merge_df(sink, chunks, destination, scope_cols=None):
+
+    """
+    Function to merge data into a table. The data is staged in a temporary
+    table and only new rows (by ROW_KEY) are inserted and only changed rows
+    (by ROW_HASH) are updated. Rows without a ROW_KEY (loaded by the replace
+    or append modes) are removed first, so the first merge into a table
+    loaded by another mode replaces its rows instead of duplicating them.
+    Rows missing from the upload are kept unless scope_cols is given.
+
+    inputs:
+    - sink: Sink of the database (see get_sink)
+    - chunks: List (or generator) of dataframes, each with the ROW_KEY and 
+    ROW_HASH columns. The chunks are staged one at a time
+    - destination: Full table name of the destination
+    (e.g. DATABASE_NAME.SCHEMA_NAME.TABLE_NAME)
+    - scope_cols: List of columns that scope the upload (e.g. the diagnosis
+    window of a publication). Rows of the destination missing from the upload 
+    (by ROW_KEY) are deleted if their values of these columns are in the 
+    upload, or whatever their values are if the list is empty
+
+    output:
+    Returns a tuple of the number of rows inserted, updated and deleted (None
+    if scope_cols isn't given)
+    """
+
+    stage = get_work_table(destination, "STAGE")
+    ndeleted = None
 
     try:
-        if replace:
-            cur.execute(f"TRUNCATE TABLE {destination}")
-
-        # Upload DataFrame
-        success, nchunks, nrows, _ = write_pandas(
-            conn=ctx,
-            df=df,
-            table_name=destination_segs[2],
-            schema=destination_segs[1],
-            database=destination_segs[0],
-            overwrite=False
-        )
-
-        if not success:
-            raise Exception("Failed to write DataFrame to Snowflake.")
+        _, columns = stage_chunks(sink, chunks, stage, destination, 
+                                  temporary=True)
+        if columns is None:
+            return 0, 0, ndeleted
 
-        print(f"Uploaded {nrows} rows to {destination}")
-    except Exception as e:
-        print("Data ingestion failed with error:", e)
-        cur.execute("ROLLBACK") #Undoes truncation on upload error
+        #Merge (removing the rows without a key) then delete the rows missing 
+        #from the upload in one transaction
+        with sink.transaction():
+            ninserted, nupdated = sink.merge(stage, destination, columns)
 
+            if scope_cols is not None:
+                delete_sql = (f'DELETE FROM {destination} WHERE "ROW_KEY" '
+                              f'NOT IN (SELECT "ROW_KEY" FROM {stage})')
+                if scope_cols:
+                    delete_sql += (f" AND ({quote_columns(scope_cols)}) IN "
+                                   f"(SELECT {quote_columns(scope_cols)} "
+                                   f"FROM {stage})")
+                ndeleted = sink.execute_count(delete_sql)
     finally:
-        cur.close()
+        sink.drop(stage)
+
+    return ninserted, nupdated, ndeleted
+
+#Check the shadow table before it is swapped in
+#Raises an exception if the row count doesn't match the upload or (if the
+#ROW_KEY column is available) if any key appears more than once
+def validate_shadow(nrows, nkeys, expected_rows):
+    if nrows != expected_rows:
+        raise Exception(f"Shadow table has {nrows} rows but {expected_rows} "
+                        "were uploaded.")
     
-    return success
\ No newline at end of file
+    if nkeys is not None and nkeys != nrows:
+        raise Exception(f"Shadow table has {nrows - nkeys} rows with a "
+                        "duplicate key.")
+
+def swap_df(sink, chunks, destination):
+
+    """
+    Function to replace the contents of a table without readers ever seeing an
+    empty or partially loaded table. The data is written to a shadow table,
+    validated, then swapped with the destination in one step.
+
+    inputs:
+    - sink: Sink of the database (see get_sink)
+    - chunks: List (or generator) of dataframes. The chunks are appended to
+    the shadow table one at a time
+    - destination: Full table name of the destination
+    (e.g. DATABASE_NAME.SCHEMA_NAME.TABLE_NAME)
+
+    output:
+    Returns the number of rows loaded
+    """
+
+    shadow = get_work_table(destination, "SHADOW")
+
+    try:
+        expected_rows, columns = stage_chunks(sink, chunks, shadow, 
+                                              destination)
+
+        #Nothing was loaded but the table is still emptied
+        if columns is None:
+            with sink.transaction():
+                sink.truncate(destination)
+            return 0
+
+        #Only check the keys are unique if the row hashes were added
+        count_keys = ('COUNT(DISTINCT "ROW_KEY")' if "ROW_KEY" in columns
+                      else "NULL")
+        nrows, nkeys = sink.fetchone(
+            f"SELECT COUNT(*), {count_keys} FROM {shadow}")
+        validate_shadow(nrows, nkeys, expected_rows)
+
+        with sink.transaction():
+            sink.swap(shadow, destination)
+    finally:
+        #After a swap this holds the previous data
+        sink.drop(shadow)
+
+    return nrows
+
+#Append the chunks to a table (emptying it first if clear is True) in one
+#transaction, returning the number of rows appended
+#If the sink can't roll back its writes (Snowflake), a replace is loaded as a
+#swap and an append is staged then inserted in one statement, so the
+#destination is unchanged if any chunk fails
+def append_df(sink, chunks, destination, clear=False):
+    if not sink.transactional_writes:
+        if clear:
+            return swap_df(sink, chunks, destination)
+
+        stage = get_work_table(destination, "STAGE")
+        try:
+            nrows, columns = stage_chunks(sink, chunks, stage, destination,
+                                          temporary=True)
+            if columns is not None:
+                sink.execute(
+                    f"INSERT INTO {destination} ({quote_columns(columns)}) "
+                    f"SELECT {quote_columns(columns)} FROM {stage}")
+        finally:
+            sink.drop(stage)
+
+        return nrows
+
+    nrows = 0
+    with sink.transaction():
+        if clear:
+            sink.truncate(destination)
+        for df in chunks:
+            nrows += sink.write_chunk(df, destination)
+
+    return nrows
+
+def upload_df(ctx, df, destination, replace=True, key_cols=None, mode=None,
+              loader="write_pandas", chunk_rows=None, scope_cols=None):
+
+    """
+    Function to upload a dataframe to Snowflake (or a local database through
+    SQLAlchemy).
+
+    inputs:
+    - ctx: Snowflake connection object
+    (https://docs.snowflake.com/en/developer-guide/python-connector/python-connector-connect),
+    a SQLAlchemy engine or a local DuckDB connection (see connect_local)
+    - df: Dataframe object, or a list (or generator) of dataframes to upload
+    in chunks (e.g. from pipeline_util.iter_pipeline) so only one chunk is
+    held in memory at a time
+    - destination: Full table name of the destination
+    (e.g. DATABASE_NAME.SCHEMA_NAME.TABLE_NAME)
+    - replace: If True, the destination is TRUNCATED before uploading new data
+    (If the upload fails, the destination is left unchanged)
+    - key_cols: List of columns that identify a unique row. For the merge and
+    swap modes, the ROW_KEY and ROW_HASH columns are added to the upload (the
+    other modes upload the columns of the dataframe unchanged)
+    - mode: How to load the data (overrides replace if given):
+        - "replace": Truncate the destination and upload all rows (on
+        Snowflake the rows are loaded into a shadow table that is swapped in)
+        - "append": Upload all rows without truncating (on Snowflake the rows
+        are staged and inserted once every chunk is written)
+        - "merge": Insert new rows and update changed rows (needs key_cols)
+        - "swap": Load into a shadow table and swap it with the destination
+        (the destination is left unchanged if the load or validation fails)
+    - loader: How to write the data to Snowflake:
+        - "write_pandas": Use write_pandas
+        - "copy": Write typed Parquet files, PUT them to the table stage and 
+        load them with COPY INTO (lower peak memory for large uploads)
+    - chunk_rows: Rows per chunk/file uploaded (the loader's default if None)
+    - scope_cols: For the merge mode, list of columns that scope the upload
+    (see merge_df). If None, rows missing from the upload are kept
+
+    output:
+    Returns Boolean value if the upload was successful
+    """
+
+    if mode is None:
+        mode = "replace" if replace else "append"
+
+    if mode == "merge" and not key_cols:
+        raise ValueError("key_cols must be given to merge into a table.")
+
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+
+    #Only the merge and swap modes use the row hashes
+    if key_cols and mode in ["merge", "swap"]:
+        chunks = (add_row_hashes(chunk, key_cols) for chunk in chunks)
+
+    with telemetry.stage("upload", destination=destination, mode=mode,
+                         loader=loader, backend=get_backend(ctx)) as span:
+        success = load_chunks(ctx, telemetry.count_rows(chunks, span), 
+                              destination, mode=mode, loader=loader, 
+                              chunk_rows=chunk_rows, scope_cols=scope_cols)
+        span["success"] = success
+
+    return success
+
+#Load the chunks into the destination with the given mode and loader (see
+#upload_df), returning Boolean value if the load was successful
+#A ValidationError raised by the chunks (see validation_util.validate_chunks)
+#is raised once the load is rolled back, so the run stops with its summary
+def load_chunks(ctx, chunks, destination, mode="replace", 
+                loader="write_pandas", chunk_rows=None, scope_cols=None):
+    sink = get_sink(ctx, loader=loader, chunk_rows=chunk_rows)
+
+    try:
+        if mode == "merge":
+            ninserted, nupdated, ndeleted = merge_df(
+                sink, chunks, destination, scope_cols=scope_cols)
+        elif mode == "swap":
+            nrows = swap_df(sink, chunks, destination)
+        else:
+            nrows = append_df(sink, chunks, destination, 
+                              clear=(mode == "replace"))
+    except validation.ValidationError:
+        raise
+    except Exception as e:
+        print("Data ingestion failed with error:", e)
+        return False
+
+    if mode == "merge":
+        print(f"Inserted {ninserted} and updated {nupdated} rows in {destination}")
+        if ndeleted is not None:
+            print(f"Deleted {ndeleted} rows missing from the upload from "
+                  f"{destination}")
+    else:
+        print(f"Uploaded {nrows} rows to {destination}")
+    return True
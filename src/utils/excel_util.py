@@ -0,0 +1,288 @@
+#Functions for reading the NHSD data workbooks
+
+#Import packages
+import os
+from io import BytesIO
+
+import pandas as pd
+from openpyxl import load_workbook
+from pandas.io.parsers import TextParser
+
+import utils.cache_util as cache
+import utils.telemetry_util as telemetry
+import utils.validation_util as validation
+
+#Workbooks are opened once (in read-only/streaming mode) and each parsed sheet
+#is kept so every function in main.py that needs a sheet shares one parse.
+#Parsed sheets are also stored in the persistent cache (see cache_util.py) so
+#unchanged workbooks are not parsed again on later runs.
+#Sheets read in chunks (iter_sheet) are not kept so memory use is bounded.
+_workbooks = {}
+_sheets = {}
+
+def open_workbook(data_file):
+
+    """
+    Function to open a workbook in read-only mode, reusing an open workbook if
+    the file has already been opened. Workbooks held in memory (see
+    cache_util.add_memory_file) are read from memory instead of the disk.
+
+    inputs:
+    - data_file: Path to the Excel workbook
+
+    output:
+    Returns the openpyxl workbook object
+    """
+
+    if data_file not in _workbooks:
+        content = cache.get_memory_file(data_file)
+        source = data_file if content is None else BytesIO(content)
+        _workbooks[data_file] = load_workbook(
+            source, read_only=True, data_only=True, keep_links=False)
+
+    return _workbooks[data_file]
+
+#Convert columns to compact dtypes: the given columns to categoricals and any
+#integer columns to the smallest integer type that fits
+#(Float columns are kept as float64 so no precision is lost)
+def compact_dtypes(df, categories):
+    for col in categories:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    for col in df.select_dtypes("integer").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+
+    return df
+
+#Iterate the rows of a sheet after skiprows
+#Returns the header and a generator of the data rows. Only the usecols columns
+#(all if None) and the rows matching row_filter (see read_sheet) are returned
+#and trailing empty cells are trimmed (as pd.read_excel does)
+def iter_rows(data_file, sheet_name, skiprows=0, nrows=None, usecols=None,
+              row_filter=None):
+    ws = open_workbook(data_file)[sheet_name]
+    #The dimensions stored in the file are not always reliable
+    ws.reset_dimensions()
+
+    #Read the header row plus the requested number of data rows
+    max_row = skiprows + 1 + nrows if nrows is not None else None
+    rows = ws.iter_rows(min_row=skiprows + 1, max_row=max_row,
+                        values_only=True)
+
+    header = list(next(rows, ()))
+    while header and header[-1] is None:
+        header.pop()
+
+    #Without the row filter columns every row would be read, so stop here
+    #(an empty sheet has no header to check)
+    if header:
+        check_header(data_file, sheet_name, skiprows, header, 
+                     list(row_filter or {}), list(usecols or []))
+
+    #Get the positions of the columns to filter on and the columns to read
+    filters = [(header.index(col), set(values)) 
+               for col, values in (row_filter or {}).items()
+               if col in header]
+
+    col_idx = None
+    if usecols is not None:
+        col_idx = [i for i, col in enumerate(header) if col in usecols]
+        header = [header[i] for i in col_idx]
+
+    def data_rows():
+        for row in rows:
+            #Skip rows that don't match the filter
+            if filters and not any(i < len(row) and row[i] in values
+                                   for i, values in filters):
+                continue
+
+            if col_idx is not None:
+                row = [row[i] if i < len(row) else None for i in col_idx]
+            else:
+                row = list(row)
+
+            while row and row[-1] is None:
+                row.pop()
+            yield row
+
+    return header, data_rows()
+
+#Find the header of a sheet (the first row containing every one of columns)
+#in its first max_rows rows
+#Returns the number of rows before the header (i.e. skiprows) or None if it
+#isn't found
+def find_header_row(data_file, sheet_name, columns, max_rows=50):
+    ws = open_workbook(data_file)[sheet_name]
+    for skiprows, row in enumerate(ws.iter_rows(max_row=max_rows, 
+                                                values_only=True)):
+        if set(columns) <= set(row):
+            return skiprows
+
+    return None
+
+#Check the header of a sheet (after skiprows) has every one of the required 
+#columns. If not, a ValidationError is raised saying where a header with all
+#the required and expected columns was found (if anywhere)
+def check_header(data_file, sheet_name, skiprows, header, required, 
+                 expected=()):
+    missing = [col for col in required if col not in header]
+    if not missing:
+        return
+
+    header_row = find_header_row(data_file, sheet_name, 
+                                 set(required) | set(expected))
+    if header_row is None:
+        location = "No row in the sheet has all the columns"
+    else:
+        location = f"The header was found after {header_row} rows"
+
+    validation.raise_problems(
+        f"{os.path.basename(data_file)} ({sheet_name})",
+        [f"Missing columns {missing} in the header after {skiprows} rows. "
+         + location])
+
+#Parse a header and list of rows into a dataframe
+#Uses the same parser as pd.read_excel so dtypes match
+def parse_rows(header, rows, categories=None):
+    #Pad the rows so each has the same width
+    data = [header] + rows
+    width = max((len(row) for row in data), default=0)
+    data = [row + [None] * (width - len(row)) for row in data]
+
+    with TextParser(data, header=0) as parser:
+        df = parser.read()
+
+    if categories is not None:
+        df = compact_dtypes(df, categories)
+
+    return df
+
+def read_sheet(data_file, sheet_name, skiprows=0, nrows=None, categories=None,
+               usecols=None, row_filter=None, use_cache=True):
+
+    """
+    Function to read a sheet from a workbook into a dataframe. Only the rows
+    after skiprows are read and the result is cached for later calls.
+    If use_cache is True, the persistent cache is checked before the workbook
+    is opened.
+
+    inputs:
+    - data_file: Path to the Excel workbook
+    - sheet_name: Name of the sheet to read
+    - skiprows: How many lines in the sheet before the tabular data begins
+    - nrows: Number of data rows to read (all rows if None)
+    - categories: Columns to read as categoricals. If given, integer columns
+    are also downcast (see compact_dtypes)
+    - usecols: Columns to read (all columns if None). Other columns are 
+    skipped as the rows are read so they are never stored
+    - row_filter: Dict of column: list of values. If given, only rows where
+    any of the columns has one of its values are read (e.g. 
+    {"Geography type": ["Cancer Alliance"], "Geography code": ["E92000001"]})
+    - use_cache: If True, the persistent cache is used
+
+    output:
+    Returns a dataframe of the sheet (a copy, so it can be safely modified)
+    """
+
+    #Options that change the result (used to identify it in the caches)
+    options = {
+        "skiprows": skiprows,
+        "nrows": nrows,
+        "categories": None if categories is None else list(categories),
+        "usecols": None if usecols is None else sorted(usecols),
+        "row_filter": None if row_filter is None else
+            {col: sorted(values) for col, values in sorted(row_filter.items())}
+    }
+    key = (data_file, sheet_name, repr(options))
+
+    #Workbooks only held in memory are not written to the persistent cache
+    if (use_cache and cache.get_memory_file(data_file) is not None 
+        and not os.path.isfile(data_file)):
+        use_cache = False
+
+    with telemetry.stage("read_sheet", data_file=data_file, 
+                         sheet_name=sheet_name) as span:
+        span["source"] = "memory" if key in _sheets else "workbook"
+
+        if key not in _sheets and use_cache:
+            df = cache.load_frame(data_file, sheet_name, options)
+            if df is not None:
+                _sheets[key] = df
+                span["source"] = "cache"
+
+        if key not in _sheets:
+            header, rows = iter_rows(data_file, sheet_name, skiprows=skiprows,
+                                     nrows=nrows, usecols=usecols, 
+                                     row_filter=row_filter)
+
+            #Trim trailing empty rows (as pd.read_excel does)
+            data = []
+            last_row = 0
+            for row in rows:
+                data.append(row)
+                if row:
+                    last_row = len(data)
+            data = data[:last_row]
+
+            df = parse_rows(header, data, categories)
+            del data
+            _sheets[key] = df
+
+            if use_cache:
+                cache.save_frame(df, data_file, sheet_name, options)
+
+        span["rows_out"] = len(_sheets[key])
+        span["bytes"] = telemetry.frame_bytes(_sheets[key])
+
+        return _sheets[key].copy()
+
+def iter_sheet(data_file, sheet_name, skiprows=0, chunk_rows=100000,
+               categories=None, usecols=None, row_filter=None):
+
+    """
+    Function to read a sheet from a workbook in chunks, so only chunk_rows
+    rows are held in memory at once. The chunks are not kept or cached.
+
+    inputs:
+    - data_file: Path to the Excel workbook
+    - sheet_name: Name of the sheet to read
+    - skiprows: How many lines in the sheet before the tabular data begins
+    - chunk_rows: Maximum number of rows in each chunk (after filtering)
+    - categories: Columns to read as categoricals (see read_sheet)
+    - usecols: Columns to read (see read_sheet)
+    - row_filter: Rows to read (see read_sheet)
+
+    output:
+    Yields a dataframe for each chunk (at least one, which may be empty)
+    """
+
+    header, rows = iter_rows(data_file, sheet_name, skiprows=skiprows,
+                             usecols=usecols, row_filter=row_filter)
+
+    chunk = []
+    nchunks = 0
+    nempty = 0
+    for row in rows:
+        #Empty rows are only kept if there are rows after them
+        if not row:
+            nempty += 1
+            continue
+        chunk += [[] for _ in range(nempty)]
+        nempty = 0
+
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield parse_rows(header, chunk, categories)
+            nchunks += 1
+            chunk = []
+
+    if chunk or nchunks == 0:
+        yield parse_rows(header, chunk, categories)
+
+#Close all open workbooks and clear the parsed sheets
+def close_workbooks():
+    for wb in _workbooks.values():
+        wb.close()
+    _workbooks.clear()
+    _sheets.clear()
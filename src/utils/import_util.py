@@ -0,0 +1,71 @@
+#Functions for importing packages lazily
+#
+#Packages like pandas and the Snowflake connector take a long time to import.
+#A lazily imported module is only loaded the first time one of its attributes
+#is used, so commands that don't need it (e.g. main.py check) start quickly.
+#
+#LazyLoader is not thread safe before Python 3.13 (a thread can see a module
+#that another thread is still loading), so load_lazy_modules must be called on
+#the main thread before starting a thread pool that uses a lazy module.
+
+#Import packages
+import importlib.util
+import sys
+import types
+
+#Modules imported by lazy_import that may not have been loaded yet
+_lazy_modules = []
+
+#Stands in for a module that is not installed, raising the ModuleNotFoundError
+#when one of its attributes is first used (so only the commands that use the
+#module need it installed)
+class MissingModule(types.ModuleType):
+    def __init__(self, name, error):
+        super().__init__(name)
+        self.__error = error
+
+    def __getattr__(self, attr):
+        raise ModuleNotFoundError(str(self.__error), name=self.__error.name)
+
+def lazy_import(name):
+
+    """
+    Function to import a module lazily (see importlib.util.LazyLoader).
+
+    inputs:
+    - name: Full name of the module (e.g. "utils.database_util")
+
+    output:
+    Returns the module. If it has not already been imported, it is loaded
+    when one of its attributes is first used. If it is not installed, a
+    MissingModule is returned instead (raising a ModuleNotFoundError when one
+    of its attributes is used)
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    #find_spec imports the parent packages (e.g. snowflake for 
+    #snowflake.connector) so raises if they are missing
+    try:
+        spec = importlib.util.find_spec(name)
+    except ModuleNotFoundError as e:
+        return MissingModule(name, e)
+    if spec is None:
+        return MissingModule(name, ModuleNotFoundError(
+            f"No module named '{name}'", name=name))
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    _lazy_modules.append(module)
+
+    return module
+
+#Finish loading every module imported by lazy_import (using any attribute of a
+#lazy module loads it)
+def load_lazy_modules():
+    while _lazy_modules:
+        getattr(_lazy_modules.pop(0), "__dict__")
@@ -0,0 +1,14 @@
+#Paths of the directories used by the ETL
+#
+#Every path is relative to the root of the repository (not the working
+#directory), so the scripts can be run from any directory.
+
+#Import packages
+import os
+
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+data_dir = os.path.join(root_dir, "data")
+docs_dir = os.path.join(root_dir, "docs")
+output_dir = os.path.join(root_dir, "output")
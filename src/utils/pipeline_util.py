@@ -0,0 +1,189 @@
+#Functions for running declarative transform pipelines
+#
+#Each table is described by a pipeline spec (a dict) instead of a chain of
+#pandas steps. The spec is planned before the sheet is read so that:
+# - The row filter and the columns needed are pushed down to read time, so
+#   rows and columns that are never used are not stored
+# - Steps that only add columns which are never used are skipped
+# - The column renames (column_map, formatting and the final rename) are fused
+#   into a single projection at the end
+#
+#A spec has the following keys:
+# - sheet_name, skiprows, categories: How to read the sheet (see read_sheet)
+# - row_filter: Function of the context returning the row filter (optional)
+# - steps: List of {"func", "uses", "adds"} dicts. Each func takes and returns
+#   (df, context) -> df. "uses" lists the columns it reads and "adds" the
+#   columns it creates (steps without "adds" are always run)
+# - keep: Columns to keep (after the steps and unpivot)
+# - unpivot: {"value_cols", "value_names", "var_name", "value_name"} (optional)
+# - column_map: Renames applied before the column names are formatted
+# - rename: Final column names (formatted name -> destination column)
+
+import utils.excel_util as excel
+import utils.telemetry_util as telemetry
+
+#Format a column name (e.g. "Geography code" => "geography_code")
+def format_column_name(col):
+    return col.replace("\n", " ").strip().replace(" ", "_").lower()
+
+def plan_pipeline(spec):
+
+    """
+    Function to plan a pipeline spec.
+
+    inputs:
+    - spec: Pipeline spec (see the top of this file)
+
+    output:
+    Returns a dict of the steps to run, the columns to read (usecols) and
+    the final projection (source column -> destination column, in the order
+    of the final rename)
+    """
+
+    column_map = spec.get("column_map", {})
+    rename = spec["rename"]
+
+    #Fuse column_map, formatting and the final rename into one mapping
+    destinations = {}
+    for col in spec["keep"]:
+        name = format_column_name(column_map.get(col, col))
+        if name in rename:
+            destinations[name] = col
+    columns = {destinations[name]: rename[name]
+               for name in rename if name in destinations}
+
+    #Work back from the final columns to find the columns each step needs
+    needed = set(columns)
+
+    unpivot = spec.get("unpivot")
+    if unpivot:
+        needed -= {unpivot["var_name"], unpivot["value_name"]}
+        needed |= set(unpivot["value_cols"])
+
+    steps = []
+    for step in reversed(spec.get("steps", [])):
+        adds = set(step.get("adds", []))
+        #Skip steps whose columns are never used
+        if adds and not adds & needed:
+            continue
+        steps.insert(0, step)
+        needed = (needed - adds) | set(step.get("uses", []))
+
+    return {"steps": steps, "usecols": needed, "columns": columns}
+
+#Check the columns read from a sheet include every column the plan needs. If
+#not, the header is not where the spec expects it (or the columns have been
+#renamed), so a ValidationError is raised saying where the header was found
+def check_header(spec, plan, row_filter, columns, data_file):
+    excel.check_header(data_file, spec["sheet_name"], spec.get("skiprows", 0),
+                       list(columns), sorted(plan["usecols"]), 
+                       list(row_filter or {}))
+
+#Run the planned steps, unpivot and final projection on a dataframe
+#Each step is recorded as a transform_step span (see telemetry_util.py)
+def apply_pipeline(spec, plan, df, context, compact_dtypes=True):
+    for step in plan["steps"]:
+        with telemetry.stage("transform_step", step=step["func"].__name__,
+                             sheet_name=spec["sheet_name"]) as span:
+            span["rows_in"] = len(df)
+            df = step["func"](df, context)
+            span["rows_out"] = len(df)
+
+    unpivot = spec.get("unpivot")
+    if unpivot:
+        value_cols = unpivot["value_cols"]
+        id_cols = [col for col in plan["columns"]
+                   if col not in (unpivot["var_name"], unpivot["value_name"])]
+        df = df[id_cols + value_cols]
+
+        #Format metric names before unpivoting so it only runs once each
+        if unpivot.get("value_names"):
+            df = df.rename(columns={col: unpivot["value_names"](col)
+                                    for col in value_cols})
+
+        with telemetry.stage("transform_step", step="unpivot",
+                             sheet_name=spec["sheet_name"]) as span:
+            span["rows_in"] = len(df)
+            df = df.melt(id_vars=id_cols, var_name=unpivot["var_name"],
+                         value_name=unpivot["value_name"])
+
+            if compact_dtypes:
+                df[unpivot["var_name"]] = (
+                    df[unpivot["var_name"]].astype("category"))
+            span["rows_out"] = len(df)
+
+    #Select and rename the final columns in one pass
+    return df[list(plan["columns"])].rename(columns=plan["columns"])
+
+def run_pipeline(spec, data_file, context, compact_dtypes=True):
+
+    """
+    Function to run a pipeline spec against a data file.
+
+    inputs:
+    - spec: Pipeline spec (see the top of this file)
+    - data_file: Path to the Excel workbook
+    - context: Dict passed to the steps and row_filter (e.g. the data file
+    and target geographies)
+    - compact_dtypes: If True, the spec categories are read as categoricals
+
+    output:
+    Returns the transformed dataframe with the destination column names
+    """
+
+    with telemetry.stage("transform", data_file=data_file, 
+                         sheet_name=spec["sheet_name"]) as span:
+        plan = plan_pipeline(spec)
+
+        row_filter = None
+        if spec.get("row_filter"):
+            row_filter = spec["row_filter"](context)
+
+        #Extract data (only the rows and columns needed)
+        df = excel.read_sheet(
+            data_file, spec["sheet_name"], skiprows=spec.get("skiprows", 0),
+            categories=spec.get("categories") if compact_dtypes else None,
+            usecols=plan["usecols"], row_filter=row_filter)
+        check_header(spec, plan, row_filter, df.columns, data_file)
+
+        df = apply_pipeline(spec, plan, df, context, compact_dtypes)
+        span["rows_out"] = len(df)
+        span["bytes"] = telemetry.frame_bytes(df)
+
+        return df
+
+def iter_pipeline(spec, data_file, context, chunk_rows=100000,
+                  compact_dtypes=True):
+
+    """
+    Function to run a pipeline spec against a data file in chunks, so memory
+    use depends on chunk_rows rather than the size of the sheet. Every step
+    must only depend on the rows in its own chunk.
+
+    inputs:
+    - spec: Pipeline spec (see the top of this file)
+    - data_file: Path to the Excel workbook
+    - context: Dict passed to the steps and row_filter
+    - chunk_rows: Maximum number of rows read into each chunk (after the row
+    filter, so chunks can grow if the steps add rows)
+    - compact_dtypes: If True, the spec categories are read as categoricals
+
+    output:
+    Yields the transformed dataframe of each chunk
+    """
+
+    plan = plan_pipeline(spec)
+
+    row_filter = None
+    if spec.get("row_filter"):
+        row_filter = spec["row_filter"](context)
+
+    chunks = excel.iter_sheet(
+        data_file, spec["sheet_name"], skiprows=spec.get("skiprows", 0),
+        chunk_rows=chunk_rows,
+        categories=spec.get("categories") if compact_dtypes else None,
+        usecols=plan["usecols"], row_filter=row_filter)
+
+    for df in chunks:
+        check_header(spec, plan, row_filter, df.columns, data_file)
+        yield apply_pipeline(spec, plan, df, context, compact_dtypes)
@@ -1,11 +1,22 @@
+import atexit
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
 import requests
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
-import pandas as pd
-from io import BytesIO
-from zipfile import ZipFile
 from datetime import datetime
 
+import utils.cache_util as cache
+import utils.path_util as paths
+import utils.telemetry_util as telemetry
+
 #To explain the terminalogy in this script:
 #The NHSD website is made up of "publications" which contain "pages" 
 #which contain "file_links" which contain "files".
@@ -14,20 +25,144 @@ from datetime import datetime
 #"File Links" are the url links on pages that contain the data files
 #"Files" refers to the target data itself
 
+#All requests go through one pooled session so connections are kept alive and
+#reused, with retries and backoff for transient server errors
+max_workers = 4     #Number of pages/files fetched at the same time
+chunk_size = 1024 * 1024    #Size of the blocks files are streamed to disk in
+memory_max_bytes = 256 * 1024 * 1024    #Largest file downloaded into memory
+_session = None
+_session_lock = threading.Lock()
+
+#Get the shared requests session (created on first use)
+def get_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=5, backoff_factor=1,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=["GET"])
+            adapter = HTTPAdapter(pool_connections=max_workers,
+                                  pool_maxsize=max_workers, 
+                                  max_retries=retry)
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+
+    return _session
+
+#The scrape cache stores the ETag, Last-Modified and content hash of each url
+#requested so later runs can send conditional requests and skip anything that
+#has not changed. Page HTML is kept in the cache directory alongside the index.
+scrape_cache_dir = os.path.join(paths.data_dir, ".scrape_cache")
+_scrape_cache = None
+_scrape_cache_lock = threading.RLock()
+
+#Load the scrape cache index (once per run)
+def load_scrape_cache():
+    global _scrape_cache
+
+    with _scrape_cache_lock:
+        if _scrape_cache is None:
+            index_file = os.path.join(scrape_cache_dir, "index.json")
+            try:
+                with open(index_file) as file:
+                    _scrape_cache = json.load(file)
+            except (OSError, ValueError):
+                _scrape_cache = {}
+
+    return _scrape_cache
+
+#Write the scrape cache index to disk
+def save_scrape_cache():
+    os.makedirs(scrape_cache_dir, exist_ok=True)
+    index_file = os.path.join(scrape_cache_dir, "index.json")
+
+    with _scrape_cache_lock:
+        with open(index_file + ".tmp", "w") as file:
+            json.dump(load_scrape_cache(), file, indent=2)
+        os.replace(index_file + ".tmp", index_file)
+
+#Build the conditional request headers for a cached url
+def get_conditional_headers(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    return headers
+
+#Record the validators and content hash of a response in the scrape cache
+def update_scrape_cache(url, res, content_hash, **extra):
+    entry = {"etag": res.headers.get("ETag"),
+             "last_modified": res.headers.get("Last-Modified"),
+             "sha256": content_hash}
+    entry.update(extra)
+
+    with _scrape_cache_lock:
+        load_scrape_cache()[url] = entry
+        save_scrape_cache()
+
+#Get the path of the cached copy of a page's html
+def get_body_file(url):
+    return os.path.join(scrape_cache_dir, 
+                        hashlib.sha256(url.encode("utf-8")).hexdigest() 
+                        + ".html")
+
+#Read the cached copy of a page's html
+def read_page_html(url):
+    with open(get_body_file(url), encoding="utf-8") as file:
+        return file.read()
+
+#Save a downloaded page's html and record it in the scrape cache
+def save_page_html(url, res, content, text):
+    os.makedirs(scrape_cache_dir, exist_ok=True)
+    with open(get_body_file(url), "w", encoding="utf-8") as file:
+        file.write(text)
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    update_scrape_cache(url, res, content_hash)
+
+#Get the conditional request headers for a page (only if the cached copy of
+#the page is still available)
+def get_page_headers(url):
+    if not os.path.isfile(get_body_file(url)):
+        return {}
+
+    return get_conditional_headers(load_scrape_cache().get(url, {}))
+
+#Get the html of a page, using the cached copy if the server reports it has
+#not been modified since the last request
+def get_page_html(url):
+    with telemetry.stage("scrape_page", url=url) as span:
+        res = get_session().get(url, headers=get_page_headers(url))
+        span["status_code"] = res.status_code
+
+        if res.status_code == 304:
+            return read_page_html(url)
+
+        res.raise_for_status()
+        span["bytes"] = len(res.content)
+        save_page_html(url, res, res.content, res.text)
+
+        return res.text
+
 #Get the n most recent pages from the specified nhsd page
 def get_nhsd_pages(nhsd_publication,
                    n=False,
                    url="https://digital.nhs.uk", 
                    section="/data-and-information/publications/statistical/"):
-    pages = []
-
     #Get the full url to the publication
     url_full = url + section + nhsd_publication + "/"
 
     #Make a request to get all pages in the publication
-    res = requests.get(url_full)
-    res.raise_for_status()
-    soup = BeautifulSoup(res.text, 'html.parser')
+    return parse_nhsd_pages(get_page_html(url_full), n=n)
+
+#Get the n most recent pages from the html of a publication
+def parse_nhsd_pages(html, n=False):
+    pages = []
+    soup = BeautifulSoup(html, 'html.parser')
 
     #Get the latest page via the HTML div id
     ls_div = soup.find(id="latest-statistics")
@@ -52,14 +187,51 @@ def get_nhsd_pages(nhsd_publication,
 
     return pages
 
+#Parse a file link into its file id and details: the url, period (not all
+#files have a period in the name) and file extension
+#e.g. ".../Index%20of%20survival%2C2024.xlsx" => 
+#("Index of survival", {"url": ..., "period": "2024", "ext": "xlsx"})
+#Returns None if the link is not to a file (no file extension)
+def parse_file_link(href):
+    #Get the filename without the rest of the url
+    filename = href.split("/")[-1]
+    #Replace unicode figures with spaces and commas
+    filename_clean = filename.replace("%20", " ").replace("%2C", ",")
+
+    #For files with a period in the name
+    file_id, sep, period_ext = filename_clean.rpartition(",")
+    if sep and "." in period_ext:
+        period_ext_arr = period_ext.split(".")
+        return file_id, {"url":href, 
+                         "period":period_ext_arr[0],
+                         "ext":period_ext_arr[1]}
+
+    #For files with no period in the name
+    file_id_ext = filename_clean.split(".")
+    if len(file_id_ext) < 2:
+        return None
+
+    return file_id_ext[0], {"url":href, "ext":file_id_ext[1]}
+
 #For a given page, return a list of all files capturing the file id and period
+#The links of each page are kept in the scrape cache, so a page that has not
+#changed since it was last parsed is not parsed again
 def get_file_links_from_page(page, url="https://digital.nhs.uk"):
 
     #Make a request to the full url
     full_url = url + page
-    res = requests.get(full_url)
-    res.raise_for_status()
-    soup = BeautifulSoup(res.text, 'html.parser')
+    return parse_file_links(full_url, get_page_html(full_url))
+
+#Get the file links from the html of a page (see get_file_links_from_page)
+def parse_file_links(full_url, html):
+
+    #Reuse the links if they were parsed from the same version of the page
+    #(the entry is replaced whenever a new version of the page is downloaded)
+    entry = load_scrape_cache().get(full_url, {})
+    if "links" in entry and entry.get("links_sha256") == entry.get("sha256"):
+        return entry["links"]
+
+    soup = BeautifulSoup(html, 'html.parser')
 
     #Split by this div id to isolate the file links
     file_div = soup.find(id="resources")
@@ -71,52 +243,217 @@ def get_file_links_from_page(page, url="https://digital.nhs.uk"):
         href = a_tag['href']
         #Ignore empty links (Used as comments or messages occasionally)
         if href:
-            #Get the filename without the rest of the url
-            filename = href.split("/")[-1]
-            #Replace unicode figures with spaces and commas
-            filename_clean = filename.replace("%20", " ").replace("%2C", ",")
+            file_link = parse_file_link(href)
+            if file_link:
+                file_id, details = file_link
+                relevant_files[file_id] = details
+
+    if entry:
+        with _scrape_cache_lock:
+            entry["links"] = relevant_files
+            entry["links_sha256"] = entry.get("sha256")
+            save_scrape_cache()
 
-            #Attempt to extract the url, period and file extension
-            #Not all files have a period in the name
-            try:
-                file_id, period_ext = filename_clean.rsplit(",", 1)
-                period_ext_arr = period_ext.split(".")
-                relevant_files[file_id] = {"url":href, 
-                                           "period":period_ext_arr[0],
-                                           "ext":period_ext_arr[1]}
-            #For files with no period in the name
-            except:
-                file_id_ext = filename_clean.split(".")
-                relevant_files[file_id_ext[0]] = {"url":href, 
-                                                  "ext":file_id_ext[1]}
-                
     return relevant_files
 
+#Get the file links of a page kept in the scrape cache (see parse_file_links)
+#without requesting the page. Returns None if they are not cached
+def get_cached_file_links(page, url="https://digital.nhs.uk"):
+    entry = load_scrape_cache().get(url + page, {})
+    if "links" in entry and entry.get("links_sha256") == entry.get("sha256"):
+        return entry["links"]
+
+    return None
+
+#Build a prefix index of a list of keys (e.g. the file ids of a page) so the
+#keys starting with a prefix can be found without scanning every key
+def build_prefix_index(keys):
+    return sorted(set(keys))
+
+#Find the keys in a prefix index (see build_prefix_index) that start with
+#prefix. Returns a list of the keys found (in sorted order)
+def find_prefix(index, prefix):
+    found = []
+    for key in index[bisect_left(index, prefix):]:
+        if not key.startswith(prefix):
+            break
+        found.append(key)
+
+    return found
+
+#Get the file links for several pages at once (in the same order as pages)
+def get_file_links_from_pages(pages, url="https://digital.nhs.uk"):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda page: get_file_links_from_page(page, url=url), pages))
+
 #Download data files for a given file_id and file_links
-def download_file_from_id(file_links, file_id):
+#If dest_file is given, the file is streamed straight to dest_file and the 
+#path is returned instead of the content (or None if dest_file already holds
+#the latest copy of the file)
+#If to_memory is True, the file is kept in memory under the dest_file path 
+#instead (see keep_in_memory) and only saved to dest_file if persist is True
+def download_file_from_id(file_links, file_id, dest_file=None, 
+                          to_memory=False, persist=True):
+    with telemetry.stage("download_file", file_id=file_id, 
+                         dest_file=dest_file, to_memory=to_memory) as span:
+        result = _download_file_from_id(file_links, file_id, dest_file, span,
+                                        to_memory, persist)
+        span["result"] = ("unchanged" if result is None 
+                          else "failed" if result == 0 else "downloaded")
+        return result
 
-    #Make a request for the file
-    try:
-        target_url = file_links[file_id]["url"]
-    except:
+#Get the url of a file and the conditional request headers for it
+#Returns a tuple of the url, the hash of the local copy (if dest_file exists)
+#and the headers, or None if the file is not in file_links
+def prepare_download(file_links, file_id, dest_file=None):
+    if file_id not in file_links:
         print(f"'{file_id}' could not be found for this publication.")
+        return None
+
+    target_url = file_links[file_id]["url"]
+
+    #Only make a conditional request if the local file is the cached version
+    entry = load_scrape_cache().get(target_url, {})
+    local_hash = None
+    if dest_file and os.path.isfile(dest_file):
+        local_hash = cache.file_hash(dest_file)
+
+    headers = {}
+    if local_hash and local_hash == entry.get("sha256"):
+        headers = get_conditional_headers(entry)
+
+    return target_url, local_hash, headers
+
+#Swap a fully downloaded file (dest_file + ".part") into place
+#Returns dest_file, or None if the download is the same as the local copy
+def finish_download(target_url, res, dest_file, content_hash, local_hash):
+    update_scrape_cache(target_url, res, content_hash)
+
+    #The server doesn't support conditional requests but the file is the
+    #same as the local copy
+    if content_hash == local_hash:
+        os.remove(dest_file + ".part")
+        return None
+
+    os.replace(dest_file + ".part", dest_file)
+    return dest_file
+
+#Files downloaded into memory that are too large (see memory_max_bytes) and
+#not saved to the data directory are saved to a temporary directory instead,
+#which is removed when the run ends
+_spill_dir = None
+
+#Get the temporary path for a large download (keeping its file name, as the
+#file name is used to process the file)
+def get_spill_file(dest_file):
+    global _spill_dir
+
+    if _spill_dir is None:
+        _spill_dir = tempfile.mkdtemp(prefix="nhsd_")
+        atexit.register(shutil.rmtree, _spill_dir, ignore_errors=True)
+
+    return os.path.join(_spill_dir, os.path.basename(dest_file))
+
+#Check if a download is too large to keep in memory (by its Content-Length)
+def is_large_download(headers):
+    return int(headers.get("Content-Length") or 0) > memory_max_bytes
+
+#Keep a downloaded file in memory under the dest_file path (see 
+#cache_util.add_memory_file), also saving it to dest_file if persist is True
+#Returns dest_file, or None if the download is the same as the local copy
+def keep_in_memory(target_url, res, dest_file, content, local_hash, 
+                   persist=False):
+    content_hash = hashlib.sha256(content).hexdigest()
+    update_scrape_cache(target_url, res, content_hash)
+
+    if content_hash == local_hash:
+        return None
+
+    cache.add_memory_file(dest_file, content, content_hash)
+
+    if persist:
+        with open(dest_file + ".part", "wb") as file:
+            file.write(content)
+        os.replace(dest_file + ".part", dest_file)
+
+    return dest_file
+
+#Report a failed download
+def print_download_failure(target_url, status_code):
+    print(f"Failed to download file with the following url:\n{target_url}.",
+          f"\nStatus code: {status_code}")
+
+def _download_file_from_id(file_links, file_id, dest_file, span, 
+                           to_memory=False, persist=True):
+
+    #Make a request for the file
+    download = prepare_download(file_links, file_id, dest_file)
+    if download is None:
         return 0
-    res = requests.get(target_url)
+    target_url, local_hash, headers = download
+
+    res = get_session().get(target_url, headers=headers, 
+                            stream=dest_file is not None)
+    span["status_code"] = res.status_code
+
+    #The file has not changed since it was last downloaded
+    if res.status_code == 304:
+        res.close()
+        return None
 
     #Check if the request was successful
-    if res.status_code == 200:
+    if res.status_code == 200 and dest_file is None:
+        span["bytes"] = len(res.content)
+        content_hash = hashlib.sha256(res.content).hexdigest()
+        update_scrape_cache(target_url, res, content_hash)
+
         return res.content
+
+    elif (res.status_code == 200 and to_memory 
+          and not is_large_download(res.headers)):
+        span["bytes"] = len(res.content)
+        return keep_in_memory(target_url, res, dest_file, res.content, 
+                              local_hash, persist)
+
+    elif res.status_code == 200:
+        #Large files that are not saved to the data directory are streamed
+        #to a temporary file
+        if to_memory and not persist:
+            dest_file = get_spill_file(dest_file)
+
+        #Stream the file to a temporary file in blocks, hashing as it goes
+        sha = hashlib.sha256()
+        with res, open(dest_file + ".part", "wb") as file:
+            for block in res.iter_content(chunk_size=chunk_size):
+                sha.update(block)
+                file.write(block)
+        span["bytes"] = os.path.getsize(dest_file + ".part")
+
+        return finish_download(target_url, res, dest_file, sha.hexdigest(),
+                               local_hash)
     else:
-        print(f"Failed to download file with the following url:\n{target_url}.",
-              f"\nStatus code: {res.status_code}")
+        res.close()
+        print_download_failure(target_url, res.status_code)
         return 0
 
+#Download several files at once
+#Each download is a (file_links, file_id, dest_file) tuple and the results
+#of download_file_from_id are returned in the same order
+def download_files(downloads, to_memory=False, persist=True):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda download: download_file_from_id(
+                *download, to_memory=to_memory, persist=persist), 
+            downloads))
+
 #Save the request content as a file
 def save_file(content, file_name,
-              dest_dir="./data"):
+              dest_dir=paths.data_dir):
 
     #Build the full destination filename including the path
-    target_dest = dest_dir + "/" + file_name
+    os.makedirs(dest_dir, exist_ok=True)
+    target_dest = os.path.join(dest_dir, file_name)
     
     #Save the content as a file
     with open(target_dest, "wb") as file:
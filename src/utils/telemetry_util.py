@@ -0,0 +1,195 @@
+#Functions for recording the time and memory used by each stage of the ETL
+#
+#Each stage is wrapped in a span:
+#   with telemetry.stage("read_sheet", sheet_name=sheet_name) as span:
+#       ...
+#       span["rows_out"] = len(df)
+#
+#When the stage ends the span is written as a JSON line to the spans file with
+#its duration, status, attributes (rows in/out, bytes etc.) and peak memory.
+#Spans record their parent so nested stages (e.g. the steps of a transform)
+#can be rebuilt into a trace, in the same shape as OpenTelemetry spans.
+#
+#Settings (environment variables):
+# - TELEMETRY: Set to 0 to disable the spans
+# - TELEMETRY_FILE: Path of the spans file (default output/spans.jsonl in the
+#   root of the repository)
+# - TELEMETRY_TRACEMALLOC: Set to 1 to record the peak memory allocated in
+#   each span with tracemalloc (accurate per stage, but slows the run down)
+# - PROFILE_STAGE: Name of a stage to profile. Each time it runs, the stats
+#   are saved to output/profile_<stage>_<timestamp>.prof (cProfile) or .html
+# - PROFILER: "cprofile" (default) or "pyinstrument" (must be installed)
+
+#Import packages
+import contextvars
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import utils.path_util as paths
+
+#resource is not available on Windows (peak RSS is recorded as None)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+default_spans_file = os.path.join(paths.output_dir, "spans.jsonl")
+profile_dir = paths.output_dir
+
+#Every span in a run shares a trace id
+trace_id = uuid.uuid4().hex
+
+#The open spans of each thread or asyncio task (the last is the parent of any
+#new span). A context variable is used so concurrent tasks keep their own spans
+_open_spans = contextvars.ContextVar("open_spans", default=())
+_write_lock = threading.Lock()
+
+def is_enabled():
+    return os.getenv("TELEMETRY", "1") != "0"
+
+#Get the peak resident memory of this process so far in bytes
+def get_peak_rss():
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Reported in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+#Get the (shallow) memory used by a dataframe in bytes
+def frame_bytes(df):
+    return int(df.memory_usage(deep=False).sum())
+
+#Pass through a list (or generator) of dataframes, adding up the rows and
+#bytes of each in the span as rows_in and bytes
+def count_rows(chunks, span):
+    span["rows_in"] = 0
+    span["bytes"] = 0
+    for chunk in chunks:
+        span["rows_in"] += len(chunk)
+        span["bytes"] += frame_bytes(chunk)
+        yield chunk
+
+#Write a finished span to the spans file
+def write_span(span):
+    spans_file = os.getenv("TELEMETRY_FILE", default_spans_file)
+    spans_dir = os.path.dirname(spans_file)
+    if spans_dir:
+        os.makedirs(spans_dir, exist_ok=True)
+
+    line = json.dumps(span, default=str)
+    with _write_lock:
+        with open(spans_file, "a") as file:
+            file.write(line + "\n")
+
+#Start a profiler for a stage if it is the stage chosen by PROFILE_STAGE
+def start_profile(name):
+    if os.getenv("PROFILE_STAGE") != name:
+        return None
+
+    if os.getenv("PROFILER", "cprofile") == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("Warning: pyinstrument is not installed, using cProfile.")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+#Stop a stage profiler and save the results
+def stop_profile(name, profiler):
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_file = os.path.join(
+        profile_dir, f"profile_{name}_{datetime.now():%Y%m%d_%H%M%S_%f}")
+
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(profile_file + ".prof")
+    else:
+        profiler.stop()
+        with open(profile_file + ".html", "w") as file:
+            file.write(profiler.output_html())
+
+@contextmanager
+def stage(name, **attributes):
+
+    """
+    Context manager to record a stage of the ETL as a span.
+
+    inputs:
+    - name: Name of the stage (e.g. "read_sheet")
+    - attributes: Any details of the stage (e.g. data_file). The span dict is
+    yielded so rows_in, rows_out, bytes etc. can be added during the stage
+
+    output:
+    Yields the span attributes dict. The span is written when the stage ends
+    (with status "error" and the error if an exception was raised)
+    """
+
+    if not is_enabled():
+        yield attributes
+        return
+
+    stack = _open_spans.get()
+    parent = stack[-1] if stack else None
+
+    span = {
+        "trace_id": trace_id,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start": datetime.now(timezone.utc).isoformat(),
+        "pid": os.getpid(),
+        "attributes": attributes
+    }
+
+    #Peak memory allocated within the span (tracemalloc only has one peak,
+    #so the peak before the span is kept for the parent and reset)
+    traced = os.getenv("TELEMETRY_TRACEMALLOC") == "1"
+    if traced:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if parent:
+            parent["_traced_peak"] = max(parent.get("_traced_peak", 0),
+                                         tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    token = _open_spans.set(stack + (span,))
+    profiler = start_profile(name)
+    start = time.perf_counter()
+    span["status"] = "ok"
+    try:
+        yield attributes
+    except BaseException as e:
+        span["status"] = "error"
+        span["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span["duration_s"] = round(time.perf_counter() - start, 6)
+        if profiler is not None:
+            stop_profile(name, profiler)
+        _open_spans.reset(token)
+
+        span["peak_rss_bytes"] = get_peak_rss()
+        if traced:
+            peak = max(tracemalloc.get_traced_memory()[1],
+                       span.pop("_traced_peak", 0))
+            span["peak_traced_bytes"] = peak
+            if parent:
+                parent["_traced_peak"] = max(parent.get("_traced_peak", 0),
+                                             peak)
+
+        write_span(span)
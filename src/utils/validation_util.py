@@ -0,0 +1,191 @@
+#Functions for checking the quality of the transformed data before it is
+#uploaded, so a malformed workbook fails the run before anything is loaded
+#
+#The checks for a table are described by a dict (like the pipeline specs in
+#pipeline_util.py) with the following keys (all optional):
+# - columns: Columns that must be in the data
+# - key_cols: Columns that identify a unique row (no key may appear twice)
+# - bounds: List of (lower, value, upper) columns where lower <= value <= upper
+#   must hold in every row where all three are given (e.g. confidence limits)
+# - ranges: Dict of column: (min, max) allowed values (either can be None).
+#   Values that are not numbers also fail
+# - coverage: Dict of column: values that must all appear in the column
+#   (e.g. the target geographies)
+#
+#Each row level check is worked out as a boolean mask over the whole frame,
+#so a frame is validated in one vectorised pass, and every failed check is
+#collected into one summary instead of stopping at the first.
+
+#Import packages
+import numpy as np
+import pandas as pd
+
+import utils.telemetry_util as telemetry
+
+#Number of example rows shown for each failed check
+max_examples = 3
+
+#Raised when the data fails any of its checks (the message is the summary)
+class ValidationError(Exception):
+    pass
+
+#Describe the rows of a failed check (the number of rows and a few examples)
+def describe_rows(df, mask, cols):
+    examples = df.loc[mask, cols].head(max_examples).to_dict("records")
+    return f"{int(mask.sum())} rows, e.g. {examples}"
+
+#Get a column as float values (NaN where missing) and a mask of the values
+#that are given but are not numbers
+def get_numbers(s):
+    numbers = pd.to_numeric(s, errors="coerce")
+    not_numbers = (numbers.isna() & s.notna()).to_numpy()
+    return numbers.to_numpy(dtype="float64", na_value=np.nan), not_numbers
+
+#Get the problems found by the row level checks (columns, bounds and ranges)
+def get_row_problems(df, checks):
+    problems = []
+
+    missing = [col for col in checks.get("columns", [])
+               if col not in df.columns]
+    if missing:
+        problems.append(f"Missing columns: {missing}")
+
+    for lower, value, upper in checks.get("bounds", []):
+        if not {lower, value, upper} <= set(df.columns):
+            continue
+
+        values = [get_numbers(df[col])[0] for col in (lower, value, upper)]
+        #Comparisons with missing values are False so those rows are skipped
+        mask = (values[0] > values[1]) | (values[1] > values[2])
+        if mask.any():
+            problems.append(f"{lower} <= {value} <= {upper} fails for "
+                            + describe_rows(df, mask, [lower, value, upper]))
+
+    for col, (low, high) in checks.get("ranges", {}).items():
+        if col not in df.columns:
+            continue
+
+        values, mask = get_numbers(df[col])
+        if low is not None:
+            mask = mask | (values < low)
+        if high is not None:
+            mask = mask | (values > high)
+        if mask.any():
+            problems.append(f"{col} is not a number between {low} and {high} "
+                            "for " + describe_rows(df, mask, [col]))
+
+    return problems
+
+#Hash the key columns of each row (as for ROW_KEY in database_util.py)
+def get_key_hashes(df, key_cols):
+    return pd.util.hash_pandas_object(df[key_cols], index=False).to_numpy()
+
+#Get the problem if any key appears more than once (None if the keys are
+#unique). df is only used to show examples of the duplicated rows
+def get_key_problem(hashes, key_cols, df=None):
+    duplicated = pd.Series(hashes).duplicated(keep=False).to_numpy()
+    if not duplicated.any():
+        return None
+
+    if df is None:
+        return f"{int(duplicated.sum())} rows have a duplicate key {key_cols}"
+
+    return (f"Duplicate key {key_cols} for "
+            + describe_rows(df, duplicated, key_cols))
+
+#Get the problems if any of the expected values are missing from each column
+#seen is a dict of column: values found in the column
+def get_coverage_problems(coverage, seen):
+    problems = []
+    for col, values in coverage.items():
+        missing = sorted(set(values) - set(seen.get(col, [])))
+        if missing:
+            problems.append(f"{col} is missing {missing}")
+
+    return problems
+
+#Raise a ValidationError summarising the problems (if there are any)
+def raise_problems(name, problems):
+    if problems:
+        summary = "\n".join(f"  - {problem}" for problem in problems)
+        raise ValidationError(
+            f"{name} failed {len(problems)} check(s):\n{summary}")
+
+def validate_frame(df, checks, name):
+
+    """
+    Function to check a dataframe before it is uploaded.
+
+    inputs:
+    - df: Dataframe object
+    - checks: Checks dict (see the top of this file)
+    - name: Name of the data used in the summary (e.g. the data file)
+
+    output:
+    Returns the dataframe if every check passed, otherwise raises a
+    ValidationError summarising every failed check
+    """
+
+    with telemetry.stage("validate", data=name) as span:
+        span["rows_in"] = len(df)
+        problems = get_row_problems(df, checks)
+
+        key_cols = checks.get("key_cols")
+        if key_cols and set(key_cols) <= set(df.columns):
+            problem = get_key_problem(get_key_hashes(df, key_cols), key_cols,
+                                      df)
+            if problem:
+                problems.append(problem)
+
+        coverage = checks.get("coverage", {})
+        seen = {col: df[col].unique() for col in coverage if col in df.columns}
+        problems += get_coverage_problems(coverage, seen)
+
+        span["problems"] = len(problems)
+        raise_problems(name, problems)
+
+    return df
+
+def validate_chunks(chunks, checks, name):
+
+    """
+    Function to check a list (or generator) of dataframes as they are
+    uploaded (e.g. from pipeline_util.iter_pipeline). Each chunk is checked
+    before it is passed on and the keys and coverage of all the chunks are
+    checked after the last one, so a failure is raised before the upload
+    finishes (and the load is rolled back).
+
+    inputs:
+    - chunks: List (or generator) of dataframes
+    - checks: Checks dict (see the top of this file)
+    - name: Name of the data used in the summary (e.g. the data file)
+
+    output:
+    Yields each chunk once it has passed the row level checks. Raises a
+    ValidationError summarising the failed checks
+    """
+
+    key_cols = checks.get("key_cols")
+    coverage = checks.get("coverage", {})
+
+    hashes = []
+    seen = {col: set() for col in coverage}
+    for chunk in chunks:
+        raise_problems(name, get_row_problems(chunk, checks))
+
+        if key_cols and set(key_cols) <= set(chunk.columns):
+            hashes.append(get_key_hashes(chunk, key_cols))
+        for col in coverage:
+            if col in chunk.columns:
+                seen[col].update(chunk[col].unique())
+
+        yield chunk
+
+    problems = []
+    if hashes:
+        problem = get_key_problem(np.concatenate(hashes), key_cols)
+        if problem:
+            problems.append(problem)
+    problems += get_coverage_problems(coverage, seen)
+
+    raise_problems(name, problems)
@@ -0,0 +1,223 @@
+#Shared fixtures for the tests
+#
+#Run from the root of the repository with:
+#   python -m pytest
+#
+#The tests use the synthetic NHSD shaped workbooks from src/benchmark.py and a
+#local DuckDB database, so no NHSD or Snowflake access is needed.
+
+#Import packages
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "src")
+sys.path.insert(0, src_dir)
+
+import benchmark
+import utils.cache_util as cache
+import utils.scrape_util as scrape
+
+#Rows in each synthetic workbook (enough for every target geography and a few
+#Cancer Alliances in both workbooks)
+index_rows = 6000
+adult_rows = 400
+
+#Don't record spans or cache the parsed sheets in the repository
+@pytest.fixture(autouse=True)
+def isolate(monkeypatch, tmp_path):
+    monkeypatch.setenv("TELEMETRY", "0")
+    monkeypatch.setattr(cache, "cache_dir", str(tmp_path / "cache"))
+
+#Paths of a synthetic Index and adult workbook (created once per test run)
+@pytest.fixture(scope="session")
+def workbooks(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("data")
+    index_file = str(data_dir / "Index_synthetic.xlsx")
+    adult_file = str(data_dir / "adult_synthetic_2017_2021.xlsx")
+
+    benchmark.make_index_workbook(index_file, index_rows)
+    benchmark.make_adult_workbook(adult_file, adult_rows)
+
+    return index_file, adult_file
+
+#Copy the synthetic adult workbook with the net survival of the later rows
+#out of range (so with streaming the first chunks pass their checks)
+@pytest.fixture
+def bad_adult_file(workbooks, tmp_path):
+    wb = load_workbook(workbooks[1])
+    ws = wb["Table 4"]
+    for row in range(300, ws.max_row + 1):
+        ws.cell(row=row, column=9).value = 150
+    data_file = str(tmp_path / "adult_synthetic_2017_2021.xlsx")
+    wb.save(data_file)
+    return data_file
+
+#Environment variables for loading a local DuckDB database in tmp_path
+@pytest.fixture
+def local_env(tmp_path):
+    return {
+        "LOCAL_DATABASE": str(tmp_path / "test.duckdb"),
+        "DATABASE": "DEV",
+        "SCHEMA": "TEST",
+        "DESTINATION_INDEX": "INDEX",
+        "DESTINATION_ADULT4": "ADULT_4"
+    }
+
+#A Snowflake connection that keeps its tables as dataframes, for the
+#statements used by the load modes. Like Snowflake with autocommit (where
+#write_pandas and DDL commit the open transaction), every statement takes
+#effect at once and ROLLBACK does nothing
+class FakeSnowflake:
+
+    def __init__(self):
+        self.tables = {}
+        self.statements = []
+        self.written_rows = 0  #Rows written by write_pandas
+
+    def cursor(self):
+        return FakeSnowflakeCursor(self)
+
+    def write(self, df, table):
+        if self.tables[table].empty:
+            self.tables[table] = df.reset_index(drop=True)
+        else:
+            self.tables[table] = pd.concat([self.tables[table], df], 
+                                           ignore_index=True)
+
+class FakeSnowflakeCursor:
+
+    def __init__(self, con):
+        self.con = con
+        self.result = None
+
+    def execute(self, sql):
+        tables = self.con.tables
+        self.con.statements.append(sql)
+
+        if match := re.match(r"CREATE OR REPLACE (?:TEMPORARY )?TABLE "
+                             r"(\S+) LIKE (\S+)", sql):
+            tables[match[1]] = tables[match[2]].iloc[0:0]
+        elif match := re.match(r"TRUNCATE TABLE (\S+)", sql):
+            tables[match[1]] = tables[match[1]].iloc[0:0]
+        elif match := re.match(r"INSERT INTO (\S+) .* FROM (\S+)$", sql):
+            self.con.write(tables[match[2]], match[1])
+        elif match := re.match(r"ALTER TABLE (\S+) SWAP WITH (\S+)", sql):
+            tables[match[1]], tables[match[2]] = (tables[match[2]], 
+                                                  tables[match[1]])
+        elif match := re.match(r"DROP TABLE IF EXISTS (\S+)", sql):
+            tables.pop(match[1], None)
+        elif match := re.match(r"SELECT COUNT\(\*\), (.*) FROM (\S+)", sql):
+            df = tables[match[2]]
+            nkeys = None if match[1] == "NULL" else df["ROW_KEY"].nunique()
+            self.result = (len(df), nkeys)
+        elif sql not in ["BEGIN", "COMMIT", "ROLLBACK"]:
+            raise NotImplementedError(sql)
+
+    def fetchone(self):
+        return self.result
+
+    def close(self):
+        pass
+
+#A fake Snowflake connection (see FakeSnowflake) with write_pandas writing to
+#its tables
+@pytest.fixture
+def snowflake_ctx(monkeypatch):
+    import utils.database_util as db
+
+    ctx = FakeSnowflake()
+
+    def write_pandas(conn, df, table_name, schema, database, **kwargs):
+        conn.write(df, f"{database}.{schema}.{table_name}")
+        conn.written_rows += len(df)
+        return True, 1, len(df), None
+    monkeypatch.setattr(db, "write_pandas", write_pandas)
+
+    return ctx
+
+#A local copy of the NHSD site serving pages and files (by path) with ETags,
+#so the scrape tests don't need network access. Each request is recorded and
+#a path can be made to fail (with a 503) or respond slowly
+class LocalSite:
+
+    def __init__(self, url):
+        self.url = url
+        self.content = {}
+        self.failures = {}  #Path => number of requests to fail first
+        self.delays = {}    #Path => seconds to wait before responding
+        self.requests = []  #(path, status) of each request
+
+    def get_etag(self, path):
+        return '"' + hashlib.sha256(self.content[path]).hexdigest()[:16] + '"'
+
+    #Add a publication page linking to the given file paths
+    def add_page(self, page, file_paths):
+        links = "".join(f'<a href="{self.url}{path}">{path}</a>' 
+                        for path in file_paths)
+        self.content[page] = (f'<html><body><div id="resources">{links}'
+                              '</div></body></html>').encode("utf-8")
+
+    def respond(self, handler):
+        path = handler.path
+        time.sleep(self.delays.get(path, 0))
+
+        if self.failures.get(path):
+            self.failures[path] -= 1
+            status = 503
+        elif path not in self.content:
+            status = 404
+        elif handler.headers.get("If-None-Match") == self.get_etag(path):
+            status = 304
+        else:
+            status = 200
+        self.requests.append((path, status))
+
+        handler.send_response(status)
+        if status == 200:
+            handler.send_header("ETag", self.get_etag(path))
+            handler.send_header("Content-Length", len(self.content[path]))
+            handler.end_headers()
+            handler.wfile.write(self.content[path])
+        else:
+            handler.send_header("Content-Length", 0)
+            handler.end_headers()
+
+    def get_statuses(self, path):
+        return [status for request_path, status in self.requests 
+                if request_path == path]
+
+#A local site (see LocalSite) with the scrape cache and session kept in 
+#tmp_path for the test
+@pytest.fixture
+def site(monkeypatch, tmp_path):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            local_site.respond(self)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    local_site = LocalSite(f"http://127.0.0.1:{server.server_port}")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(scrape, "scrape_cache_dir", 
+                        str(tmp_path / "scrape_cache"))
+    monkeypatch.setattr(scrape, "_scrape_cache", None)
+    monkeypatch.setattr(scrape, "_session", None)
+
+    yield local_site
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,117 @@
+#Tests for the asynchronous download and process pipeline 
+#(main.scrape_and_process and utils/async_scrape_util.py) on a local site
+
+#Import packages
+import asyncio
+import os
+import threading
+
+import aiohttp
+import pytest
+
+import main
+import utils.async_scrape_util as async_scrape
+import utils.scrape_util as scrape
+from utils.validation_util import ValidationError
+
+pages = [
+    "/pub/cancer-survival-in-england/index-of-cancer-survival-2021",
+    "/pub/cancer-survival-in-england/cancers-diagnosed-2017-to-2021",
+]
+index_path = "/files/Index_of_cancer_survival.xlsx"
+adult_path = "/files/adult_cancer_survival_2017_2021.xlsx"
+
+#Serve the publication pages with the given index and adult workbooks, with
+#the pipeline reading the pages from the local site
+@pytest.fixture
+def publication(site, workbooks, local_env, monkeypatch):
+    def add_files(index_file=workbooks[0], adult_file=workbooks[1]):
+        for path, data_file in [(index_path, index_file), 
+                                (adult_path, adult_file)]:
+            with open(data_file, "rb") as file:
+                site.content[path] = file.read()
+    add_files()
+    site.add_page(pages[0], [index_path])
+    site.add_page(pages[1], [adult_path])
+
+    get_file_links_from_page = async_scrape.get_file_links_from_page
+    monkeypatch.setattr(
+        async_scrape, "get_file_links_from_page",
+        lambda session, page: get_file_links_from_page(session, page, 
+                                                       url=site.url))
+    monkeypatch.setattr(async_scrape, "backoff_factor", 0)
+
+    for name, value in local_env.items():
+        monkeypatch.setenv(name, value)
+
+    return add_files
+
+def scrape_and_process(data_dir):
+    return main.scrape_and_process(pages, main.get_connection, 
+                                   main.target_geographies, max_workers=2,
+                                   data_dir=str(data_dir))
+
+#Each file is handed to processing as soon as it is downloaded, so a slow
+#download doesn't hold up the other file
+def test_files_are_processed_in_download_order(site, publication, tmp_path):
+    site.delays[index_path] = 1
+
+    data_files, results = scrape_and_process(tmp_path / "data")
+
+    assert [os.path.basename(data_file) for data_file in data_files] == [
+        os.path.basename(adult_path), os.path.basename(index_path)]
+    assert results == [True, True]
+
+    ctx = main.get_connection()
+    for table in ["INDEX", "ADULT_4"]:
+        assert ctx.execute(
+            f"SELECT COUNT(*) FROM DEV.TEST.{table}").fetchone()[0] > 0
+
+#A file failing validation stops the run (once every transform has finished)
+#without uploading anything
+def test_validation_error_stops_the_pipeline(publication, bad_adult_file, 
+                                             local_env, tmp_path):
+    publication(adult_file=bad_adult_file)
+
+    with pytest.raises(ValidationError, match="SURVIVAL_PERCENT"):
+        scrape_and_process(tmp_path / "data")
+
+    assert not os.path.exists(local_env["LOCAL_DATABASE"])
+
+#A page that can't be read stops the downloaders (instead of leaving them
+#waiting for more files) and the error is raised
+def test_page_error_stops_the_pipeline(site, publication, tmp_path):
+    del site.content[pages[0]]
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        scrape_and_process(tmp_path / "data")
+
+#Hashing the local copy, writing the file and saving the scrape cache run on
+#threads, leaving the event loop free for other requests
+def test_download_file_access_runs_off_the_event_loop(site, monkeypatch, 
+                                                      tmp_path):
+    site.content[index_path] = b"workbook" * 1000
+    links = {"Index": {"url": site.url + index_path}}
+    dest_file = str(tmp_path / "Index.xlsx")
+
+    threads = []
+    def record_thread(func):
+        def wrapper(*args, **kwargs):
+            threads.append(threading.get_ident())
+            return func(*args, **kwargs)
+        return wrapper
+    for name in ["prepare_download", "finish_download", "update_scrape_cache"]:
+        monkeypatch.setattr(scrape, name, record_thread(getattr(scrape, name)))
+
+    async def download():
+        async with async_scrape.create_session() as session:
+            return (threading.get_ident(), 
+                    await async_scrape.download_file_from_id(
+                        session, links, "Index", dest_file))
+    loop_thread, result = asyncio.run(download())
+
+    assert result == dest_file
+    with open(dest_file, "rb") as file:
+        assert file.read() == site.content[index_path]
+    assert len(threads) == 3
+    assert loop_thread not in threads
@@ -0,0 +1,52 @@
+#Tests for the backfill command and the order of the downloaded backfill files
+
+#Import packages
+import os
+
+import pytest
+
+import main
+
+#Page directories in publication order (newest first)
+pages = [
+    "cancers-diagnosed-2017-to-2021-followed-up-to-2022",
+    "cancers-diagnosed-2016-to-2020-followed-up-to-2021",
+    "adults-diagnosed-2013-to-2017-and-followed-up-to-2018",
+]
+
+#Write an empty data file in each page directory (the oldest publication is
+#written last, so the newest file is the oldest page)
+def make_backfill_dir(data_dir):
+    for i, page in enumerate(pages):
+        os.makedirs(data_dir / page)
+        data_file = data_dir / page / "Index.xlsx"
+        data_file.touch()
+        os.utime(data_file, (i, i))
+
+def get_pages(data_files):
+    return [os.path.basename(os.path.dirname(data_file))
+            for data_file in data_files]
+
+def test_backfill_files_are_ordered_by_page_year(tmp_path):
+    make_backfill_dir(tmp_path)
+
+    assert get_pages(main.get_backfill_files(str(tmp_path))) == pages
+
+def test_backfill_files_use_the_saved_page_order(tmp_path):
+    make_backfill_dir(tmp_path)
+    os.makedirs(tmp_path / "data-without-a-year")
+    (tmp_path / "data-without-a-year" / "Index.xlsx").touch()
+
+    #The saved order is used over the years in the page names
+    page_order = [pages[1], pages[0], pages[2]]
+    main.save_manifest(page_order,
+                       str(tmp_path / main.backfill_pages_file))
+
+    assert (get_pages(main.get_backfill_files(str(tmp_path))) ==
+            page_order + ["data-without-a-year"])
+
+#The backfill command replaced the --backfill flag
+def test_backfill_flag_is_not_accepted():
+    with pytest.raises(SystemExit) as exit_info:
+        main.cli(["--backfill"])
+    assert exit_info.value.code == 2
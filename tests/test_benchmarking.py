@@ -0,0 +1,96 @@
+#Tests that the benchmarking aggregates (main.get_benchmarking_standards and
+#main.get_benchmarking_rank) match the original reporting views in
+#docs/archive, run on a local DuckDB database
+
+#Import packages
+import re
+from os.path import dirname, join
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+import utils.database_util as db
+from conftest import src_dir
+
+archive_dir = join(dirname(src_dir), "docs", "archive")
+views = "DEV.DEV__REPORTING__CANCER__SURVIVAL"
+
+#Load the adult data into a local database and create the original views on
+#it. DuckDB's CONCAT skips nulls (Snowflake's is null if any argument is) so
+#|| is used instead, and its PIVOT names the columns without the quotes
+@pytest.fixture
+def original_views(tmp_path):
+    def create_views(df_adult4):
+        ctx = db.connect_local(str(tmp_path / "test.duckdb"), "DEV", "TEST")
+        ctx.register("adult", df_adult4)
+        #YEARS_SINCE_DIAGNOSIS is a NUMBER in docs/create_adult4.sql
+        ctx.execute("CREATE TABLE DEV.TEST.ADULT_4 AS SELECT * REPLACE "
+                    "(CAST(YEARS_SINCE_DIAGNOSIS AS BIGINT) "
+                    "AS YEARS_SINCE_DIAGNOSIS) FROM adult")
+
+        sql = []
+        for name in ["reporting_benchmarking_standard.sql", 
+                     "reporting_rank.sql"]:
+            with open(join(archive_dir, name)) as file:
+                sql.append(file.read())
+        sql = re.sub(r"CONCAT\(([^)]*)\)", 
+                     lambda match: f"({match[1].replace(', ', ' || ')})",
+                     ";".join(sql))
+        sql = re.sub(r"\"'(\w+)'\"", r'"\1"', sql)
+
+        assert db.run_local_sql(
+            ctx, sql, "DEV", 
+            {"DEV__MODELLING.CANCER__SURVIVAL": "DEV.TEST"}) == 4
+        return ctx
+
+    return create_views
+
+#Adult data with a null number of years in one of the benchmarking rows (so
+#the plain column is float and the row's JOIN_KEY is null)
+@pytest.fixture(params=[True, False], ids=["compact", "plain"])
+def df_adult4(workbooks, monkeypatch, request):
+    monkeypatch.setattr(main, "compact_dtypes", request.param)
+    df = main.transform_adult_data_sheet4(workbooks[1], 
+                                          main.target_geographies)
+
+    row = df.index[(df["AREA_TYPE"] == "Cancer Alliance")
+                   & (df["STANDARDISATION_TYPE"] == "Age-standardised")
+                   & (df["SURVIVAL_METRIC"] == "Net Survival")][0]
+    df["YEARS_SINCE_DIAGNOSIS"] = df["YEARS_SINCE_DIAGNOSIS"].astype("float64")
+    df.loc[row, "YEARS_SINCE_DIAGNOSIS"] = np.nan
+    return df
+
+#Get the rows of a view or aggregate with a JOIN_KEY (rows with a null key 
+#can't be joined to by the dashboards) sorted by JOIN_KEY, with plain dtypes
+def normalise(df, dtypes):
+    df = df[df["JOIN_KEY"].notna()].astype(dtypes)
+    return df.sort_values("JOIN_KEY", ignore_index=True)
+
+def test_benchmarking_standards_match_the_original_view(df_adult4, 
+                                                        original_views):
+    ctx = original_views(df_adult4)
+    df_view = ctx.execute(f"SELECT * FROM {views}.BENCHMARKING_STANDARDS").df()
+
+    df = main.get_benchmarking_standards(main.get_benchmarking_rows(df_adult4))
+
+    assert list(df.columns) == list(df_view.columns)
+    dtypes = {col: "float64" for col in df.columns[1:]}
+    dtypes["JOIN_KEY"] = object
+    pd.testing.assert_frame_equal(normalise(df, dtypes), 
+                                  normalise(df_view, dtypes))
+
+def test_benchmarking_rank_matches_the_original_view(df_adult4, 
+                                                     original_views):
+    ctx = original_views(df_adult4)
+    df_view = ctx.execute(f"SELECT * FROM {views}.BENCHMARKING_RANK").df()
+
+    df = main.get_benchmarking_rank(main.get_benchmarking_rows(df_adult4))
+
+    assert list(df.columns) == list(df_view.columns)
+    dtypes = {"JOIN_KEY": object, "CANCER_SITE": object, 
+              "SURVIVAL_PERCENT": "float64", "RANK_CA": "float64",
+              "RANK_BASE": "int64", "NCL_QUARTILE": object}
+    pd.testing.assert_frame_equal(normalise(df, dtypes), 
+                                  normalise(df_view, dtypes))
@@ -0,0 +1,65 @@
+#Tests that a batch run over several geography sets (GEOGRAPHY_SETS) loads the
+#same rows as a run for each set on its own
+
+#Import packages
+import json
+
+import pytest
+
+import main
+
+geography_sets = {
+    "NCL": ["E56000027", "E40000003", "E92000001"],
+    "CA3": ["E57000003", "E40000003", "E92000001"]
+}
+
+#Load the synthetic workbooks into the local database
+def load(workbooks, monkeypatch, env, target_geographies):
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+
+    ctx = main.get_connection()
+    for data_file in workbooks:
+        assert main.process_data_file(ctx, data_file, target_geographies)
+    return ctx
+
+#Get the rows of a table (without the load timestamp) sorted by key
+def get_rows(ctx, table, key_cols, where="TRUE"):
+    df = ctx.execute(f"SELECT * EXCLUDE (_TIMESTAMP) FROM DEV.TEST.{table} "
+                     f"WHERE {where}").df()
+    return df.drop(columns="GEOGRAPHY_SET", errors="ignore").sort_values(
+        key_cols, ignore_index=True)
+
+@pytest.mark.parametrize("output", ["tables", "partitioned"])
+def test_batch_run_matches_single_set_runs(workbooks, local_env, monkeypatch,
+                                           output):
+    tables = {"INDEX": main.index_key_cols, "ADULT_4": main.adult4_key_cols}
+
+    #Each set on its own (to its own tables)
+    for name, codes in geography_sets.items():
+        ctx = load(workbooks, monkeypatch, 
+                   {**local_env, "DESTINATION_INDEX": f"SINGLE_{name}_INDEX",
+                    "DESTINATION_ADULT4": f"SINGLE_{name}_ADULT_4"}, codes)
+
+    #Both sets in one run
+    monkeypatch.setenv("GEOGRAPHY_SETS", json.dumps(geography_sets))
+    monkeypatch.setenv("GEOGRAPHY_SET_OUTPUT", output)
+    if output == "partitioned":
+        #The set name is a column of the usual tables
+        for table in tables:
+            ctx.execute(f"CREATE TABLE DEV.TEST.{table} AS SELECT *, "
+                        "'' AS GEOGRAPHY_SET FROM "
+                        f"DEV.TEST.SINGLE_NCL_{table} LIMIT 0")
+    ctx = load(workbooks, monkeypatch, local_env, main.target_geographies)
+
+    for name in geography_sets:
+        for table, key_cols in tables.items():
+            if output == "tables":
+                df_batch = get_rows(ctx, f"{table}_{name}", key_cols)
+            else:
+                df_batch = get_rows(ctx, table, key_cols, 
+                                    f"GEOGRAPHY_SET = '{name}'")
+            df_single = get_rows(ctx, f"SINGLE_{name}_{table}", key_cols)
+
+            assert len(df_single) > 0
+            assert df_batch.equals(df_single), (name, table)
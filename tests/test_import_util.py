@@ -0,0 +1,37 @@
+#Tests for importing packages lazily (utils/import_util.py)
+
+#Import packages
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import src_dir
+from utils.import_util import lazy_import
+
+@pytest.mark.parametrize("name", ["not_a_package", "not_a_package.module"])
+def test_missing_module_raises_when_used(name):
+    module = lazy_import(name)
+
+    with pytest.raises(ModuleNotFoundError, match="not_a_package"):
+        module.connect
+
+#main.py (and the check command) can be imported without the Snowflake
+#connector, which is only needed to connect to Snowflake
+def test_main_imports_without_snowflake():
+    script = "\n".join([
+        "import sys",
+        "sys.modules['snowflake'] = None",
+        "import main",
+        "try:",
+        "    main.snowflake_connector.connect",
+        "except ModuleNotFoundError:",
+        "    sys.exit(0)",
+        "sys.exit(1)"
+    ])
+    env = {**os.environ, "PYTHONPATH": src_dir}
+
+    result = subprocess.run([sys.executable, "-c", script], env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -0,0 +1,234 @@
+#Tests for the load modes of database_util.upload_df on a local DuckDB database
+#(and the other backends)
+
+#Import packages
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+import main
+import utils.database_util as db
+
+destination = "DEV.TEST.SURVIVAL"
+key_cols = ["AREA_CODE", "CANCER_SITE"]
+
+@pytest.fixture
+def ctx(tmp_path):
+    return db.connect_local(str(tmp_path / "test.duckdb"), "DEV", "TEST")
+
+def get_survival(area_codes, sites, survival):
+    return pd.DataFrame({"AREA_CODE": area_codes, "CANCER_SITE": sites, 
+                         "SURVIVAL_PERCENT": survival})
+
+#Get the rows of the destination (without the load timestamp) sorted by key
+def get_rows(ctx):
+    df = ctx.execute(f"SELECT * FROM {destination}").df()
+    return df.drop(columns="_TIMESTAMP").sort_values(key_cols, 
+                                                     ignore_index=True)
+
+def test_merge_inserts_updates_and_skips_unchanged_rows(ctx, capsys):
+    df = get_survival(["E1", "E1", "E2"], ["Lung", "Breast", "Lung"], 
+                      [50.0, 80.0, 45.0])
+
+    #Every row is new
+    assert db.upload_df(ctx, df, destination, key_cols=key_cols, mode="merge")
+    assert "Inserted 3 and updated 0 rows" in capsys.readouterr().out
+    timestamps = ctx.execute(f"SELECT _TIMESTAMP FROM {destination} "
+                             "ORDER BY ROW_KEY").fetchall()
+
+    #Nothing has changed so no rows are written
+    assert db.upload_df(ctx, df, destination, key_cols=key_cols, mode="merge")
+    assert "Inserted 0 and updated 0 rows" in capsys.readouterr().out
+    assert ctx.execute(f"SELECT _TIMESTAMP FROM {destination} "
+                       "ORDER BY ROW_KEY").fetchall() == timestamps
+
+    #One row has changed and one is new
+    df_new = get_survival(["E1", "E1", "E2", "E3"], 
+                          ["Lung", "Breast", "Lung", "Lung"], 
+                          [50.0, 81.0, 45.0, 60.0])
+    assert db.upload_df(ctx, df_new, destination, key_cols=key_cols, 
+                        mode="merge")
+    assert "Inserted 1 and updated 1 rows" in capsys.readouterr().out
+
+    df_rows = get_rows(ctx)
+    pd.testing.assert_frame_equal(
+        df_rows[["AREA_CODE", "CANCER_SITE", "SURVIVAL_PERCENT"]],
+        df_new.sort_values(key_cols, ignore_index=True))
+    pd.testing.assert_series_equal(
+        df_rows["ROW_HASH"], 
+        db.add_row_hashes(df_new, key_cols).sort_values(
+            key_cols, ignore_index=True)["ROW_HASH"])
+
+def test_merge_into_table_loaded_with_replace(ctx, capsys):
+    df = get_survival(["E1", "E2"], ["Lung", "Lung"], [50.0, 45.0])
+    assert db.upload_df(ctx, df, destination, key_cols=key_cols, 
+                        mode="replace")
+
+    #The rows loaded without a ROW_KEY are replaced (not duplicated)
+    assert db.upload_df(ctx, df, destination, key_cols=key_cols, mode="merge")
+    assert "Inserted 2 and updated 0 rows" in capsys.readouterr().out
+    assert len(get_rows(ctx)) == 2
+
+@pytest.mark.parametrize("mode, hashed", [("replace", False), 
+                                          ("append", False),
+                                          ("merge", True),
+                                          ("swap", True)])
+def test_row_hashes_only_added_for_merge_and_swap(ctx, mode, hashed):
+    df = get_survival(["E1", "E2"], ["Lung", "Lung"], [50.0, 45.0])
+
+    assert db.upload_df(ctx, df, destination, key_cols=key_cols, mode=mode)
+
+    df_rows = get_rows(ctx)
+    assert df_rows["ROW_KEY"].notna().all() == hashed
+    assert df_rows["ROW_HASH"].notna().all() == hashed
+
+#A table created before the row hashes were added (without the columns) can
+#still be loaded with the default replace mode
+def test_replace_keeps_the_table_shape(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with engine.begin() as con:
+        con.execute(text('CREATE TABLE SURVIVAL ("AREA_CODE" TEXT, '
+                         '"CANCER_SITE" TEXT, "SURVIVAL_PERCENT" REAL)'))
+    df = get_survival(["E1", "E2"], ["Lung", "Lung"], [50.0, 45.0])
+
+    assert db.upload_df(engine, df, "SURVIVAL", key_cols=key_cols, 
+                        mode="replace")
+
+    with engine.connect() as con:
+        assert con.execute(text("SELECT COUNT(*) FROM SURVIVAL")).scalar() == 2
+
+def test_merge_rerun_of_transformed_data_is_a_no_op(workbooks, local_env, 
+                                                    monkeypatch, capsys):
+    for name, value in {**local_env, "LOAD_MODE": "merge"}.items():
+        monkeypatch.setenv(name, value)
+    ctx = main.get_connection()
+
+    for data_file in workbooks:
+        assert main.process_data_file(ctx, data_file, main.target_geographies)
+    out = capsys.readouterr().out
+    assert "updated 0 rows in DEV.TEST.INDEX" in out
+    assert "Inserted 0" not in out
+
+    for data_file in workbooks:
+        assert main.process_data_file(ctx, data_file, main.target_geographies)
+    out = capsys.readouterr().out
+    assert "Inserted 0 and updated 0 rows in DEV.TEST.INDEX" in out
+    assert "Inserted 0 and updated 0 rows in DEV.TEST.ADULT_4" in out
+
+#Get the tables left in a local database after a load
+def get_tables(ctx):
+    if isinstance(ctx, db.Engine):
+        return sorted(db.inspect(ctx).get_table_names())
+    return sorted(row[0] for row in ctx.execute(
+        "SELECT table_name FROM duckdb_tables()").fetchall())
+
+#The modes run through the sink of each backend and remove their staging and
+#shadow tables (which are named uniquely per load)
+@pytest.mark.parametrize("backend", ["duckdb", "sqlite"])
+def test_modes_leave_no_work_tables(tmp_path, backend, capsys):
+    df = get_survival(["E1", "E2"], ["Lung", "Lung"], [50.0, 45.0])
+    if backend == "duckdb":
+        ctx = db.connect_local(str(tmp_path / "test.duckdb"), "DEV", "TEST")
+        table = destination
+    else:
+        ctx = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+        db.add_row_hashes(df, key_cols).head(0).to_sql("SURVIVAL", ctx, 
+                                                       index=False)
+        table = "SURVIVAL"
+
+    for mode in ["replace", "merge", "swap", "merge"]:
+        assert db.upload_df(ctx, df, table, key_cols=key_cols, mode=mode)
+        assert get_tables(ctx) == ["SURVIVAL"]
+    assert "Inserted 0 and updated 0 rows" in capsys.readouterr().out
+
+    assert (db.get_work_table(table, "STAGE") != 
+            db.get_work_table(table, "STAGE"))
+
+#Get the chunks of a dataframe, raising an error instead of the given chunk
+def get_chunks(df, chunk_rows, fail_chunk=None):
+    for i, start in enumerate(range(0, len(df), chunk_rows)):
+        if i == fail_chunk:
+            raise RuntimeError(f"Chunk {i} failed")
+        yield df.iloc[start:start + chunk_rows]
+
+#Snowflake commits every write, so the replace and append modes load through
+#a shadow or staging table and the destination only changes once every chunk
+#is written
+@pytest.mark.parametrize("mode", ["replace", "append"])
+def test_snowflake_streamed_load(snowflake_ctx, mode):
+    df_old = get_survival(["E1"], ["Lung"], [50.0])
+    df = get_survival(["E1", "E2", "E3"], ["Lung", "Lung", "Lung"], 
+                      [51.0, 45.0, 60.0])
+    snowflake_ctx.tables[destination] = df_old
+
+    assert not db.upload_df(snowflake_ctx, get_chunks(df, 1, fail_chunk=2), 
+                            destination, mode=mode)
+    assert list(snowflake_ctx.tables) == [destination]
+    pd.testing.assert_frame_equal(snowflake_ctx.tables[destination], df_old)
+    assert not any(sql.startswith("TRUNCATE") 
+                   for sql in snowflake_ctx.statements)
+
+    assert db.upload_df(snowflake_ctx, get_chunks(df, 1), destination, 
+                        mode=mode)
+    assert list(snowflake_ctx.tables) == [destination]
+    expected_rows = len(df) + (len(df_old) if mode == "append" else 0)
+    assert len(snowflake_ctx.tables[destination]) == expected_rows
+
+#Local databases roll back the chunks already written when a later chunk fails
+@pytest.mark.parametrize("mode", ["replace", "append", "merge", "swap"])
+def test_failed_chunk_leaves_sqlite_table_unchanged(tmp_path, mode):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    df_old = db.add_row_hashes(get_survival(["E1"], ["Lung"], [50.0]), 
+                               key_cols)
+    df_old.to_sql("SURVIVAL", engine, index=False)
+    df = get_survival(["E1", "E2", "E3"], ["Lung", "Lung", "Lung"], 
+                      [51.0, 45.0, 60.0])
+
+    assert not db.upload_df(engine, get_chunks(df, 1, fail_chunk=2), 
+                            "SURVIVAL", key_cols=key_cols, mode=mode)
+
+    assert get_tables(engine) == ["SURVIVAL"]
+    pd.testing.assert_frame_equal(pd.read_sql("SELECT * FROM SURVIVAL", engine),
+                                  df_old)
+
+#With scope_cols a merge deletes the rows missing from the upload, but only
+#those with the scope values of the upload (the diagnosis windows)
+@pytest.mark.parametrize("backend", ["duckdb", "sqlite"])
+def test_merge_deletes_missing_rows_in_scope(tmp_path, backend, capsys):
+    window_key_cols = key_cols + ["DATE_DIAGNOSIS_WINDOW"]
+    df = get_survival(["E1", "E2", "E1", "E2"], ["Lung"] * 4, 
+                      [50.0, 45.0, 51.0, 46.0])
+    df["DATE_DIAGNOSIS_WINDOW"] = ["2016-2020"] * 2 + ["2017-2021"] * 2
+    if backend == "duckdb":
+        ctx = db.connect_local(str(tmp_path / "test.duckdb"), "DEV", "TEST")
+        table = destination
+    else:
+        ctx = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+        db.add_row_hashes(df, window_key_cols).head(0).to_sql(
+            "SURVIVAL", ctx, index=False)
+        table = "SURVIVAL"
+
+    def merge(df, scope_cols):
+        assert db.upload_df(ctx, df, table, key_cols=window_key_cols, 
+                            mode="merge", scope_cols=scope_cols)
+        if backend == "duckdb":
+            df_rows = ctx.execute(f"SELECT * FROM {table}").df()
+        else:
+            df_rows = pd.read_sql(f"SELECT * FROM {table}", ctx)
+        return sorted(zip(df_rows["AREA_CODE"], 
+                          df_rows["DATE_DIAGNOSIS_WINDOW"]))
+
+    assert len(merge(df, ["DATE_DIAGNOSIS_WINDOW"])) == 4
+    assert "Deleted 0 rows" in capsys.readouterr().out
+
+    #E2 is missing from the newer window, the older window is kept
+    assert merge(df.iloc[[2]], ["DATE_DIAGNOSIS_WINDOW"]) == [
+        ("E1", "2016-2020"), ("E1", "2017-2021"), ("E2", "2016-2020")]
+    assert "Deleted 1 rows missing from the upload" in capsys.readouterr().out
+
+    #Without scope_cols no rows are deleted
+    assert len(merge(df.iloc[[0]], None)) == 3
+    assert "Deleted" not in capsys.readouterr().out
+
+    #An empty scope deletes every row missing from the upload
+    assert merge(df.iloc[[0]], []) == [("E1", "2016-2020")]
@@ -0,0 +1,32 @@
+#Tests for loading a local DuckDB database (LOCAL_DATABASE)
+
+#Import packages
+import main
+
+#Load the synthetic workbooks into a local database and return a connection
+def load_local_database(workbooks, local_env, monkeypatch):
+    for name, value in local_env.items():
+        monkeypatch.setenv(name, value)
+
+    ctx = main.get_connection()
+    for data_file in workbooks:
+        assert main.process_data_file(ctx, data_file, main.target_geographies)
+
+    return ctx
+
+def test_create_local_views(workbooks, local_env, monkeypatch):
+    ctx = load_local_database(workbooks, local_env, monkeypatch)
+
+    assert main.create_local_views(ctx) > 0
+
+    #The views read the loaded tables
+    nrows = ctx.execute("SELECT COUNT(*) FROM "
+                        "DEV.DEV__REPORTING__CANCER__SURVIVAL.INDEX").fetchone()[0]
+    assert nrows > 0
+
+def test_create_local_views_warns_without_sql(workbooks, local_env, 
+                                              monkeypatch, tmp_path, capsys):
+    ctx = load_local_database(workbooks, local_env, monkeypatch)
+
+    assert main.create_local_views(ctx, docs_dir=str(tmp_path)) == 0
+    assert "Warning: No reporting views" in capsys.readouterr().out
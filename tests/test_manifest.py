@@ -0,0 +1,95 @@
+#Tests for skipping unchanged publications with the manifest and for the exit
+#codes of the check command
+
+#Import packages
+import pytest
+
+import main
+import utils.scrape_util as scrape
+
+site = "https://digital.nhs.uk"
+pages = [
+    "/pub/cancer-survival-in-england/cancers-diagnosed-2017-to-2021",
+    "/pub/cancer-survival-in-england/index-of-cancer-survival-2021",
+]
+file_url = site + "/files/adult_survival.xlsx"
+
+#A scrape cache holding the parsed links of the target pages and the version
+#of the adult data file last downloaded
+@pytest.fixture
+def scrape_cache(monkeypatch, tmp_path):
+    cache = {
+        site + pages[0]: {
+            "sha256": "page", "links_sha256": "page",
+            "links": {"adult_survival": {"url": file_url}}},
+        site + pages[1]: {
+            "sha256": "page", "links_sha256": "page", "links": {}},
+        file_url: {
+            "etag": '"v1"', "last_modified": "Tue, 01 Oct 2024 09:00:00 GMT",
+            "sha256": "abc"}
+    }
+    monkeypatch.setattr(scrape, "_scrape_cache", cache)
+    monkeypatch.setattr(scrape, "scrape_cache_dir", str(tmp_path / "scrape"))
+
+    #The pages are not requested
+    def get_file_links_from_page(page, url=site):
+        raise AssertionError(f"{page} was requested")
+    monkeypatch.setattr(scrape, "get_file_links_from_page",
+                        get_file_links_from_page)
+
+    return cache
+
+#Build the manifest of a run that loaded the adult data file from memory
+@pytest.fixture
+def manifest(scrape_cache, monkeypatch, tmp_path):
+    data_file = str(tmp_path / "adult_survival.xlsx")
+    main.cache.add_memory_file(data_file, b"workbook", "abc")
+    monkeypatch.setattr(main, "get_snapshot_date_from_adult",
+                        lambda data_file: "March 2024")
+    manifest = main.build_manifest(pages, [data_file])
+    main.cache.remove_memory_file(data_file)
+    return manifest
+
+def test_build_manifest_uses_the_cached_page_links(manifest):
+    assert manifest["files"]["adult_survival"] == {
+        "url": file_url,
+        "data_file": manifest["files"]["adult_survival"]["data_file"],
+        "sha256": "abc",
+        "etag": '"v1"',
+        "last_modified": "Tue, 01 Oct 2024 09:00:00 GMT"
+    }
+
+#Files kept in memory have no local copy so the scrape cache is checked
+def test_in_memory_publication_is_unchanged(manifest, scrape_cache):
+    assert main.is_publication_unchanged(manifest, pages, in_memory=True)
+    assert not main.is_publication_unchanged(manifest, pages)
+
+    #A newer version of the file has been downloaded since
+    scrape_cache[file_url]["etag"] = '"v2"'
+    assert not main.is_publication_unchanged(manifest, pages, in_memory=True)
+
+@pytest.mark.parametrize("new_file_ids, exit_code", [
+    (["adult_survival"], 0),
+    ([], main.no_new_data_exit_code)
+])
+def test_check_exit_code(monkeypatch, new_file_ids, exit_code):
+    monkeypatch.setattr(main, "check_for_new_data", lambda: new_file_ids)
+    assert main.cli(["check"]) == exit_code
+
+#A snapshot date that can't be parsed is reported (other errors are raised)
+def test_build_manifest_warns_without_a_snapshot_date(scrape_cache, 
+                                                      monkeypatch, tmp_path,
+                                                      capsys):
+    data_file = str(tmp_path / "adult_survival.xlsx")
+    main.cache.add_memory_file(data_file, b"workbook", "abc")
+
+    def get_snapshot_date_from_adult(data_file):
+        raise ValueError("No snapshot month found in: Methodology")
+    monkeypatch.setattr(main, "get_snapshot_date_from_adult",
+                        get_snapshot_date_from_adult)
+
+    manifest = main.build_manifest(pages, [data_file])
+    main.cache.remove_memory_file(data_file)
+
+    assert manifest["date_snapshot"] is None
+    assert "Unable to extract the snapshot date" in capsys.readouterr().out
@@ -0,0 +1,66 @@
+#Tests for processing the data files in parallel (main.process_files)
+
+#Import packages
+import os
+import shutil
+import subprocess
+import sys
+
+import duckdb
+import pytest
+
+import main
+from conftest import src_dir
+
+#Processes the data files given as arguments (after the cache directory) with
+#two workers and exits with 1 if any upload failed
+process_script = """
+import sys
+import main
+main.cache.cache_dir = sys.argv[1]
+data_files = sys.argv[2:]
+results = main.process_files(main.get_connection, data_files, 
+                             main.target_geographies, max_workers=2)
+sys.exit(0 if len(results) == len(data_files) and all(results) else 1)
+"""
+
+#Each run is in a new interpreter so the upload threads are the first to use
+#the lazily imported modules (the uploads only failed some of the time)
+@pytest.mark.parametrize("run", range(3))
+def test_parallel_uploads_to_local_database(workbooks, local_env, tmp_path, 
+                                            run):
+    env = {**os.environ, **local_env, "TELEMETRY": "0",
+           "PYTHONPATH": os.pathsep.join(
+               [src_dir] + os.environ.get("PYTHONPATH", "").split(os.pathsep))}
+
+    result = subprocess.run([sys.executable, "-c", process_script, 
+                             str(tmp_path / "cache"), *workbooks],
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    with duckdb.connect() as con:
+        con.execute(f"ATTACH '{local_env['LOCAL_DATABASE']}' AS DEV (READ_ONLY)")
+        for table in ["INDEX", "ADULT_4"]:
+            nrows = con.execute(
+                f"SELECT COUNT(*) FROM DEV.TEST.{table}").fetchone()[0]
+            assert nrows > 0
+
+#Files with the same destination table (adult files of two diagnosis windows)
+#are uploaded one after another, as uploads to one table at the same time 
+#conflict
+def test_uploads_to_one_table_run_in_order(workbooks, local_env, tmp_path,
+                                           monkeypatch):
+    for name, value in {**local_env, "LOAD_MODE": "merge"}.items():
+        monkeypatch.setenv(name, value)
+    older_file = str(tmp_path / "adult_synthetic_2016_2020.xlsx")
+    shutil.copy(workbooks[1], older_file)
+
+    results = main.process_files(main.get_connection, 
+                                 [workbooks[1], older_file],
+                                 main.target_geographies, max_workers=2)
+    assert results == [True, True]
+
+    ctx = main.get_connection()
+    windows = ctx.execute("SELECT DISTINCT DATE_DIAGNOSIS_WINDOW "
+                          "FROM DEV.TEST.ADULT_4").fetchall()
+    assert sorted(windows) == [("2016-2020",), ("2017-2021",)]
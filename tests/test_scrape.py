@@ -0,0 +1,147 @@
+#Tests for scraping the NHSD site (utils/scrape_util.py and the downloads of
+#utils/async_scrape_util.py) on a local site
+
+#Import packages
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import utils.async_scrape_util as async_scrape
+import utils.cache_util as cache
+import utils.scrape_util as scrape
+
+page = "/pub/cancer-survival-in-england/index-of-cancer-survival-2021"
+file_path = "/files/Index_of_cancer_survival.xlsx"
+
+#A page that hasn't changed since it was last requested is read from the
+#page cache (the server answers the conditional request with a 304)
+def test_unchanged_page_is_read_from_the_cache(site):
+    site.add_page(page, [file_path])
+
+    links = scrape.get_file_links_from_page(page, url=site.url)
+    assert links == {"Index_of_cancer_survival": {
+        "url": site.url + file_path, "ext": "xlsx"}}
+    assert scrape.get_file_links_from_page(page, url=site.url) == links
+    assert site.get_statuses(page) == [200, 304]
+
+    #A new version of the page is downloaded and parsed again
+    site.add_page(page, [file_path, "/files/Index_extra.xlsx"])
+    links = scrape.get_file_links_from_page(page, url=site.url)
+    assert site.get_statuses(page) == [200, 304, 200]
+    assert "Index_extra" in links
+
+#A file is only requested conditionally if the local copy is the version in
+#the scrape cache
+def test_unchanged_file_is_not_downloaded_again(site, tmp_path):
+    site.content[file_path] = b"workbook"
+    links = {"Index": {"url": site.url + file_path}}
+    dest_file = str(tmp_path / "Index.xlsx")
+
+    assert scrape.download_file_from_id(links, "Index", dest_file) == dest_file
+    assert scrape.download_file_from_id(links, "Index", dest_file) is None
+    assert site.get_statuses(file_path) == [200, 304]
+
+    #The local copy has changed so the file is downloaded again
+    with open(dest_file, "wb") as file:
+        file.write(b"edited")
+    assert scrape.download_file_from_id(links, "Index", dest_file) == dest_file
+    assert site.get_statuses(file_path) == [200, 304, 200]
+    with open(dest_file, "rb") as file:
+        assert file.read() == b"workbook"
+
+#Every thread uses the one pooled session
+def test_session_is_shared_between_threads(site):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        sessions = list(executor.map(lambda _: scrape.get_session(), range(8)))
+
+    assert all(session is sessions[0] for session in sessions)
+    assert sessions[0].get_adapter(site.url)._pool_maxsize == scrape.max_workers
+
+#A transient server error is retried
+def test_download_retries_transient_errors(site, tmp_path):
+    site.content[file_path] = b"workbook"
+    site.failures[file_path] = 1
+    links = {"Index": {"url": site.url + file_path}}
+    dest_file = str(tmp_path / "Index.xlsx")
+
+    assert scrape.download_file_from_id(links, "Index", dest_file) == dest_file
+    assert site.get_statuses(file_path) == [503, 200]
+
+#The files are streamed to disk in blocks (through a .part file) and the
+#results are in the order of the downloads
+def test_download_files_streams_to_disk(site, monkeypatch, tmp_path):
+    monkeypatch.setattr(scrape, "chunk_size", 1000)
+    block_sizes = []
+    iter_content = requests.Response.iter_content
+    def record_blocks(res, chunk_size=1, **kwargs):
+        for block in iter_content(res, chunk_size=chunk_size, **kwargs):
+            block_sizes.append(len(block))
+            yield block
+    monkeypatch.setattr(requests.Response, "iter_content", record_blocks)
+
+    paths = ["/files/Index.xlsx", "/files/adult_2017_2021.xlsx"]
+    site.content[paths[0]] = os.urandom(10500)
+    site.content[paths[1]] = os.urandom(20)
+    links = {path.split("/")[-1].split(".")[0]: {"url": site.url + path}
+             for path in paths}
+    downloads = [(links, file_id, str(tmp_path / f"{file_id}.xlsx")) 
+                 for file_id in links]
+
+    results = scrape.download_files(downloads + [(links, "missing", None)])
+
+    assert results == [dest_file for _, _, dest_file in downloads] + [0]
+    for path, dest_file in zip(paths, results):
+        with open(dest_file, "rb") as file:
+            assert file.read() == site.content[path]
+    assert max(block_sizes) == 1000 and len(block_sizes) == 12
+    assert sorted(os.listdir(tmp_path)) == ["Index.xlsx", "adult_2017_2021.xlsx",
+                                            "scrape_cache"]
+
+#Download a file with scrape_util or async_scrape_util
+def download_file(mode, *args, **kwargs):
+    if mode == "sync":
+        return scrape.download_file_from_id(*args, **kwargs)
+
+    async def download():
+        async with async_scrape.create_session() as session:
+            return await async_scrape.download_file_from_id(session, *args, 
+                                                            **kwargs)
+    return asyncio.run(download())
+
+#Files kept in memory are only saved to the data directory if persist is True
+@pytest.mark.parametrize("mode", ["sync", "async"])
+@pytest.mark.parametrize("persist", [True, False])
+def test_download_to_memory(site, tmp_path, mode, persist):
+    site.content[file_path] = b"workbook"
+    links = {"Index": {"url": site.url + file_path}}
+    dest_file = str(tmp_path / "Index.xlsx")
+
+    result = download_file(mode, links, "Index", dest_file, to_memory=True,
+                           persist=persist)
+
+    assert result == dest_file
+    assert cache.get_memory_file(dest_file) == b"workbook"
+    assert os.path.exists(dest_file) == persist
+    cache.remove_memory_file(dest_file)
+
+#Files too large to keep in memory are streamed to a temporary file instead
+#(keeping the file name) unless they are saved to the data directory
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_large_download_spills_to_disk(site, monkeypatch, tmp_path, mode):
+    monkeypatch.setattr(scrape, "memory_max_bytes", 100)
+    site.content[file_path] = os.urandom(1000)
+    links = {"Index": {"url": site.url + file_path}}
+    dest_file = str(tmp_path / "Index.xlsx")
+
+    result = download_file(mode, links, "Index", dest_file, to_memory=True,
+                           persist=False)
+
+    assert result != dest_file
+    assert os.path.basename(result) == "Index.xlsx"
+    assert not os.path.exists(dest_file)
+    assert cache.get_memory_file(result) is None
+    with open(result, "rb") as file:
+        assert file.read() == site.content[file_path]
@@ -0,0 +1,224 @@
+#Tests that the transforms give the same output as the original (baseline)
+#transforms on the synthetic workbooks
+#
+#The baseline transforms below are the original process_* functions (reading
+#each sheet with pandas and transforming it step by step) without the upload
+#and the upload date (which isn't in the output).
+
+#Import packages
+from calendar import month_name
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+import utils.pipeline_util as pipeline
+
+def get_snapshot_date_from_adult(data_file):
+    df = pd.read_excel(data_file, sheet_name="Notes and definitions",
+                       skiprows=10)
+    month_year = df.iloc[0,0].split(" ")[-3:-1]
+    if month_year[0] not in month_name[1:]:
+        raise Exception()
+    return " ".join(month_year)
+
+def generalise_gender(df, cancer_site, base_gender):
+    df_gendered = df[(df["Cancer site"] == cancer_site)
+                     & (df["Gender"] == base_gender)].copy()
+    df_gendered["Gender"] = "Persons"
+    return pd.concat([df, df_gendered])
+
+def format_columns(df):
+    df.columns = df.columns.str.replace('\n', ' ', regex=False)
+    df.columns = df.columns.str.strip().str.replace(' ', '_')
+    df.columns = df.columns.str.lower()
+    return df
+
+def baseline_index_data(data_file, target_geographies):
+    df = pd.read_excel(data_file, sheet_name="Table 5", skiprows=10)
+
+    df = df[((df["Geography type"] == "Cancer Alliance") |
+             (df["Geography code"].isin(target_geographies)))].copy()
+    df["area_core"] = df["Geography code"].isin(target_geographies)
+    df["data_substituted"] = np.where(
+        df["Substituted by Other Geography"].isnull(), False, True)
+
+    breast = ((df["Cancer site"] == "Breast") & (df["Gender"] == "Female")
+              & (df["Age at diagnosis"] == "All ages"))
+    df_dupe = df[breast].copy()
+    df_dupe["Gender"] = "Persons"
+    df = pd.concat([df[~breast], df_dupe])
+
+    df["Cancer site"] = df["Cancer site"].str.replace('Index', 'Overall')
+    df = df[~(df["Cancer site"] == "Other")]
+
+    df = df[main.index_pipeline["keep"][:-1]]
+    df = format_columns(df.rename(columns=main.index_pipeline["column_map"]))
+
+    rename = main.index_pipeline["rename"]
+    return df[list(rename)].rename(columns=rename)
+
+def baseline_adult_data_sheet4(data_file, target_geographies):
+    df = pd.read_excel(data_file, sheet_name="Table 4", skiprows=9)
+
+    df["area_core"] = df["Geography code"].isin(target_geographies)
+    df = df[(df["area_core"] == True) |
+            (df["Geography type"] == "Cancer Alliance")].copy()
+
+    std = df["Standardisation type"]
+    std_sc = std.where(std != "Non-standardised")
+    std_sc = std_sc.str.split("(").str[1].str.split(")").str[0]
+    df["standardisation_type_subcategory"] = std_sc
+    df["Standardisation type"] = std.str.split("(").str[0].str.strip()
+
+    diagnosis_window_years = data_file.split(".")[-2].split("_")[-2:]
+    df["date_diagnosis_window"] = "-".join(diagnosis_window_years)
+    df["date_snapshot"] = get_snapshot_date_from_adult(data_file)
+
+    df_breast_persons = df[(df["Cancer site"] == "Breast") &
+                           (df["Gender"] == "Female") &
+                           (df["Geography code"] == "E92000001")].copy()
+    df_breast_persons["Gender"] = "Persons"
+    df = pd.concat([df, df_breast_persons])
+
+    for site in ["Larynx", "Prostate"]:
+        df = generalise_gender(df, site, "Male")
+    for site in ["Cervix", "Ovary"]:
+        df = generalise_gender(df, site, "Female")
+
+    unpivot = main.adult4_pipeline["unpivot"]
+    id_cols = [col for col in main.adult4_pipeline["keep"]
+               if col not in ["date_upload", unpivot["var_name"],
+                              unpivot["value_name"]]]
+    df = pd.melt(df[id_cols + unpivot["value_cols"]], id_vars=id_cols,
+                 var_name="survival_metric", value_name="survival_per")
+    df["survival_metric"] = (
+        df["survival_metric"].str.removesuffix(" (%)").str.title())
+
+    df = format_columns(
+        df.rename(columns=main.adult4_pipeline["column_map"]))
+
+    rename = main.adult4_pipeline["rename"]
+    return df[list(rename)].rename(columns=rename)
+
+#Get a dataframe with plain (object and 64 bit) dtypes, sorted by its key
+#columns, so the output of the compact dtypes can be compared with the
+#baseline
+def normalise(df, key_cols):
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+        elif pd.api.types.is_integer_dtype(df[col]):
+            df[col] = df[col].astype("int64")
+        elif pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype("float64")
+        elif pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].astype(bool)
+        else:
+            df[col] = df[col].astype(object)
+
+    df = df.where(df.notna(), None)
+    return df.sort_values(key_cols, ignore_index=True)
+
+transforms = {
+    "index": (main.transform_index_data, baseline_index_data,
+              main.index_key_cols, 0),
+    "adult": (main.transform_adult_data_sheet4, baseline_adult_data_sheet4,
+              main.adult4_key_cols, 1)
+}
+
+@pytest.fixture(params=[True, False], ids=["compact", "plain"])
+def compact_dtypes(request, monkeypatch):
+    monkeypatch.setattr(main, "compact_dtypes", request.param)
+    return request.param
+
+@pytest.mark.parametrize("table", transforms)
+def test_transform_matches_baseline(workbooks, compact_dtypes, table):
+    transform, baseline, key_cols, file_position = transforms[table]
+    data_file = workbooks[file_position]
+
+    df = transform(data_file, main.target_geographies)
+    df_baseline = baseline(data_file, main.target_geographies)
+
+    assert list(df.columns) == list(df_baseline.columns)
+    pd.testing.assert_frame_equal(normalise(df, key_cols),
+                                  normalise(df_baseline, key_cols))
+
+#The compact dtypes read the text columns as categoricals and downcast the
+#integer columns
+def test_compact_dtypes(workbooks, monkeypatch):
+    df = main.transform_adult_data_sheet4(workbooks[1],
+                                          main.target_geographies)
+
+    monkeypatch.setattr(main, "compact_dtypes", False)
+    df_plain = main.transform_adult_data_sheet4(workbooks[1],
+                                                main.target_geographies)
+
+    for col in ["AREA_CODE", "CANCER_SITE", "GENDER"]:
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+    assert df["PATIENT_NUMBERS"].dtype.itemsize < 8
+    assert (df.memory_usage(deep=True).sum() <
+            df_plain.memory_usage(deep=True).sum())
+
+#Every gender exclusive site has a Persons copy of its rows (and breast only
+#for England)
+def test_generalise_gender_adds_persons_rows(workbooks):
+    df = main.transform_adult_data_sheet4(workbooks[1],
+                                          main.target_geographies)
+
+    for site, gender in [("Larynx", "Male"), ("Prostate", "Male"),
+                         ("Cervix", "Female"), ("Ovary", "Female")]:
+        df_site = df[df["CANCER_SITE"] == site]
+        assert (df_site["GENDER"] == "Persons").sum() > 0
+        assert ((df_site["GENDER"] == "Persons").sum() ==
+                (df_site["GENDER"] == gender).sum())
+
+    breast_persons = df[(df["CANCER_SITE"] == "Breast") &
+                        (df["GENDER"] == "Persons")]
+    assert set(breast_persons["AREA_CODE"]) == {"E92000001"}
+
+@pytest.mark.parametrize("keep_base", [True, False])
+@pytest.mark.parametrize("dtype", [object, "category"])
+def test_generalise_gender_matches_baseline(keep_base, dtype):
+    df = pd.DataFrame({
+        "Cancer site": ["Prostate", "Prostate", "Ovary", "Lung", "Ovary"],
+        "Gender": ["Male", "Female", "Female", "Male", "Male"],
+        "Survival": [1, 2, 3, 4, 5]
+    }).astype({"Cancer site": dtype, "Gender": dtype})
+
+    df_new = main.generalise_gender(df.copy(),
+                                    {"Prostate": "Male", "Ovary": "Female"},
+                                    keep_base=keep_base)
+
+    df_baseline = generalise_gender(
+        df.astype({"Cancer site": object, "Gender": object}), 
+        "Prostate", "Male")
+    df_baseline = generalise_gender(df_baseline, "Ovary", "Female")
+    if not keep_base:
+        #The base rows are relabelled as Persons instead of copied
+        df_baseline = df_baseline[~df_baseline.index.duplicated(keep="last")]
+
+    pd.testing.assert_frame_equal(
+        normalise(df_new, ["Survival", "Gender"]),
+        normalise(df_baseline, ["Survival", "Gender"]))
+
+#Streaming the pipeline spec in chunks gives the same rows as one pass
+@pytest.mark.parametrize("table", transforms)
+def test_iter_pipeline_matches_run_pipeline(workbooks, table):
+    _, _, key_cols, file_position = transforms[table]
+    data_file = workbooks[file_position]
+    spec = {"index": main.index_pipeline, "adult": main.adult4_pipeline}[table]
+    context = {"data_file": data_file,
+               "target_geographies": main.target_geographies}
+
+    df = pipeline.run_pipeline(spec, data_file, context)
+    df_chunks = pd.concat(pipeline.iter_pipeline(spec, data_file, context,
+                                                 chunk_rows=500),
+                          ignore_index=True)
+
+    pd.testing.assert_frame_equal(
+        normalise(df.drop(columns="date_upload", errors="ignore"), key_cols),
+        normalise(df_chunks.drop(columns="date_upload", errors="ignore"),
+                  key_cols))
@@ -0,0 +1,86 @@
+#Tests that data failing validation stops the run before (or rolls back) the
+#upload of the tables
+
+#Import packages
+import os
+
+import pandas as pd
+import pytest
+
+import main
+import utils.validation_util as validation
+from utils.validation_util import ValidationError
+
+@pytest.fixture
+def local_db(local_env, monkeypatch):
+    for key, value in local_env.items():
+        monkeypatch.setenv(key, value)
+    return local_env["LOCAL_DATABASE"]
+
+def count_rows(ctx, table):
+    return ctx.execute(f"SELECT COUNT(*) FROM DEV.TEST.{table}").fetchone()[0]
+
+#No file is uploaded (or connection opened) when any file fails validation
+def test_process_files_validates_before_uploading(workbooks, bad_adult_file,
+                                                  local_db):
+    with pytest.raises(ValidationError, match="SURVIVAL_PERCENT"):
+        main.process_files(main.get_connection,
+                           [workbooks[0], bad_adult_file],
+                           main.target_geographies, max_workers=2)
+
+    assert not os.path.exists(local_db)
+
+#A streamed load fails on a later chunk after the first chunks are uploaded,
+#so the table is rolled back to its previous rows
+def test_streaming_validation_error_rolls_back(workbooks, bad_adult_file,
+                                               local_db, monkeypatch):
+    ctx = main.get_connection()
+    assert main.process_data_file(ctx, workbooks[1], main.target_geographies)
+    rows = count_rows(ctx, "ADULT_4")
+
+    monkeypatch.setenv("STREAM_ROWS", "100")
+    with pytest.raises(ValidationError, match="SURVIVAL_PERCENT"):
+        main.process_data_file(ctx, bad_adult_file, main.target_geographies)
+
+    assert count_rows(ctx, "ADULT_4") == rows
+    ctx.close()
+
+#On Snowflake every write commits, so the chunks uploaded before the failed
+#chunk are only in a shadow or staging table and the table is unchanged
+@pytest.mark.parametrize("mode", ["replace", "append", "swap"])
+def test_streaming_validation_error_leaves_snowflake_table_unchanged(
+        bad_adult_file, snowflake_ctx, monkeypatch, mode):
+    for key, value in {"DATABASE": "DEV", "SCHEMA": "TEST", 
+                       "DESTINATION_ADULT4": "ADULT_4", "LOAD_MODE": mode,
+                       "STREAM_ROWS": "100"}.items():
+        monkeypatch.setenv(key, value)
+    df_old = pd.DataFrame({"AREA_CODE": ["E1"], "SURVIVAL_PERCENT": [50.0]})
+    snowflake_ctx.tables["DEV.TEST.ADULT_4"] = df_old
+
+    with pytest.raises(ValidationError, match="SURVIVAL_PERCENT"):
+        main.process_data_file(snowflake_ctx, bad_adult_file, 
+                               main.target_geographies)
+
+    assert snowflake_ctx.written_rows > 0
+    assert list(snowflake_ctx.tables) == ["DEV.TEST.ADULT_4"]
+    pd.testing.assert_frame_equal(snowflake_ctx.tables["DEV.TEST.ADULT_4"], 
+                                  df_old)
+
+#Under copy-on-write (pandas 3) the arrays of a column are read-only, so the
+#checks must not change them in place
+def test_range_checks_with_read_only_arrays(monkeypatch):
+    get_numbers = validation.get_numbers
+
+    def get_read_only_numbers(s):
+        arrays = get_numbers(s)
+        for array in arrays:
+            array.setflags(write=False)
+        return arrays
+    monkeypatch.setattr(validation, "get_numbers", get_read_only_numbers)
+
+    df = pd.DataFrame({"SURVIVAL_PERCENT": [50.0, 150.0, -1.0, "x"]})
+    problems = validation.get_row_problems(
+        df, {"ranges": {"SURVIVAL_PERCENT": (0, 100)}})
+
+    assert len(problems) == 1
+    assert "3 rows" in problems[0]